@@ -0,0 +1,204 @@
+import argparse
+import json
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+
+try:
+    import resource
+except ImportError:  # Not available under Windows, the peak memory is not measured there
+    resource = None
+
+import xml2dict
+from extraction_metrics import collect_metrics
+from synthetic_xml import write_synthetic_folder
+
+
+# Benchmark Setup #####################################################################################################
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_baseline.json')
+# Synthetic folders the stages are measured on (see synthetic_xml.write_synthetic_folder)
+BENCHMARK_SCENARIOS = {'small': dict(num_stations=4, num_hours=24, num_versions=2, num_sensors=8, num_subtests=2),
+                       'large': dict(num_stations=2, num_hours=24, num_versions=3, num_sensors=40, num_subtests=5)}
+BENCHMARK_STAGES = ('header_scan', 'compose', 'folder')
+
+
+def peak_rss_mb():
+    """ Returns the peak resident memory of the current process in MB (None if it can't be measured). """
+    if resource is None:
+        return None
+    # ru_maxrss is given in kilobytes under Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def measured_call(function, **kwargs):
+    """ Runs the measured call of a stage with the stage timers of the extraction collected (see extraction_metrics),
+    so a change of the throughput can be traced to the parse, compose, pickle etc. steps.
+
+    Returns:
+        seconds (float) - Duration of the call
+        timers (dict) - Stage as key and number of calls and seconds as value
+    """
+    with collect_metrics() as metrics:
+        start_time = time.perf_counter()
+        function(**kwargs)
+        seconds = time.perf_counter() - start_time
+    return seconds, metrics['timers']
+
+
+def stage_result(num_files: int, num_bytes: int, seconds: float, timers: dict = None):
+    """ Returns the throughput of a measured stage together with the stage timers of its call. """
+    seconds = max(seconds, 1e-9)
+    return {'files': num_files,
+            'seconds': round(seconds, 4),
+            'files_per_s': round(num_files / seconds, 2),
+            'mb_per_s': round(num_bytes / 2 ** 20 / seconds, 3),
+            'peak_rss_mb': peak_rss_mb(),
+            'timers': {stage: [calls, round(stage_seconds, 4)]
+                       for stage, (calls, stage_seconds) in sorted((timers or {}).items())}}
+
+
+# Stages ##############################################################################################################
+
+def benchmark_header_scan(folder_path: str, backend: str = None):
+    """ Measures the mapping of the files to stations, which only reads the xml headers
+    (see xml2dict.create_mapping_filename2station). """
+    folder = xml2dict.list_xml_payloads(folder_path)
+    num_bytes = sum(os.path.getsize(folder_path + file) for file in folder)
+    seconds, timers = measured_call(xml2dict.create_mapping_filename2station, folder=folder, folder_path=folder_path,
+                                    multi_process=False)
+    return stage_result(len(folder), num_bytes, seconds, timers)
+
+
+def benchmark_compose(folder_path: str, backend: str = 'bs4'):
+    """ Measures the extraction of single files (see xml2dict.xml_extraction_complete_compose). """
+    files = [folder_path + file for file in sorted(xml2dict.list_xml_payloads(folder_path))]
+    num_bytes = sum(os.path.getsize(file) for file in files)
+
+    def compose_files():
+        for file in files:
+            xml2dict.xml_extraction_complete_compose(file, backend=backend)
+
+    seconds, timers = measured_call(compose_files)
+    return stage_result(len(files), num_bytes, seconds, timers)
+
+
+def benchmark_folder(folder_path: str, backend: str = 'bs4', multi_process: bool = False):
+    """ Measures the end-to-end extraction of the folder by station including the mapping, the merge of the work
+    units and the manifest (see xml2dict.xml_folder_to_pickled_extraction_dicts). """
+    shutil.rmtree(xml2dict.extraction_output_path(folder_path), ignore_errors=True)
+    if os.path.exists(folder_path + 'mapping_filename2station.pickle'):
+        os.remove(folder_path + 'mapping_filename2station.pickle')
+    files = xml2dict.list_xml_payloads(folder_path)
+    num_bytes = sum(os.path.getsize(folder_path + file) for file in files)
+    seconds, timers = measured_call(xml2dict.xml_folder_to_pickled_extraction_dicts,
+                                    input_folder_path=folder_path,
+                                    chunk_by='station',
+                                    multi_process=multi_process,
+                                    backend=backend)
+    return stage_result(len(files), num_bytes, seconds, timers)
+
+
+BENCHMARK_FUNCTIONS = {'header_scan': benchmark_header_scan,
+                       'compose': benchmark_compose,
+                       'folder': benchmark_folder}
+
+
+def measure_stage(stage: str, folder_path: str, backend: str):
+    """ Runs a stage in a new process, so the peak memory only belongs to this stage. """
+    with multiprocessing.get_context('spawn').Pool(processes=1) as pool:
+        return pool.apply(BENCHMARK_FUNCTIONS[stage], kwds=dict(folder_path=folder_path, backend=backend))
+
+
+# Runner ##############################################################################################################
+
+def run_benchmarks(scenarios: list = None, backends=('bs4', 'lxml'), stages=BENCHMARK_STAGES, work_path: str = None):
+    """ Generates the synthetic folders and measures every stage with every backend.
+
+    Params:
+        scenarios (list) - Names of the BENCHMARK_SCENARIOS to run (all if not given)
+        backends (tuple) - Extraction backends to compare (see xml2dict.EXTRACTION_BACKENDS)
+        stages (tuple) - Stages to measure (see BENCHMARK_FUNCTIONS), the header scan doesn't depend on the backend
+        work_path (str) - Folder for the synthetic data (temporary folder which is removed afterwards if not given)
+
+    Returns:
+        results (dict) - Key '<scenario>/<stage>/<backend>' with files, seconds, files_per_s, mb_per_s, peak_rss_mb
+            and the stage timers of the extraction
+    """
+    temporary_path = None
+    if work_path is None:
+        work_path = temporary_path = tempfile.mkdtemp(prefix='extraction_benchmark_')
+    results = {}
+    try:
+        for scenario in scenarios or list(BENCHMARK_SCENARIOS):
+            # The folder function writes to the output folder of the extraction (see xml2dict.extraction_output_path)
+            folder_path = os.path.join(work_path, 'raw', scenario) + os.sep
+            shutil.rmtree(folder_path, ignore_errors=True)
+            write_synthetic_folder(folder_path=folder_path, **BENCHMARK_SCENARIOS[scenario])
+            for stage in stages:
+                for backend in (backends if stage != 'header_scan' else ('-',)):
+                    results['%s/%s/%s' % (scenario, stage, backend)] = measure_stage(stage, folder_path, backend)
+    finally:
+        if temporary_path:
+            shutil.rmtree(temporary_path, ignore_errors=True)
+    return results
+
+
+def compare_to_baseline(results: dict, baseline: dict, tolerance: float = 0.3):
+    """ Prints the results next to the baseline and returns the measurements whose throughput dropped by more than
+    the tolerance (share of the baseline) or whose peak memory grew by more than the tolerance. """
+    regressions = []
+    print("%-28s %10s %10s %10s %10s %8s" % ('benchmark', 'files/s', 'baseline', 'MB/s', 'peak MB', 'change'))
+    for key, result in results.items():
+        reference = baseline.get(key)
+        change = ''
+        if reference:
+            change = '%+.0f%%' % (100 * (result['files_per_s'] / reference['files_per_s'] - 1))
+            if result['files_per_s'] < reference['files_per_s'] * (1 - tolerance):
+                regressions.append(key)
+            elif result['peak_rss_mb'] and reference.get('peak_rss_mb') and \
+                    result['peak_rss_mb'] > reference['peak_rss_mb'] * (1 + tolerance):
+                regressions.append(key)
+        print("%-28s %10.1f %10s %10.2f %10s %8s" % (
+            key, result['files_per_s'], '%.1f' % reference['files_per_s'] if reference else '-', result['mb_per_s'],
+            '%.0f' % result['peak_rss_mb'] if result['peak_rss_mb'] else '-', change))
+    return regressions
+
+
+def load_baseline(baseline_path: str = BASELINE_PATH):
+    """ Loads the committed baseline results ({} if there are none). """
+    try:
+        with open(baseline_path) as baseline_file:
+            return json.load(baseline_file)['results']
+    except FileNotFoundError:
+        return {}
+
+
+def save_baseline(results: dict, baseline_path: str = BASELINE_PATH):
+    """ Saves the results as new baseline including a description of the scenarios they were measured on. """
+    with open(baseline_path, 'w') as baseline_file:
+        json.dump({'scenarios': BENCHMARK_SCENARIOS, 'cpu_count': multiprocessing.cpu_count(), 'results': results},
+                  baseline_file, indent=1, sort_keys=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark of the xml extraction on synthetic payloads.")
+    parser.add_argument('--scenario', action='append', choices=list(BENCHMARK_SCENARIOS),
+                        help="Scenario to run (repeatable, default all)")
+    parser.add_argument('--backend', action='append', choices=list(xml2dict.EXTRACTION_BACKENDS),
+                        help="Backend to run (repeatable, default all)")
+    parser.add_argument('--tolerance', type=float, default=0.3, help="Allowed relative slowdown against the baseline")
+    parser.add_argument('--update-baseline', action='store_true', help="Save the results as new baseline")
+    arguments = parser.parse_args()
+
+    benchmark_results = run_benchmarks(scenarios=arguments.scenario,
+                                       backends=tuple(arguments.backend or xml2dict.EXTRACTION_BACKENDS))
+    regressed = compare_to_baseline(results=benchmark_results, baseline=load_baseline(), tolerance=arguments.tolerance)
+    if arguments.update_baseline:
+        save_baseline(results=benchmark_results)
+        print("--- Saved new baseline to %s.---" % BASELINE_PATH)
+    elif regressed:
+        print("--- Regressions against the baseline: %s ---" % ', '.join(regressed))
+        raise SystemExit(1)
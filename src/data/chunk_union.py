@@ -0,0 +1,258 @@
+import json
+import os
+import pickle
+
+import numpy as np
+import pandas as pd
+
+from compact_records import compact_columns, decode_column, is_compact_records, load_schema_registry
+from extraction_manifest import save_json
+from extraction_parquet import coerce_column, extraction_column_type
+from feature_store import commit_partition, missing_value, open_partition_writer
+from version_flattening import POST_MC_SUFFIX
+
+
+# Chunk Columns #######################################################################################################
+
+# Every chunk pickle gets a small sidecar '<chunk>.columns.json' with its number of rows and the non-null count of
+# each key (in order of their first occurrence), so the union of the columns of a folder is known without loading
+# any chunk. A sidecar is only used as long as the signature of its chunk matches.
+CHUNK_COLUMNS_SUFFIX = '.columns.json'
+# Dtype of the combined columns by their type (see union_column_type), strings are stored as category codes
+UNION_DTYPES = {'float': ('numeric', np.float64),
+                'flag': ('numeric', np.float32),
+                'datetime': ('datetime', np.int64),
+                'string': ('category', np.int32)}
+
+
+def chunk_file_paths(output_path: str):
+    """ Lists the chunk pickles of an extraction output folder (the work units and parquet files are in subfolders).
+    """
+    return [output_path + file_name for file_name in sorted(os.listdir(output_path))
+            if file_name.endswith('.pickle') and os.path.isfile(output_path + file_name)]
+
+
+def chunk_signature(file_path: str):
+    """ Returns size and modification time of a file, which change whenever it is written again. """
+    stat = os.stat(file_path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def chunk_column_counts(chunk, registry: dict = None):
+    """ Counts the non-null values of each key of a loaded chunk pickle.
+
+    Params:
+        chunk (dict) - Dictionary of extraction dictionaries or compact chunk (decoded with the schema registry)
+        registry (dict) - Schema registry of the folder (only used for compact chunks)
+
+    Returns:
+        num_rows (int), column_counts (list) - Number of records and pairs of key and non-null count
+    """
+    if is_compact_records(chunk):
+        num_rows = len(chunk['file_ids'])
+        column_counts = []
+        for column, encoded_column in zip(compact_columns(chunk, registry), chunk['columns']):
+            non_null = int(np.unpackbits(encoded_column['present'], count=num_rows).sum())
+            if encoded_column['encoding'] == 'category' and None in encoded_column['categories']:
+                non_null -= int((encoded_column['data'] == encoded_column['categories'].index(None)).sum())
+            column_counts.append((column, non_null))
+        return num_rows, column_counts
+    counts = {}
+    for station_data in chunk.values():
+        for key, value in station_data.items():
+            counts[key] = counts.get(key, 0) + (value is not None)
+    return len(chunk), list(counts.items())
+
+
+def save_chunk_columns(folder_path: str, chunk_name: str, chunk, registry: dict = None):
+    """ Saves the sidecar of a chunk pickle which was just saved (see CHUNK_COLUMNS_SUFFIX). """
+    num_rows, column_counts = chunk_column_counts(chunk, registry=registry)
+    save_json(folder_path=folder_path,
+              file_name=chunk_name + CHUNK_COLUMNS_SUFFIX,
+              save_object={'signature': chunk_signature(folder_path + chunk_name + '.pickle'),
+                           'rows': num_rows,
+                           'columns': column_counts})
+
+
+def load_chunk_columns(file_path: str):
+    """ Returns the number of rows and the column counts of a chunk pickle from its sidecar. Chunks without a valid
+    sidecar (e.g. written before sidecars existed) are loaded once and get one. """
+    folder_path, file_name = os.path.dirname(file_path) + os.sep, os.path.basename(file_path)
+    chunk_name = file_name[:-len('.pickle')]
+    try:
+        with open(folder_path + chunk_name + CHUNK_COLUMNS_SUFFIX) as sidecar_file:
+            sidecar = json.load(sidecar_file)
+        if sidecar['signature'] == chunk_signature(file_path):
+            return sidecar['rows'], [tuple(column_count) for column_count in sidecar['columns']]
+    except FileNotFoundError:
+        pass
+    with open(file_path, 'rb') as handle:
+        chunk = pickle.load(handle)
+    registry = load_schema_registry(folder_path) if is_compact_records(chunk) else None
+    save_chunk_columns(folder_path=folder_path, chunk_name=chunk_name, chunk=chunk, registry=registry)
+    return chunk_column_counts(chunk, registry=registry)
+
+
+# Phase 1: Column Union ###############################################################################################
+
+def collect_column_union(output_path: str):
+    """ Collects the union of the columns of all chunk pickles of an output folder from their sidecars.
+
+    Returns:
+        union (dict) - Chunks with their number of rows, total number of rows and the non-null count of each column
+            in order of its first occurrence (like the columns of pd.concat)
+    """
+    union = {'chunks': [], 'rows': 0, 'columns': {}}
+    for file_path in chunk_file_paths(output_path):
+        num_rows, column_counts = load_chunk_columns(file_path)
+        union['chunks'].append((file_path, num_rows))
+        union['rows'] += num_rows
+        for column, non_null in column_counts:
+            union['columns'][column] = union['columns'].get(column, 0) + non_null
+    return union
+
+
+def column_sparsity(union: dict):
+    """ Returns the non-null count and fill ratio of every column of the union, sparsest first, and prints how many
+    columns are empty (never materialized by combine_chunks). """
+    sparsity = pd.DataFrame({'column': list(union['columns']), 'non_null': list(union['columns'].values())})
+    sparsity['fill_ratio'] = sparsity['non_null'] / max(union['rows'], 1)
+    sparsity = sparsity.sort_values(['fill_ratio', 'column']).reset_index(drop=True)
+    print("--- %d of %d columns are empty, %d are filled in less than 1%% of %d rows.---" % (
+        (sparsity['non_null'] == 0).sum(), len(sparsity), (sparsity['fill_ratio'] < 0.01).sum(), union['rows']))
+    return sparsity
+
+
+# Phase 2: Combination ################################################################################################
+
+def union_column_type(column: str):
+    """ Returns the type of a column (see extraction_parquet.extraction_column_type), the keys of the latest
+    correction in flat records ('_post_mc') have the type of their original key. """
+    if column.endswith(POST_MC_SUFFIX):
+        column = column[:-len(POST_MC_SUFFIX)]
+    return extraction_column_type(column)
+
+
+def iter_chunk_columns(chunk, registry: dict, column_types: dict):
+    """ Generator of the values of the selected columns of a loaded chunk pickle.
+
+    Params:
+        chunk (dict) - Dictionary of extraction dictionaries or compact chunk
+        registry (dict) - Schema registry of the folder (only used for compact chunks)
+        column_types (dict) - Selected columns with their type (see union_column_type)
+
+    Yields:
+        column (str), rows (np.ndarray), values (list/np.ndarray) - Positions of the records containing the column
+            and their values (the numbers of numeric compact columns without decoding them to strings)
+    """
+    if is_compact_records(chunk):
+        num_records = len(chunk['file_ids'])
+        for column, encoded_column in zip(compact_columns(chunk, registry), chunk['columns']):
+            if column not in column_types:
+                continue
+            if encoded_column['encoding'] in ('integer', 'decimal') and column_types[column] in ('float', 'flag'):
+                present = np.unpackbits(encoded_column['present'], count=num_records).astype(bool)
+                yield column, np.flatnonzero(present), encoded_column['data']
+            else:
+                values, present = decode_column(column=encoded_column, num_records=num_records)
+                yield column, np.flatnonzero(present), values
+        return
+    column_rows = {}
+    column_values = {}
+    for row, station_data in enumerate(chunk.values()):
+        for key, value in station_data.items():
+            if value is not None and key in column_types:
+                if key not in column_rows:
+                    column_rows[key], column_values[key] = [], []
+                column_rows[key].append(row)
+                column_values[key].append(value)
+    for column, rows in column_rows.items():
+        yield column, np.array(rows, dtype=np.int64), column_values[column]
+
+
+def write_column_values(array: np.ndarray, column: str, column_type: str, rows: np.ndarray, values,
+                        categories: dict = None):
+    """ Converts the values of a column into the dtype of its type and writes them into the rows of the array (values
+    which can't be converted are counted, see extraction_parquet.coerce_column). Strings are written as codes of the
+    categories, which are extended by new values. """
+    if column_type in ('float', 'flag'):
+        numbers = coerce_column(pd.Series(values, dtype=None if isinstance(values, np.ndarray) else object),
+                                column=column, column_type=column_type)
+        array[rows] = numbers.to_numpy(dtype=array.dtype, na_value=np.nan)
+    elif column_type == 'datetime':
+        times = coerce_column(pd.Series(values, dtype=object), column=column, column_type=column_type)
+        array[rows] = times.to_numpy(dtype='datetime64[ns]').view(np.int64)
+    else:
+        array[rows] = [-1 if value is None else categories.setdefault(value, len(categories)) for value in values]
+
+
+def combine_chunks(output_path: str, columns: list = None, drop_empty: bool = True, store_path: str = None,
+                   partition: str = None):
+    """ Combines the chunk pickles of an output folder (any format) into one typed table without pd.concat.
+
+    Phase 1 collects the union of the columns and the number of rows from the chunk sidecars (see
+    collect_column_union), so all columns are preallocated with their final size and dtype: floats for values,
+    float32 for QA flags, datetimes and category codes for strings (see UNION_DTYPES). Phase 2 loads one chunk after
+    the other and writes the values of each column directly into its rows, so the peak memory is the output plus a
+    single chunk. Empty columns (dropped by dropna(how='all', axis=1) in the notebooks) are not allocated at all.
+
+    Params:
+        output_path (str) - Output folder of the extraction
+        columns (list) - Columns to combine (all if None)
+        drop_empty (bool) - Indicator if columns without any value are left out
+        store_path (str) - Feature store the table is written to as memory mapped partition instead of memory
+        partition (str) - Name of the partition in the feature store
+
+    Returns:
+        df (pd.DataFrame) - Combined table with the unique file id as index (the header of the feature store if a
+            store_path is given)
+    """
+    union = collect_column_union(output_path)
+    selected = [column for column, non_null in union['columns'].items()
+                if (non_null or not drop_empty) and (columns is None or column in columns)]
+    column_types = {column: union_column_type(column) for column in selected}
+    column_dtypes = {column: UNION_DTYPES[column_type] for column, column_type in column_types.items()}
+    if store_path is not None:
+        assert partition is not None, "The partition of the feature store has to be given."
+        writer = open_partition_writer(store_path=store_path, partition=partition, num_rows=union['rows'],
+                                       column_dtypes=column_dtypes)
+        arrays = writer['arrays']
+    else:
+        arrays = {column: np.full(union['rows'], missing_value(kind, dtype), dtype=dtype)
+                  for column, (kind, dtype) in column_dtypes.items()}
+    categories = {column: {} for column, column_type in column_types.items() if column_type == 'string'}
+
+    registry = None
+    index = []
+    offset = 0
+    for file_path, num_rows in union['chunks']:
+        with open(file_path, 'rb') as handle:
+            chunk = pickle.load(handle)
+        if is_compact_records(chunk):
+            registry = load_schema_registry(os.path.dirname(file_path) + os.sep)
+            index.extend(chunk['file_ids'])
+        else:
+            index.extend(chunk)
+        for column, rows, values in iter_chunk_columns(chunk, registry=registry, column_types=column_types):
+            write_column_values(array=arrays[column], column=column, column_type=column_types[column],
+                                rows=offset + rows, values=values, categories=categories.get(column))
+        offset += num_rows
+        del chunk
+
+    if store_path is not None:
+        for column, column_type in column_types.items():
+            if column_type == 'string':
+                writer['extras'][column] = {'categories': [str(value) for value in categories[column]]}
+            elif column_type == 'datetime':
+                writer['extras'][column] = {'tz': 'UTC'}
+        return commit_partition(writer=writer, index=index)
+
+    data = {}
+    for column, column_type in column_types.items():
+        if column_type == 'string':
+            data[column] = np.array(list(categories[column]) + [np.nan], dtype=object)[arrays[column]]
+        elif column_type == 'datetime':
+            data[column] = pd.DatetimeIndex(arrays[column].view('datetime64[ns]')).tz_localize('UTC')
+        else:
+            data[column] = arrays[column]
+    return pd.DataFrame(data, index=index, copy=False)
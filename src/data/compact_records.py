@@ -0,0 +1,239 @@
+import json
+import os
+import pickle
+
+import numpy as np
+import pandas as pd
+
+from extraction_manifest import save_json
+
+
+# Schema Registry #####################################################################################################
+
+# The registry assigns an id to every key of the extraction dictionaries (e.g. air_temperature_xxx_qa-range_12) which
+# is shared by all compact chunks of an output folder. Ids are only appended, so chunks written with an older version
+# of the registry can always be decoded with a newer one.
+SCHEMA_FILE_NAME = 'extraction_schema.json'
+COMPACT_FORMAT = 'compact-records-1'
+
+
+def load_schema_registry(folder_path: str):
+    """ Loads the schema registry of an output folder (an empty registry with version 0 if there is none). """
+    try:
+        with open(folder_path + SCHEMA_FILE_NAME) as schema_file:
+            registry = json.load(schema_file)
+    except FileNotFoundError:
+        registry = {'version': 0, 'columns': []}
+    registry['column_ids'] = {column: column_id for column_id, column in enumerate(registry['columns'])}
+    return registry
+
+
+def save_schema_registry(folder_path: str, registry: dict):
+    """ Atomically saves the schema registry (see load_schema_registry). """
+    save_json(folder_path=folder_path,
+              file_name=SCHEMA_FILE_NAME,
+              save_object={'version': registry['version'], 'columns': registry['columns']})
+
+
+def register_columns(registry: dict, columns: list):
+    """ Returns the ids of the columns and adds unknown columns to the registry, which increases its version.
+
+    Returns:
+        column_ids (list) - Id of each column
+        changed (bool) - Indicator if the registry was extended and needs to be saved
+    """
+    new_columns = [column for column in columns if column not in registry['column_ids']]
+    for column in new_columns:
+        registry['column_ids'][column] = len(registry['columns'])
+        registry['columns'].append(column)
+    if new_columns:
+        registry['version'] += 1
+    return [registry['column_ids'][column] for column in columns], bool(new_columns)
+
+
+# Column Encodings ####################################################################################################
+
+def smallest_dtype(minimum: int, maximum: int, dtypes=(np.int8, np.int16, np.int32, np.int64)):
+    """ Returns the smallest of the integer dtypes which can hold all values between minimum and maximum. """
+    for dtype in dtypes:
+        if np.iinfo(dtype).min <= minimum and maximum <= np.iinfo(dtype).max:
+            return dtype
+    return None
+
+
+def encode_integers(values: list):
+    """ Encodes strings of integers (e.g. the QA flags '100', '-10') if they can be restored exactly, otherwise
+    None. """
+    try:
+        integers = [int(value) for value in values]
+    except (TypeError, ValueError):
+        return None
+    if any(str(integer) != value for integer, value in zip(integers, values)):
+        return None
+    dtype = smallest_dtype(min(integers), max(integers))
+    if dtype is None:
+        return None
+    return {'encoding': 'integer', 'data': np.array(integers, dtype=dtype)}
+
+
+def encode_decimals(values: list):
+    """ Encodes strings of decimal numbers with the same number of decimals (e.g. '-5.1', '12.3') as floats if they
+    can be restored exactly, otherwise None. """
+    if not all(isinstance(value, str) and '.' in value for value in values):
+        return None
+    decimals = len(values[0].partition('.')[2])
+    try:
+        floats = [float(value) for value in values]
+    except ValueError:
+        return None
+    if any('%.*f' % (decimals, number) != value for number, value in zip(floats, values)):
+        return None
+    return {'encoding': 'decimal', 'decimals': decimals, 'data': np.array(floats, dtype=np.float64)}
+
+
+def encode_categories(values: list):
+    """ Encodes any values as codes of their distinct values (in order of their first occurrence). """
+    categories = {}
+    codes = [categories.setdefault(value, len(categories)) for value in values]
+    dtype = smallest_dtype(0, max(len(categories) - 1, 0), dtypes=(np.uint8, np.uint16, np.uint32, np.uint64))
+    return {'encoding': 'category', 'categories': list(categories), 'data': np.array(codes, dtype=dtype)}
+
+
+def encode_column(values: list, present: np.ndarray):
+    """ Encodes the values of a column as typed array with the smallest lossless encoding.
+
+    Params:
+        values (list) - Values of the records which contain the column
+        present (np.ndarray) - Boolean mask which records contain the column
+
+    Returns:
+        column (dict) - Encoding, data array of the present values and bitmap of the present records
+    """
+    column = encode_integers(values) or encode_decimals(values) or encode_categories(values)
+    column['present'] = np.packbits(present)
+    return column
+
+
+def decode_column(column: dict, num_records: int):
+    """ Restores the values of an encoded column.
+
+    Returns:
+        values (list) - Values of the records which contain the column
+        present (np.ndarray) - Boolean mask which records contain the column
+    """
+    present = np.unpackbits(column['present'], count=num_records).astype(bool)
+    if column['encoding'] == 'integer':
+        values = [str(integer) for integer in column['data'].tolist()]
+    elif column['encoding'] == 'decimal':
+        values = ['%.*f' % (column['decimals'], number) for number in column['data'].tolist()]
+    else:
+        categories = column['categories']
+        values = [categories[code] for code in column['data'].tolist()]
+    return values, present
+
+
+# Compact Chunks ######################################################################################################
+
+def is_compact_records(chunk) -> bool:
+    """ Checks if a loaded chunk pickle is in the compact format (instead of a dictionary of extraction dicts). """
+    return isinstance(chunk, dict) and chunk.get('format') == COMPACT_FORMAT
+
+
+def compact_records(records: dict, registry: dict):
+    """ Transforms the extraction dictionaries of a chunk into the compact format.
+
+    Every key is stored once per chunk as id of the schema registry instead of once per record, and the values of a
+    key are stored as typed array (see encode_column) with a bitmap of the records containing the key.
+
+    Params:
+        records (dict) - Dictionary with the unique file id as key and the extraction dictionary as value
+        registry (dict) - Schema registry which is extended by unknown keys (see load_schema_registry)
+
+    Returns:
+        compact (dict) - Compact chunk
+        changed (bool) - Indicator if the registry was extended and needs to be saved before the chunk
+    """
+    # Keys in order of their first occurrence, like the columns of pd.DataFrame.from_dict
+    columns = {}
+    for station_data in records.values():
+        for key in station_data:
+            columns.setdefault(key, None)
+    columns = list(columns)
+    column_ids, changed = register_columns(registry=registry, columns=columns)
+
+    record_list = list(records.values())
+    encoded_columns = []
+    for column in columns:
+        present = np.fromiter((column in station_data for station_data in record_list), dtype=bool,
+                              count=len(record_list))
+        values = [station_data[column] for station_data in record_list if column in station_data]
+        encoded_columns.append(encode_column(values=values, present=present))
+
+    compact = {'format': COMPACT_FORMAT,
+               'schema_version': registry['version'],
+               'file_ids': list(records),
+               'column_ids': np.array(column_ids, dtype=np.int32),
+               'columns': encoded_columns}
+    return compact, changed
+
+
+def compact_columns(compact: dict, registry: dict):
+    """ Returns the key names of a compact chunk. """
+    assert compact['schema_version'] <= registry['version'], \
+        "Compact chunk was written with schema version %d, but the registry only has version %d." % (
+            compact['schema_version'], registry['version'])
+    return [registry['columns'][column_id] for column_id in compact['column_ids'].tolist()]
+
+
+def compact_to_records(compact: dict, registry: dict):
+    """ Restores the dictionary of extraction dictionaries from a compact chunk (see compact_records). """
+    records = [{} for _ in compact['file_ids']]
+    for column, encoded_column in zip(compact_columns(compact, registry), compact['columns']):
+        values, present = decode_column(column=encoded_column, num_records=len(records))
+        for record_index, value in zip(np.flatnonzero(present).tolist(), values):
+            records[record_index][column] = value
+    return dict(zip(compact['file_ids'], records))
+
+
+def compact_to_dataframe(compact: dict, registry: dict, columns=None, rows: np.ndarray = None):
+    """ Creates the DataFrame of a compact chunk directly from its columns. The result equals
+    pd.DataFrame.from_dict(records, orient='index') of the restored records (missing values are NaN).
+
+    Params:
+        compact (dict) - Compact chunk (see compact_records)
+        registry (dict) - Schema registry the chunk was written with
+        columns (set/list) - Keys which are decoded (all if None), the others are never decoded
+        rows (np.ndarray) - Boolean mask of the records which are kept (all if None)
+    """
+    num_records = len(compact['file_ids'])
+    index = compact['file_ids']
+    if rows is not None:
+        index = [file_id for file_id, keep in zip(index, rows.tolist()) if keep]
+    data = {}
+    for column, encoded_column in zip(compact_columns(compact, registry), compact['columns']):
+        if columns is not None and column not in columns:
+            continue
+        values, present = decode_column(column=encoded_column, num_records=num_records)
+        column_values = np.full(num_records, np.nan, dtype=object)
+        column_values[present] = values
+        data[column] = column_values if rows is None else column_values[rows]
+    return pd.DataFrame(data, index=index)
+
+
+def read_records_pickle(file_path: str):
+    """ Loads a chunk pickle as dictionary of extraction dictionaries, independent of it being compact or not.
+    The schema registry of a compact chunk is expected in the same folder. """
+    with open(file_path, 'rb') as handle:
+        chunk = pickle.load(handle)
+    if is_compact_records(chunk):
+        chunk = compact_to_records(chunk, load_schema_registry(os.path.dirname(file_path) + os.sep))
+    return chunk
+
+
+def read_records_dataframe(file_path: str):
+    """ Loads a chunk pickle as DataFrame with one row per file, independent of it being compact or not. """
+    with open(file_path, 'rb') as handle:
+        chunk = pickle.load(handle)
+    if is_compact_records(chunk):
+        return compact_to_dataframe(chunk, load_schema_registry(os.path.dirname(file_path) + os.sep))
+    return pd.DataFrame.from_dict(chunk, orient='index')
@@ -0,0 +1,442 @@
+import functools
+import pickle
+
+import numpy as np
+import pandas as pd
+
+from chunk_union import chunk_file_paths
+from compact_records import compact_columns, compact_to_dataframe, is_compact_records, load_schema_registry
+from extraction_metrics import count, stage_timer
+from extraction_parquet import parquet_dataset
+from feature_store import load_feature_store, read_partition, store_columns
+from online_scoring import NATIVE_CODES, STATION_PREFIX, is_station_dummy
+from version_flattening import POST_MC_SUFFIX
+from xml2dict import PARQUET_FOLDER_NAME
+
+
+# Column Projection ###################################################################################################
+
+# Keys of the flat records which are not available at prediction time or belong to sensors without meaning
+# (qa_failed_to_ml_input in Train_and_test)
+EXCLUDED_FEATURE_WORDS = ('post_mc', 'orig-value', 'override', 'dummy', 'deactivated')
+# Keys of the sensors which are converted to features (convert_datatypes in Train_and_test), all others are metadata
+FEATURE_WORDS = ('_qa', '_value', '-derived', 'native')
+FEATURE_METADATA_COLUMNS = ('tc_identifier', 'date_time', 'latitude', 'longitude', 'station_elevation')
+# Metadata which is only read for the features derived from it or for the row filter
+NON_FEATURE_COLUMNS = ('tc_identifier', 'date_time', 'version')
+DATASET_SOURCES = ('chunks', 'parquet')
+
+
+def target_label_columns(target_var: str):
+    """ Returns the keys of the flat records the target of a variable is created from (see target_labels). """
+    return [target_var + '_overall_qa_summary',
+            target_var + '_overall_qa_summary' + POST_MC_SUFFIX,
+            target_var + '_value_override' + POST_MC_SUFFIX]
+
+
+def target_column_selector(target_var: str, feature_prefixes: list = None,
+                           feature_words=FEATURE_WORDS, excluded_words=EXCLUDED_FEATURE_WORDS):
+    """ Returns the predicate which selects the columns read for the dataset of a target variable. It is decided once
+    per column name (cached), as the same keys are checked for every record of a chunk.
+
+    Params:
+        target_var (str) - Prefix of the target sensor (see xml2dict.observation_extract_prefix), e.g. snow_depth_3022
+        feature_prefixes (list) - Prefixes of the sensors used as features (all sensors if None)
+        feature_words (tuple) - Words of which a feature key contains at least one
+        excluded_words (tuple) - Words of which a feature key contains none
+
+    Returns:
+        select_column (function) - Indicator if a column is read
+    """
+    required_columns = set(target_label_columns(target_var)) | set(FEATURE_METADATA_COLUMNS)
+    prefixes = None if feature_prefixes is None else tuple(prefix + '_' for prefix in feature_prefixes)
+
+    @functools.lru_cache(maxsize=None)
+    def select_column(column: str):
+        if column in required_columns:
+            return True
+        if any(word in column for word in excluded_words):
+            return False
+        if prefixes is not None and not column.startswith(prefixes):
+            return False
+        return any(word in column for word in feature_words)
+    return select_column
+
+
+# Row Filter ##########################################################################################################
+
+def flag_values(df, column: str):
+    """ Returns the QA flags of a column as numbers, independent of them being strings (pickle) or integers (parquet),
+    and NaN if the column is missing. """
+    if column not in df:
+        return pd.Series(np.nan, index=df.index)
+    return pd.to_numeric(df[column], errors='coerce')
+
+
+def row_filter_columns(target_var: str, only_qa_failed: bool = True, versions: list = None):
+    """ Returns the keys which are read before all others to decide which rows are kept (see target_row_mask). """
+    return ([target_var + '_overall_qa_summary'] if only_qa_failed else []) + (['version'] if versions else [])
+
+
+def target_row_mask(df, target_var: str, only_qa_failed: bool = True, versions: list = None):
+    """ Returns the boolean mask of the rows kept for the dataset of a target variable.
+
+    Params:
+        df (pd.DataFrame) - Records with at least the columns of row_filter_columns
+        target_var (str) - Prefix of the target sensor
+        only_qa_failed (bool) - Indicator if only rows whose automatic QA of the target failed (overall_qa_summary not
+            null and not 100) are kept, like qa_failed_to_ml_input
+        versions (list) - Versions of the rows which are kept (all if None)
+    """
+    mask = np.ones(len(df), dtype=bool)
+    if only_qa_failed:
+        flags = flag_values(df, target_var + '_overall_qa_summary')
+        mask &= (flags.notna() & (flags != 100)).to_numpy()
+    if versions:
+        if 'version' not in df:
+            return np.zeros(len(df), dtype=bool)
+        mask &= df['version'].astype(str).isin([str(version) for version in versions]).to_numpy()
+    return mask
+
+
+def parquet_row_filter(target_var: str, schema_names: list, only_qa_failed: bool = True, versions: list = None):
+    """ Returns the row filter of target_row_mask as pyarrow expression, which is pushed down to the parquet files
+    (None if all rows are kept, False if no row can match). """
+    import pyarrow.dataset as ds
+
+    expression = None
+    if only_qa_failed:
+        overall_column = target_var + '_overall_qa_summary'
+        if overall_column not in schema_names:
+            return False
+        expression = ds.field(overall_column).is_valid() & (ds.field(overall_column) != 100)
+    if versions:
+        if 'version' not in schema_names:
+            return False
+        version_expression = ds.field('version').isin([str(version) for version in versions])
+        expression = version_expression if expression is None else expression & version_expression
+    return expression
+
+
+# Streamed Reads ######################################################################################################
+
+def iter_chunk_frames(output_path: str, select_column, filter_columns: list, row_mask):
+    """ Generator which reads the chunk pickles one after the other and yields the kept rows of each chunk with only
+    the selected columns.
+
+    The rows are decided on the filter columns before any other column is touched. Compact chunks only decode the
+    filter columns and the selected columns of the kept rows, for chunks of extraction dictionaries only the selected
+    keys of the kept records are copied into the DataFrame before the chunk is released.
+
+    Params:
+        output_path (str) - Output folder of the extraction
+        select_column (function) - Indicator if a column is read (see target_column_selector)
+        filter_columns (list) - Columns the row mask is computed from (always read)
+        row_mask (function) - Returns the boolean mask of the kept rows of a DataFrame of the filter columns
+
+    Yields:
+        df (pd.DataFrame) - Kept rows with the unique file id (station time identifier for flat chunks) as index
+    """
+    registry = None
+    for file_path in chunk_file_paths(output_path):
+        with stage_timer('dataset_read'):
+            with open(file_path, 'rb') as handle:
+                chunk = pickle.load(handle)
+            if is_compact_records(chunk):
+                if registry is None or chunk['schema_version'] > registry['version']:
+                    registry = load_schema_registry(output_path)
+                rows = row_mask(compact_to_dataframe(chunk, registry, columns=set(filter_columns)))
+                columns = {column for column in compact_columns(chunk, registry)
+                           if select_column(column) or column in filter_columns}
+                df = compact_to_dataframe(chunk, registry, columns=columns, rows=rows) if rows.any() else None
+            else:
+                records = list(chunk.values())
+                filter_df = pd.DataFrame({column: [station_data.get(column) for station_data in records]
+                                          for column in filter_columns}, index=list(chunk))
+                rows = row_mask(filter_df)
+                df = None
+                if rows.any():
+                    kept_records = {file_id: {key: value for key, value in station_data.items()
+                                              if select_column(key) or key in filter_columns}
+                                    for (file_id, station_data), keep in zip(chunk.items(), rows.tolist()) if keep}
+                    df = pd.DataFrame.from_dict(kept_records, orient='index')
+            count('dataset.rows_scanned', len(rows))
+            del chunk
+        if df is not None:
+            yield df
+
+
+def iter_parquet_frames(parquet_root: str, select_column, filter_columns: list, row_filter, batch_size: int = 10000):
+    """ Generator which streams the parquet dataset in record batches with only the selected columns, while the row
+    filter is pushed down to the files (row groups whose statistics exclude the filter are skipped).
+
+    Params:
+        parquet_root (str) - Root folder of the parquet dataset
+        select_column (function) - Indicator if a column is read (see target_column_selector)
+        filter_columns (list) - Columns the row filter refers to (always read)
+        row_filter (function) - Returns the pyarrow expression of the row filter from the names of the unified schema
+        batch_size (int) - Maximum number of rows per batch
+
+    Yields:
+        df (pd.DataFrame) - Rows of a batch with the unique file id as index
+    """
+    dataset = parquet_dataset(parquet_root)
+    columns = [name for name in dataset.schema.names if select_column(name) or name in filter_columns]
+    expression = row_filter(dataset.schema.names)
+    if expression is False:
+        return
+    batches = iter(dataset.to_batches(columns=['file_id'] + columns, filter=expression, batch_size=batch_size))
+    while True:
+        with stage_timer('dataset_read'):
+            batch = next(batches, None)
+            if batch is None:
+                return
+            df = batch.to_pandas().set_index('file_id') if batch.num_rows else None
+        if df is not None:
+            yield df
+
+
+# Typed Features ######################################################################################################
+
+def target_labels(df, target_var: str):
+    """ Creates the target of a variable like create_target_variable (without the false positive/negative columns):
+
+    1. Either (qa flag value was 100 and changed not to null) Or (was unequal 100 and changed to 100) (target=1)
+    2. Reason that flag value after MC is 100 is not wrong qa flag but retest after value_override (target=0)
+    3. Both flag values are 100 but this is caused by rerun of test after value_override (target=1)
+    """
+    overall_column, post_mc_column, override_column = target_label_columns(target_var)
+    was_100 = flag_values(df, overall_column) == 100
+    post_mc = flag_values(df, post_mc_column)
+    is_100 = post_mc == 100
+    target = (was_100 & post_mc.notna()) != is_100
+    if override_column in df:
+        overridden = df[override_column].notna()
+        target[~was_100 & is_100 & overridden] = False
+        target[was_100 & is_100 & overridden] = True
+    return target.astype(np.int8).rename(target_var + '_target')
+
+
+def feature_batch_columns(df):
+    """ Returns the columns typed_feature_batch creates from the read rows of a batch in the same order, without
+    converting any value. """
+    columns = []
+    if 'tc_identifier' in df:
+        stations = df['tc_identifier'].drop_duplicates()
+        columns.extend(pd.get_dummies(stations, prefix=STATION_PREFIX[:-1]).columns)
+    columns.extend(column for column in df.columns
+                   if column not in NON_FEATURE_COLUMNS and not any(word in column for word in EXCLUDED_FEATURE_WORDS))
+    if 'date_time' in df:
+        columns.append('hour_of_day')
+    return columns
+
+
+def typed_feature_batch(df, target_var: str, float_dtype=np.float32):
+    """ Converts the read rows of a batch into the typed features and the target (convert_datatypes and the hour of
+    the day of Train_and_test). All features are floats: measured, derived and QA values (unparsable ones are NaN),
+    native codes as 0/1, station dummies and the hour of the day. float32 is the input type of the sklearn trees.
+
+    Returns:
+        X (pd.DataFrame) - Features of the batch
+        y (pd.Series) - Target of the batch (see target_labels)
+    """
+    with stage_timer('dataset_typing'):
+        y = target_labels(df, target_var)
+        features = {}
+        if 'tc_identifier' in df:
+            dummies = pd.get_dummies(df['tc_identifier'], prefix=STATION_PREFIX[:-1], dtype=float_dtype)
+            features.update(dummies.items())
+        for column in df.columns:
+            if column in NON_FEATURE_COLUMNS or any(word in column for word in EXCLUDED_FEATURE_WORDS):
+                continue
+            values = df[column].map(NATIVE_CODES) if 'native' in column else df[column]
+            features[column] = pd.to_numeric(values, errors='coerce').astype(float_dtype)
+        if 'date_time' in df:
+            features['hour_of_day'] = pd.to_datetime(df['date_time'], errors='coerce', utc=True).dt.hour.astype(
+                float_dtype)
+        X = pd.DataFrame(features, index=df.index)
+    count('dataset.rows', len(X))
+    return X, y
+
+
+def iter_target_frames(output_path: str,
+                       target_var: str,
+                       feature_prefixes: list = None,
+                       only_qa_failed: bool = True,
+                       versions: list = None,
+                       source: str = 'chunks',
+                       batch_size: int = 10000):
+    """ Returns the generator of the read rows of a target variable (see iter_target_batches) before they are typed.
+
+    Yields:
+        df (pd.DataFrame) - Kept rows of a batch with the selected columns and the unique file id as index
+    """
+    assert source in DATASET_SOURCES, "Dataset source has to be one of %s." % (DATASET_SOURCES,)
+    select_column = target_column_selector(target_var=target_var, feature_prefixes=feature_prefixes)
+    filter_columns = row_filter_columns(target_var=target_var, only_qa_failed=only_qa_failed, versions=versions)
+    if source == 'parquet':
+        return iter_parquet_frames(parquet_root=output_path + PARQUET_FOLDER_NAME,
+                                   select_column=select_column,
+                                   filter_columns=filter_columns,
+                                   row_filter=functools.partial(parquet_row_filter,
+                                                                target_var,
+                                                                only_qa_failed=only_qa_failed,
+                                                                versions=versions),
+                                   batch_size=batch_size)
+    return iter_chunk_frames(output_path=output_path,
+                             select_column=select_column,
+                             filter_columns=filter_columns,
+                             row_mask=functools.partial(target_row_mask,
+                                                        target_var=target_var,
+                                                        only_qa_failed=only_qa_failed,
+                                                        versions=versions))
+
+
+def iter_target_batches(output_path: str,
+                        target_var: str,
+                        feature_prefixes: list = None,
+                        only_qa_failed: bool = True,
+                        versions: list = None,
+                        source: str = 'chunks',
+                        batch_size: int = 10000,
+                        float_dtype=np.float32):
+    """ Generator which streams the typed feature batches of a target variable from the extraction output.
+
+    Only the columns of the target and the selected features are read and the rows are filtered while reading, so the
+    memory scales with the selected data instead of the whole extraction. The target needs the latest corrections,
+    therefore the output has to contain flat records (output_format "flat" or flat records written to parquet).
+
+    Params:
+        output_path (str) - Output folder of the extraction
+        target_var (str) - Prefix of the target sensor (see xml2dict.observation_extract_prefix), e.g. snow_depth_3022
+        feature_prefixes (list) - Prefixes of the sensors used as features (all sensors if None)
+        only_qa_failed (bool) - Indicator if only rows whose automatic QA of the target failed are kept
+        versions (list) - Versions of the rows which are kept (all if None)
+        source ("chunks"/"parquet") - Chunk pickles of the folder (any format) or its parquet dataset
+        batch_size (int) - Maximum number of rows per parquet batch (chunks are read as one batch each)
+        float_dtype (np.dtype) - Type of the features
+
+    Yields:
+        X (pd.DataFrame), y (pd.Series) - Features and target of a batch (see typed_feature_batch)
+    """
+    frames = iter_target_frames(output_path=output_path,
+                                target_var=target_var,
+                                feature_prefixes=feature_prefixes,
+                                only_qa_failed=only_qa_failed,
+                                versions=versions,
+                                source=source,
+                                batch_size=batch_size)
+    for df in frames:
+        yield typed_feature_batch(df=df, target_var=target_var, float_dtype=float_dtype)
+
+
+def build_target_dataset(output_path: str,
+                         target_var: str,
+                         feature_prefixes: list = None,
+                         only_qa_failed: bool = True,
+                         versions: list = None,
+                         source: str = 'chunks',
+                         batch_size: int = 10000,
+                         float_dtype=np.float32,
+                         drop_incomplete_columns: bool = True):
+    """ Builds the training data of a target variable from the streamed batches (replaces qa_failed_to_ml_input,
+    convert_datatypes and the preparation of X and y in Train_and_test).
+
+    The output is read twice and never held as a whole: the first pass only counts the kept rows and collects the
+    union of the feature columns (see feature_batch_columns), the second one types each batch and copies it into the
+    preallocated matrix, so the peak memory is the dataset and a single batch. Missing station dummies are 0, other
+    missing features NaN. Empty columns are dropped and, like the notebook, all columns with any missing value if
+    drop_incomplete_columns.
+
+    Params:
+        see iter_target_batches
+        drop_incomplete_columns (bool) - Indicator if only complete columns are kept
+
+    Returns:
+        X (pd.DataFrame) - Features with the unique file id as index
+        y (pd.Series) - Target named <target_var>_target
+    """
+    read_kwargs = dict(output_path=output_path, target_var=target_var, feature_prefixes=feature_prefixes,
+                       only_qa_failed=only_qa_failed, versions=versions, source=source, batch_size=batch_size)
+    columns = {}
+    num_rows = 0
+    for df in iter_target_frames(**read_kwargs):
+        columns.update(dict.fromkeys(feature_batch_columns(df)))
+        num_rows += len(df)
+    columns = list(columns)
+    positions = {column: position for position, column in enumerate(columns)}
+    matrix = np.full((num_rows, len(columns)), np.nan, dtype=float_dtype)
+    target = np.zeros(num_rows, dtype=np.int8)
+    index = []
+    row = 0
+    for X_batch, y_batch in iter_target_batches(float_dtype=float_dtype, **read_kwargs):
+        assert row + len(X_batch) <= num_rows, "The extraction output %s changed while the dataset was built." % (
+            output_path)
+        batch_positions = [positions[column] for column in X_batch.columns]
+        matrix[row:row + len(X_batch), batch_positions] = X_batch.to_numpy(dtype=float_dtype)
+        target[row:row + len(X_batch)] = y_batch.to_numpy()
+        row += len(X_batch)
+        index.extend(X_batch.index)
+    assert row == num_rows, "The extraction output %s changed while the dataset was built." % output_path
+    X = pd.DataFrame(matrix, index=index, columns=columns, copy=False)
+    return complete_target_dataset(X=X, target=target, target_var=target_var,
+                                   drop_incomplete_columns=drop_incomplete_columns)
+
+
+def complete_target_dataset(X, target: np.ndarray, target_var: str, drop_incomplete_columns: bool = True):
+    """ Fills the missing station dummies of the typed features with 0 and drops the empty columns (and, like the
+    notebook, all columns with any missing value if drop_incomplete_columns).
+
+    Returns:
+        X (pd.DataFrame), y (pd.Series) - Features and target named <target_var>_target
+    """
+    num_columns = X.shape[1]
+    station_columns = [column for column in X.columns if is_station_dummy(column)]
+    X[station_columns] = X[station_columns].fillna(0)
+    X = X.dropna(how='all', axis=1)
+    if drop_incomplete_columns:
+        X = X.dropna(how='any', axis=1)
+    y = pd.Series(target, index=X.index, name=target_var + '_target')
+    print("--- Dataset of %s: %d rows and %d features (%d columns read).---" % (
+        target_var, len(X), X.shape[1], num_columns))
+    return X, y
+
+
+def build_store_target_dataset(store_path: str,
+                               partition: str,
+                               target_var: str,
+                               feature_prefixes: list = None,
+                               only_qa_failed: bool = True,
+                               versions: list = None,
+                               float_dtype=np.float32,
+                               drop_incomplete_columns: bool = True):
+    """ Builds the training data of a target variable (see build_target_dataset) from the combined columns of the
+    extraction in a feature store partition (see chunk_union.combine_chunks) instead of the chunk pickles, so the
+    datasets of several targets share one read of the extraction output.
+
+    The rows are decided on the memory mapped filter columns first, then only the kept rows of the selected columns
+    are copied out of the store and typed.
+
+    Params:
+        store_path (str) - Folder of the feature store with the combined columns
+        partition (str) - Partition of the combined columns
+        see build_target_dataset for the others
+
+    Returns:
+        X (pd.DataFrame) - Features with the unique file id as index
+        y (pd.Series) - Target named <target_var>_target
+    """
+    header = load_feature_store(store_path)
+    select_column = target_column_selector(target_var=target_var, feature_prefixes=feature_prefixes)
+    filter_columns = row_filter_columns(target_var=target_var, only_qa_failed=only_qa_failed, versions=versions)
+    with stage_timer('dataset_read'):
+        filter_df = read_partition(store_path=store_path, partition=partition, columns=filter_columns, header=header)
+        rows = np.flatnonzero(target_row_mask(filter_df, target_var=target_var, only_qa_failed=only_qa_failed,
+                                              versions=versions))
+        columns = [column for column in store_columns(header, partition)
+                   if select_column(column) or column in filter_columns]
+        df = read_partition(store_path=store_path, partition=partition, columns=columns, header=header, rows=rows)
+    count('dataset.rows_scanned', len(filter_df))
+    X, y = typed_feature_batch(df=df, target_var=target_var, float_dtype=float_dtype)
+    return complete_target_dataset(X=X, target=y.to_numpy(), target_var=target_var,
+                                   drop_incomplete_columns=drop_incomplete_columns)
@@ -0,0 +1,208 @@
+import hashlib
+import json
+import os
+
+
+# Manifest Files ######################################################################################################
+
+MANIFEST_FILE_NAME = 'extraction_manifest.json'
+# Journals are written by each chunk as soon as it is saved, so an interrupted run can be resumed
+JOURNAL_PREFIX = 'extraction_manifest.'
+JOURNAL_SUFFIX = '.journal.json'
+
+
+def save_json(folder_path: str, file_name: str, save_object):
+    """ Helper function to atomically save an object to a json file (written to a temporary file and renamed). """
+    temporary_path = folder_path + file_name + '.tmp'
+    with open(temporary_path, 'w') as handle:
+        json.dump(save_object, handle, indent=1, sort_keys=True)
+    os.replace(temporary_path, folder_path + file_name)
+
+
+def journal_file_name(chunk_name: str):
+    """ Returns the file name of the manifest journal written for a single chunk. """
+    return JOURNAL_PREFIX + chunk_name + JOURNAL_SUFFIX
+
+
+def list_journal_files(output_path: str):
+    """ Lists all manifest journals in the output folder which are not yet merged into the manifest. """
+    if not os.path.exists(output_path):
+        return []
+    return [file for file in os.listdir(output_path)
+            if file.startswith(JOURNAL_PREFIX) and file.endswith(JOURNAL_SUFFIX)]
+
+
+def load_extraction_manifest(output_path: str):
+    """ Loads the manifest of all extracted xml files of an output folder including the journals of chunks finished
+    by an interrupted run.
+
+    Params:
+        output_path (str) - Folder containing the extracted chunk pickles
+
+    Returns:
+        manifest (dict) - Dictionary with the xml file name as key and its manifest entry (see file_manifest_entry)
+    """
+    manifest = {}
+    try:
+        with open(output_path + MANIFEST_FILE_NAME) as manifest_file:
+            manifest = json.load(manifest_file)['files']
+    except FileNotFoundError:
+        pass
+
+    journal_files = list_journal_files(output_path)
+    for journal_file in journal_files:
+        with open(output_path + journal_file) as journal:
+            manifest.update(json.load(journal))
+    if journal_files:
+        print("--- Resuming extraction: %d chunks of an interrupted run are already finished.---" % len(journal_files))
+    return manifest
+
+
+def save_extraction_manifest(output_path: str, manifest: dict):
+    """ Saves the manifest and removes all journals which are contained in it afterwards. """
+    save_json(folder_path=output_path, file_name=MANIFEST_FILE_NAME, save_object={'files': manifest})
+    discard_manifest_journals(output_path)
+
+
+def discard_manifest_journals(output_path: str):
+    """ Removes the journals of an interrupted run (used if the extraction is not incremental). """
+    for journal_file in list_journal_files(output_path):
+        os.remove(output_path + journal_file)
+
+
+def write_manifest_journal(output_path: str, chunk_name: str, entries: dict):
+    """ Writes the manifest entries of a single finished chunk. """
+    save_json(folder_path=output_path, file_name=journal_file_name(chunk_name), save_object=entries)
+
+
+# Manifest Entries ####################################################################################################
+
+def extraction_options(qa_category_list, output_subtests: bool, native_codes: bool, output_format: str = 'pickle',
+                       qa_failed_only: bool = False):
+    """ Returns the options influencing the extracted values in a form which can be compared with the manifest. """
+    options = {'qa_category_list': list(qa_category_list),
+               'output_subtests': bool(output_subtests),
+               'native_codes': bool(native_codes),
+               'output_format': output_format}
+    # Only recorded if set, so the manifests of complete extractions stay valid
+    if qa_failed_only:
+        options['qa_failed_only'] = True
+    return options
+
+
+def file_content_hash(file_path: str, block_size: int = 1 << 20):
+    """ Returns the hex digest of the file content. """
+    content_hash = hashlib.blake2b(digest_size=16)
+    with open(file_path, 'rb') as file:
+        for block in iter(lambda: file.read(block_size), b''):
+            content_hash.update(block)
+    return content_hash.hexdigest()
+
+
+def file_manifest_entry(file_path: str, chunk_name: str, file_id: str, options: dict):
+    """ Creates the manifest entry for an extracted xml.
+
+    Params:
+        file_path (str) - Path to the extracted xml
+        chunk_name (str) - Name of the chunk (pickle file without ending) the extraction is saved to
+        file_id (str) - Key of the extraction in the chunk dictionary
+        options (dict) - Options used for the extraction (see extraction_options)
+
+    Returns:
+        entry (dict) - Dictionary with size, mtime, hash, chunk, file_id and options of the file
+    """
+    stat = os.stat(file_path)
+    return {'size': stat.st_size,
+            'mtime': stat.st_mtime_ns,
+            'hash': file_content_hash(file_path),
+            'chunk': chunk_name,
+            'file_id': file_id,
+            'options': options}
+
+
+def file_needs_extraction(file_path: str, entry: dict, options: dict):
+    """ Checks if a file is new or has changed since it was extracted with the same options.
+
+    Size and modification time are compared first and only if they differ the content hash is calculated, so unchanged
+    files are not read at all. Files which were only touched keep their extraction and get a refreshed entry with the
+    new mtime (the given entry is left as it is).
+
+    Returns:
+        needs_extraction (bool), entry (dict) - Entry of the file if it keeps its extraction (None otherwise)
+    """
+    if not entry or entry['options'] != options:
+        return True, None
+    stat = os.stat(file_path)
+    if stat.st_size == entry['size'] and stat.st_mtime_ns == entry['mtime']:
+        return False, entry
+    if stat.st_size == entry['size'] and file_content_hash(file_path) == entry['hash']:
+        return False, dict(entry, mtime=stat.st_mtime_ns)
+    return True, None
+
+
+# Incremental Chunking ################################################################################################
+
+def chunk_name_end(chunk_name: str):
+    """ Returns the end index of a chunk named '<start>_to_<end>' or 0 for other names. """
+    start, _, end = chunk_name.partition('_to_')
+    return int(end) if start.isdigit() and end.isdigit() else 0
+
+
+def manifest_chunking(input_list: list, manifest: dict, chunksize: int):
+    """ Chunks a list of files by a fixed size while files which are already in the manifest stay in their chunk.
+
+    Only new files are assigned to new chunks which continue the numbering of the existing chunks, therefore the
+    extraction of an unchanged file is never duplicated to a second chunk.
+    """
+    output_dict = {}
+    new_files = []
+    for file_path in input_list:
+        entry = manifest.get(os.path.basename(file_path))
+        if entry:
+            output_dict.setdefault(entry['chunk'], []).append(file_path)
+        else:
+            new_files.append(file_path)
+
+    start_offset = max([chunk_name_end(entry['chunk']) for entry in manifest.values()] + [0])
+    for start_item in range(0, len(new_files), chunksize):
+        end_item = min(start_item + chunksize, len(new_files))
+        chunk_name = str(start_offset + start_item) + '_to_' + str(start_offset + end_item)
+        output_dict[chunk_name] = new_files[start_item:end_item]
+    return output_dict
+
+
+def filter_chunks_to_extract(file_chunks_dict: dict, manifest: dict, options: dict):
+    """ Reduces the chunks to the files which are new or changed (see file_needs_extraction).
+
+    Returns:
+        pending_chunks_dict (dict) - Chunk name as key and list of files to (re-)extract as value. Chunks without any
+                                     changed file are left out.
+        refreshed_entries (dict) - Manifest entries of the files which were only touched (with their new mtime)
+    """
+    pending_chunks_dict = {}
+    refreshed_entries = {}
+    for name_key, file_list in file_chunks_dict.items():
+        pending_files = []
+        for file_path in sorted(file_list):
+            file_name = os.path.basename(file_path)
+            needs_extraction, entry = file_needs_extraction(file_path, manifest.get(file_name), options)
+            if needs_extraction:
+                pending_files.append(file_path)
+            elif entry is not manifest[file_name]:
+                refreshed_entries[file_name] = entry
+        if pending_files:
+            pending_chunks_dict[name_key] = pending_files
+    return pending_chunks_dict, refreshed_entries
+
+
+def removed_file_chunks(manifest: dict, file_names: set):
+    """ Returns the files of the manifest which were removed from the input folder since their extraction.
+
+    Returns:
+        removed_chunks (dict) - Chunk name as key and set of the names of its removed xml files as value
+    """
+    removed_chunks = {}
+    for file_name, entry in manifest.items():
+        if file_name not in file_names:
+            removed_chunks.setdefault(entry['chunk'], set()).add(file_name)
+    return removed_chunks
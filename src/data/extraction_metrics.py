@@ -0,0 +1,196 @@
+import contextlib
+import cProfile
+import json
+import logging
+import os
+import time
+
+
+logger = logging.getLogger(__name__)
+
+
+# Collector ###########################################################################################################
+
+# Collector of the current process, None while the instrumentation is switched off. Every hook checks it first, so the
+# extraction only pays a function call per hook if no metrics are collected.
+_METRICS = None
+_NULL_TIMER = contextlib.nullcontext()
+# Number of example details kept per anomaly (the counter includes all occurrences)
+MAX_ANOMALY_SAMPLES = 5
+
+METRICS_FORMATS = ('jsonl', 'prometheus')
+METRICS_FILE_NAMES = {'jsonl': 'extraction_metrics.jsonl', 'prometheus': 'extraction_metrics.prom'}
+PROFILE_FOLDER_NAME = 'extraction_profiles/'
+# Separator of the stages which ran within another stage, e.g. 'train_models/fit' (see merge_metrics)
+STAGE_SEPARATOR = '/'
+
+
+def new_metrics():
+    """ Returns an empty collector with the calls and seconds per stage, counters and anomaly examples. """
+    return {'timers': {}, 'counters': {}, 'anomalies': {}}
+
+
+@contextlib.contextmanager
+def collect_metrics(enabled: bool = True):
+    """ Context manager which collects the metrics of the enclosed code into a new collector (yielded) and restores
+    the previous collector afterwards, so nested collections (e.g. a work unit run by the parent process) are separate.
+    Yields None and leaves the instrumentation untouched if not enabled. """
+    global _METRICS
+    if not enabled:
+        yield None
+        return
+    previous_metrics, _METRICS = _METRICS, new_metrics()
+    try:
+        yield _METRICS
+    finally:
+        _METRICS = previous_metrics
+
+
+@contextlib.contextmanager
+def _timed_stage(timers: dict, stage: str):
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        timer = timers.setdefault(stage, [0, 0.0])
+        timer[0] += 1
+        timer[1] += time.perf_counter() - start_time
+
+
+def stage_timer(stage: str):
+    """ Returns a context manager which adds the time of the enclosed code to the stage (no-op if switched off). """
+    if _METRICS is None:
+        return _NULL_TIMER
+    return _timed_stage(_METRICS['timers'], stage)
+
+
+def count(counter: str, value: int = 1):
+    """ Increases a counter (e.g. files, bytes, observations) by value (no-op if switched off). """
+    if _METRICS is not None:
+        _METRICS['counters'][counter] = _METRICS['counters'].get(counter, 0) + value
+
+
+def record_anomaly(anomaly: str, detail: str):
+    """ Counts an anomaly of the data (e.g. missing_station_identifier) and keeps the first details as examples.
+    The detail is also passed to the debug log, so it is available without collecting metrics. """
+    logger.debug("%s: %s", anomaly, detail)
+    if _METRICS is not None:
+        count('anomaly.' + anomaly)
+        samples = _METRICS['anomalies'].setdefault(anomaly, [])
+        if len(samples) < MAX_ANOMALY_SAMPLES:
+            samples.append(detail)
+
+
+def merge_metrics(total: dict, metrics: dict, parent: str = None):
+    """ Adds the metrics of a collector (e.g. returned by a worker) to the total collector. The stages of the worker
+    are nested into the stage parent ('<parent>/<stage>') if it's given, i.e. the stage of the total which ran the
+    workers, so they are reported within it instead of being counted a second time. """
+    for stage, (calls, seconds) in metrics['timers'].items():
+        if parent is not None:
+            stage = parent + STAGE_SEPARATOR + stage
+        timer = total['timers'].setdefault(stage, [0, 0.0])
+        timer[0] += calls
+        timer[1] += seconds
+    for counter, value in metrics['counters'].items():
+        total['counters'][counter] = total['counters'].get(counter, 0) + value
+    for anomaly, samples in metrics['anomalies'].items():
+        total_samples = total['anomalies'].setdefault(anomaly, [])
+        total_samples.extend(samples[:MAX_ANOMALY_SAMPLES - len(total_samples)])
+    return total
+
+
+# Output ##############################################################################################################
+
+def metrics_records(metrics: dict, labels: dict = None):
+    """ Flattens a collector to one record per stage and counter, each with the given labels (e.g. run name). """
+    labels = labels or {}
+    records = [dict(labels, type='stage', name=stage, calls=calls, seconds=round(seconds, 6))
+               for stage, (calls, seconds) in sorted(metrics['timers'].items())]
+    records += [dict(labels, type='counter', name=counter, value=value)
+                for counter, value in sorted(metrics['counters'].items())]
+    records += [dict(labels, type='anomaly', name=anomaly, samples=samples)
+                for anomaly, samples in sorted(metrics['anomalies'].items())]
+    return records
+
+
+def write_metrics_jsonl(file_path: str, metrics: dict, labels: dict = None):
+    """ Appends the metrics as json lines (see metrics_records), so the runs of a folder accumulate in one file. """
+    with open(file_path, 'a') as metrics_file:
+        for record in metrics_records(metrics=metrics, labels=labels):
+            metrics_file.write(json.dumps(record, sort_keys=True) + '\n')
+
+
+def _prometheus_labels(labels: dict):
+    return ','.join('%s="%s"' % (key, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                    for key, value in sorted(labels.items()))
+
+
+def write_prometheus_textfile(file_path: str, metrics: dict, labels: dict = None):
+    """ Atomically writes the metrics of the last run in the Prometheus text format (e.g. for the textfile collector
+    of the node exporter). """
+    labels = labels or {}
+    lines = ['# HELP xml2dict_stage_seconds_total Seconds spent in each extraction stage.',
+             '# TYPE xml2dict_stage_seconds_total counter']
+    lines += ['xml2dict_stage_seconds_total{%s} %.6f' % (_prometheus_labels(dict(labels, stage=stage)), seconds)
+              for stage, (_, seconds) in sorted(metrics['timers'].items())]
+    lines += ['# HELP xml2dict_stage_calls_total Number of times each extraction stage was run.',
+              '# TYPE xml2dict_stage_calls_total counter']
+    lines += ['xml2dict_stage_calls_total{%s} %d' % (_prometheus_labels(dict(labels, stage=stage)), calls)
+              for stage, (calls, _) in sorted(metrics['timers'].items())]
+    lines += ['# HELP xml2dict_events_total Files, bytes, elements, observations and anomalies of the extraction.',
+              '# TYPE xml2dict_events_total counter']
+    lines += ['xml2dict_events_total{%s} %d' % (_prometheus_labels(dict(labels, counter=counter)), value)
+              for counter, value in sorted(metrics['counters'].items())]
+    temporary_path = file_path + '.tmp'
+    with open(temporary_path, 'w') as metrics_file:
+        metrics_file.write('\n'.join(lines) + '\n')
+    os.replace(temporary_path, file_path)
+
+
+def save_metrics(output_path: str, metrics: dict, metrics_format: str, labels: dict = None):
+    """ Saves the metrics to the output folder in the metrics_format (see METRICS_FORMATS). """
+    assert metrics_format in METRICS_FORMATS
+    file_path = output_path + METRICS_FILE_NAMES[metrics_format]
+    if metrics_format == 'jsonl':
+        write_metrics_jsonl(file_path=file_path, metrics=metrics, labels=labels)
+    else:
+        write_prometheus_textfile(file_path=file_path, metrics=metrics, labels=labels)
+    return file_path
+
+
+def _report_stages(timers: dict, parent: str = None, depth: int = 0):
+    # Stages of the level below the parent (all stages without a timed parent on the top level)
+    prefix = '' if parent is None else parent + STAGE_SEPARATOR
+    stages = {stage: timer for stage, timer in timers.items() if stage.rpartition(STAGE_SEPARATOR)[0] == (
+        parent or '') or (parent is None and stage.rpartition(STAGE_SEPARATOR)[0] not in timers)}
+    total_seconds = max(sum(seconds for _, seconds in stages.values()), 1e-9)
+    for stage, (calls, seconds) in sorted(stages.items(), key=lambda item: -item[1][1]):
+        print("--- %sStage %s: %.2f s in %d calls (%.1f%%).---" % (
+            '  ' * depth, stage[len(prefix):], seconds, calls, 100 * seconds / total_seconds))
+        _report_stages(timers=timers, parent=stage, depth=depth + 1)
+
+
+def metrics_report(metrics: dict):
+    """ Prints the time per stage and the counters. Nested stages ('<parent>/<stage>', see merge_metrics) are printed
+    indented below their parent with their share of the time of their siblings, as the parent's time already includes
+    them. Nested stages of parallel workers can sum up to more than the wall time of their parent. """
+    _report_stages(timers=metrics['timers'])
+    print("--- Counters: %s.---" % ', '.join('%s=%d' % item for item in sorted(metrics['counters'].items())))
+
+
+# Profiling ###########################################################################################################
+
+@contextlib.contextmanager
+def profile_block(profile_path: str, name: str):
+    """ Context manager which profiles the enclosed code with cProfile and dumps the statistics to
+    '<profile_path><name>.prof' (to be inspected with pstats or snakeviz). No-op if profile_path is None. """
+    if profile_path is None:
+        yield
+        return
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profiler.dump_stats(profile_path + name + '.prof')
@@ -0,0 +1,222 @@
+import glob
+import os
+
+import pandas as pd
+
+from extraction_metrics import count, record_anomaly, stage_timer
+
+
+# Column Types ########################################################################################################
+
+# Keys of the extraction dictionaries which are written as parquet columns with a dedicated type. All remaining keys
+# (e.g. version, native codes, qc remarks) keep their string values.
+FLOAT_METADATA_COLUMNS = ['latitude', 'longitude', 'station_elevation']
+DATETIME_COLUMNS = ['date_time']
+PARTITION_COLUMNS = ['station', 'month']
+
+
+def extraction_column_type(column: str):
+    """ Returns the type of an extracted key based on its name ('float', 'flag', 'datetime' or 'string').
+
+    Measured and derived values are floats and the QA flags are small integers (-10, -1, 0, 10, 100).
+    The derived min/max air temperature times are no numbers and therefore stay strings.
+    """
+    if column in DATETIME_COLUMNS:
+        return 'datetime'
+    if column in FLOAT_METADATA_COLUMNS:
+        return 'float'
+    if column.endswith('-derived'):
+        return 'string' if '_time-' in column else 'float'
+    if column.endswith(('_value', '_orig-value', '_value_override')):
+        return 'float'
+    if column.endswith(('_overall_qa_summary', '_qa_flag_override')) or '_qa-' in column:
+        return 'flag'
+    return 'string'
+
+
+def extraction_arrow_type(column: str):
+    """ Returns the pyarrow type for an extracted key (see extraction_column_type). """
+    import pyarrow as pa
+
+    return {'float': pa.float64(),
+            'flag': pa.int16(),
+            'datetime': pa.timestamp('ns', tz='UTC'),
+            'string': pa.string()}[extraction_column_type(column)]
+
+
+def coerce_column(values, column: str, column_type: str):
+    """ Converts the values of a float, flag or datetime column (see extraction_column_type). Values which can't be
+    converted become missing, they are counted as 'coerced_values.<type>' and recorded as anomaly 'coerced_value' with
+    the column and an example, so no value is lost without a trace.
+
+    Params:
+        values (pd.Series) - Values of the column as extracted (strings, numbers or None)
+        column (str) - Name of the column
+        column_type (str) - Type of the column ('float', 'flag' or 'datetime')
+
+    Returns:
+        typed (pd.Series) - Numbers (datetimes in UTC for datetime columns), missing where not convertible
+    """
+    if column_type == 'datetime':
+        typed = pd.to_datetime(values, errors='coerce', utc=True)
+    else:
+        typed = pd.to_numeric(values, errors='coerce')
+    coerced = typed.isna().to_numpy() & values.notna().to_numpy()
+    if coerced.any():
+        count('coerced_values.' + column_type, int(coerced.sum()))
+        record_anomaly('coerced_value', "%d values of column %s are no %s, e.g. %r." % (
+            coerced.sum(), column, column_type, values[coerced].iloc[0]))
+    return typed
+
+
+def records_to_typed_dataframe(records: dict):
+    """ Transforms extraction dictionaries into a DataFrame with typed columns (values which can't be converted are
+    counted, see coerce_column).
+
+    Params:
+        records (dict) - Dictionary with the unique file id as key and the extraction dictionary as value
+
+    Returns:
+        df (pd.DataFrame) - One row per file with the unique file id in the column 'file_id' and the partition columns
+    """
+    df = pd.DataFrame.from_dict(records, orient='index')
+    for column in df.columns:
+        column_type = extraction_column_type(column)
+        if column_type == 'float':
+            df[column] = coerce_column(df[column], column, column_type).astype('float64')
+        elif column_type == 'flag':
+            df[column] = coerce_column(df[column], column, column_type).astype('Int16')
+        elif column_type == 'datetime':
+            df[column] = coerce_column(df[column], column, column_type)
+
+    # Station and month partitions (station as used for the chunking by station)
+    uri_parts = df['source_uri'].str.split('/')
+    df['station'] = uri_parts.str[10] + '_' + uri_parts.str[9]
+    df['month'] = df['date_time'].dt.strftime('%Y-%m').fillna('unknown')
+    df.index.name = 'file_id'
+    return df.reset_index()
+
+
+# Parquet Sink ########################################################################################################
+
+def parquet_chunk_files(output_root: str, chunk_name: str):
+    """ Lists all parquet files which were written for a chunk (in any station/month partition). """
+    return sorted(glob.glob(os.path.join(output_root, 'station=*', 'month=*', chunk_name + '-*.parquet')))
+
+
+def parquet_batch_number(file_path: str):
+    """ Returns the batch number of a parquet file named '<chunk>-<batch>.parquet'. """
+    return int(os.path.basename(file_path)[:-len('.parquet')].rpartition('-')[2])
+
+
+def write_parquet_batch(df, output_root: str, chunk_name: str, batch_number: int):
+    """ Writes a typed DataFrame (see records_to_typed_dataframe) partitioned by station and month. """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    with stage_timer('parquet'):
+        data_columns = [column for column in df.columns if column not in PARTITION_COLUMNS]
+        schema = pa.schema([(column, pa.string() if column == 'file_id' else extraction_arrow_type(column))
+                            for column in data_columns])
+        for (station, month), df_partition in df.groupby(PARTITION_COLUMNS, sort=False):
+            partition_path = os.path.join(output_root, 'station=' + station, 'month=' + month)
+            os.makedirs(partition_path, exist_ok=True)
+            table = pa.Table.from_pandas(df_partition[data_columns], schema=schema, preserve_index=False)
+            file_path = os.path.join(partition_path, '%s-%05d.parquet' % (chunk_name, batch_number))
+            pq.write_table(table, file_path + '.tmp')
+            os.replace(file_path + '.tmp', file_path)
+
+
+def remove_parquet_chunk_rows(output_root: str, chunk_name: str, origin_file_names: set = None):
+    """ Removes the rows of a chunk which were extracted from the given xml files (all rows if not given).
+
+    Returns:
+        next_batch_number (int) - Batch number which can be used for new files of the chunk
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    next_batch_number = 0
+    for file_path in parquet_chunk_files(output_root=output_root, chunk_name=chunk_name):
+        if origin_file_names is None:
+            os.remove(file_path)
+            continue
+        table = pq.read_table(file_path)
+        keep = [os.path.basename(origin_filename) not in origin_file_names
+                for origin_filename in table.column('origin_filename').to_pylist()]
+        if not any(keep):
+            os.remove(file_path)
+            continue
+        if not all(keep):
+            pq.write_table(table.filter(pa.array(keep)), file_path + '.tmp')
+            os.replace(file_path + '.tmp', file_path)
+        next_batch_number = max(next_batch_number, parquet_batch_number(file_path) + 1)
+    return next_batch_number
+
+
+def write_parquet_records(records, output_root: str, chunk_name: str, batch_size: int = 500):
+    """ Writes extraction dictionaries of a chunk as typed parquet files partitioned by station and month.
+
+    The records are consumed lazily and flushed every batch_size rows, therefore the memory usage only depends on the
+    batch size and not on the size of the chunk.
+
+    Params:
+        records (iterable) - Tuples of unique file id and extraction dictionary
+        output_root (str) - Root folder of the parquet dataset
+        chunk_name (str) - Name of the chunk which is used as prefix of all written files
+        batch_size (int) - Number of rows per written batch
+
+    Returns:
+        num_rows (int) - Number of written rows
+    """
+    # Files of the same name (left by an interrupted run) are replaced
+    batch_number = remove_parquet_chunk_rows(output_root=output_root, chunk_name=chunk_name)
+    num_rows = 0
+    batch = {}
+    for unique_file_id, station_data in records:
+        batch[unique_file_id] = station_data
+        if len(batch) >= batch_size:
+            write_parquet_batch(records_to_typed_dataframe(batch), output_root, chunk_name, batch_number)
+            num_rows += len(batch)
+            batch_number += 1
+            batch = {}
+    if batch:
+        write_parquet_batch(records_to_typed_dataframe(batch), output_root, chunk_name, batch_number)
+        num_rows += len(batch)
+    return num_rows
+
+
+# Parquet Reader ######################################################################################################
+
+def parquet_dataset(output_root: str):
+    """ Opens the parquet dataset with the schema unified over all files (stations report different sensors, so
+    columns missing in a file are null). Only the footers of the files are read. """
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+    import pyarrow.parquet as pq
+
+    dataset = ds.dataset(output_root, format='parquet', partitioning='hive')
+    schema = pa.unify_schemas([pq.read_schema(file_path) for file_path in dataset.files] +
+                              [dataset.partitioning.schema])
+    return ds.dataset(output_root, format='parquet', partitioning='hive', schema=schema)
+
+
+def read_parquet_extraction(output_root: str, columns: list = None, filters=None):
+    """ Reads the parquet dataset into a DataFrame with only the requested columns.
+
+    Stations report different sensors, therefore the schema is unified over all files and missing columns are null.
+
+    Params:
+        output_root (str) - Root folder of the parquet dataset
+        columns (list) - Columns to read (all if not given), the partition columns station and month can be included
+        filters (pyarrow expression/list) - Row filter which is pushed down to the files (see pyarrow.dataset)
+
+    Returns:
+        df (pd.DataFrame) - Extracted values with typed columns
+    """
+    import pyarrow.parquet as pq
+
+    dataset = parquet_dataset(output_root)
+    if isinstance(filters, list):
+        filters = pq.filters_to_expression(filters)
+    return dataset.to_table(columns=columns, filter=filters).to_pandas()
@@ -0,0 +1,296 @@
+import collections
+import functools
+import json
+import os
+import pickle
+
+import numpy as np
+import pandas as pd
+
+from chunk_union import chunk_file_paths, chunk_signature
+from compact_records import compact_to_dataframe, is_compact_records, load_schema_registry
+from extraction_manifest import save_json
+from xml2dict import ensure_folder_exists
+
+
+# Extraction Index ####################################################################################################
+
+# The index of an output folder holds the station, time, version, chunk and row of every extraction sorted by
+# (station, date_time, version) as .npy arrays and the statistics of every chunk (stations, min/max date_time) in
+# 'index.json'. A query finds its rows by binary search and only reads the chunks containing them.
+INDEX_FOLDER_NAME = 'extraction_index/'
+INDEX_FILE_NAME = 'index.json'
+INDEX_ARRAYS = ('stations', 'times', 'versions', 'chunks', 'rows')
+INDEX_COLUMNS = ('tc_identifier', 'date_time', 'version')
+# Keys which are returned by every query besides the projected sensors
+QUERY_METADATA_COLUMNS = ('tc_identifier', 'station_identifier', 'date_time', 'version', 'origin_filename')
+# Number of loaded chunks kept in memory, so repeated queries of a station don't read its chunk again
+CHUNK_CACHE_SIZE = 4
+_CHUNK_CACHE = collections.OrderedDict()
+_INDEX_CACHE = {}
+
+
+def normalize_station(station: str):
+    """ Returns the tc identifier of a station as used by the index (e.g. 'ZPK ' of the MIDAS error list -> 'ZPK'). """
+    return str(station).strip().upper()
+
+
+def read_chunk_index_columns(file_path: str):
+    """ Reads the station, date_time and version of every extraction of a chunk pickle (in the order of the chunk). """
+    with open(file_path, 'rb') as handle:
+        chunk = pickle.load(handle)
+    if is_compact_records(chunk):
+        df = compact_to_dataframe(chunk, load_schema_registry(os.path.dirname(file_path) + os.sep),
+                                  columns=set(INDEX_COLUMNS))
+        return df.reindex(columns=list(INDEX_COLUMNS)).reset_index(drop=True)
+    return pd.DataFrame([[station_data.get(column) for column in INDEX_COLUMNS] for station_data in chunk.values()],
+                        columns=list(INDEX_COLUMNS))
+
+
+def build_extraction_index(output_path: str):
+    """ Builds or updates the index of the chunk pickles of an output folder (any format, see INDEX_FOLDER_NAME).
+
+    Only chunks which are new or were written again since the last build are read, the entries of unchanged chunks
+    are taken from the existing index and entries of removed chunks are dropped. Extractions without a valid
+    date_time are not indexed.
+
+    Returns:
+        index (dict) - Header of the index (see load_extraction_index)
+    """
+    index_path = output_path + INDEX_FOLDER_NAME
+    ensure_folder_exists(index_path)
+    previous = load_extraction_index(output_path) if os.path.exists(index_path + INDEX_FILE_NAME) else None
+    previous_chunks = {entry['file_name']: number for number, entry in enumerate(previous['chunks'])} if previous \
+        else {}
+    if previous:
+        # Positions of the entries of each previous chunk, grouped once instead of scanning the index per chunk
+        previous_order = np.argsort(previous['arrays']['chunks'], kind='stable')
+        previous_bounds = np.searchsorted(previous['arrays']['chunks'][previous_order],
+                                          np.arange(len(previous['chunks']) + 1))
+        previous_stations = np.array(previous['stations'], dtype=object)
+
+    stations = {}
+    chunk_entries = []
+    parts = []
+    for file_path in chunk_file_paths(output_path):
+        file_name = os.path.basename(file_path)
+        signature = chunk_signature(file_path)
+        chunk_number = len(chunk_entries)
+        previous_number = previous_chunks.get(file_name)
+        if previous_number is not None and previous['chunks'][previous_number]['signature'] == signature:
+            entry = previous['chunks'][previous_number]
+            in_chunk = previous_order[previous_bounds[previous_number]:previous_bounds[previous_number + 1]]
+            station_names = previous_stations[previous['arrays']['stations'][in_chunk]]
+            times = previous['arrays']['times'][in_chunk]
+            versions = previous['arrays']['versions'][in_chunk]
+            rows = previous['arrays']['rows'][in_chunk]
+        else:
+            df = read_chunk_index_columns(file_path)
+            valid = pd.to_datetime(df['date_time'], errors='coerce', utc=True)
+            rows = np.flatnonzero(valid.notna().to_numpy())
+            station_names = np.array([normalize_station(station) for station in df['tc_identifier'].to_numpy()[rows]],
+                                     dtype=object)
+            times = valid.to_numpy(dtype='datetime64[ns]').view(np.int64)[rows]
+            versions = pd.to_numeric(df['version'], errors='coerce').fillna(-1).to_numpy(dtype=np.int32)[rows]
+            entry = {'file_name': file_name, 'signature': signature}
+        chunk_stations, station_positions = np.unique(station_names.astype(str), return_inverse=True)
+        entry = dict(entry,
+                     rows=len(rows),
+                     stations=chunk_stations.tolist(),
+                     min_date_time=int(times.min()) if len(times) else None,
+                     max_date_time=int(times.max()) if len(times) else None)
+        codes = np.array([stations.setdefault(station, len(stations)) for station in chunk_stations.tolist()],
+                         dtype=np.int32)[station_positions.reshape(-1)]
+        parts.append((codes, times, versions, np.full(len(rows), chunk_number, dtype=np.int32),
+                      np.asarray(rows, dtype=np.int32)))
+        chunk_entries.append(entry)
+
+    arrays = {name: np.concatenate([part[position] for part in parts]) if parts else np.array([], dtype=np.int64)
+              for position, name in enumerate(INDEX_ARRAYS)}
+    order = np.lexsort((arrays['versions'], arrays['times'], arrays['stations']))
+    for name in INDEX_ARRAYS:
+        # Replaced instead of overwritten, the arrays of the previous index can still be memory mapped
+        np.save(index_path + name + '.tmp.npy', arrays[name][order])
+        os.replace(index_path + name + '.tmp.npy', index_path + name + '.npy')
+    header = {'stations': list(stations), 'chunks': chunk_entries}
+    save_json(folder_path=index_path, file_name=INDEX_FILE_NAME, save_object=header)
+    print("--- Indexed %d extractions of %d stations in %d chunks.---" % (
+        len(order), len(stations), len(chunk_entries)))
+    return load_extraction_index(output_path)
+
+
+def load_extraction_index(output_path: str):
+    """ Loads the index of an output folder (see build_extraction_index) with its arrays memory mapped. The index is
+    kept in memory until it is built again.
+
+    Returns:
+        index (dict) - Stations (name by code and code by name), chunk entries and the sorted arrays
+    """
+    index_path = output_path + INDEX_FOLDER_NAME
+    assert os.path.exists(index_path + INDEX_FILE_NAME), \
+        "%s has no index, it is created with build_extraction_index." % output_path
+    signature = chunk_signature(index_path + INDEX_FILE_NAME)
+    cached = _INDEX_CACHE.get(output_path)
+    if cached is not None and cached['signature'] == signature:
+        return cached
+    with open(index_path + INDEX_FILE_NAME) as index_file:
+        index = json.load(index_file)
+    index['signature'] = signature
+    index['station_codes'] = {station: code for code, station in enumerate(index['stations'])}
+    index['arrays'] = {name: np.load(index_path + name + '.npy', mmap_mode='r') for name in INDEX_ARRAYS}
+    _INDEX_CACHE[output_path] = index
+    return index
+
+
+def stale_index_chunks(output_path: str, index: dict):
+    """ Returns the names of the chunk pickles which were added, written again or removed since the index was built.
+    """
+    indexed_signatures = {entry['file_name']: entry['signature'] for entry in index['chunks']}
+    stale_chunks = []
+    for file_path in chunk_file_paths(output_path):
+        file_name = os.path.basename(file_path)
+        if indexed_signatures.pop(file_name, None) != chunk_signature(file_path):
+            stale_chunks.append(file_name)
+    return stale_chunks + list(indexed_signatures)
+
+
+# Queries #############################################################################################################
+
+def timestamp_ns(value):
+    """ Returns a date (string or timestamp, UTC if it has no time zone) as nanoseconds since the epoch. """
+    timestamp = pd.Timestamp(value)
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.tz_localize('UTC')
+    return timestamp.value
+
+
+def query_column_selector(sensor_prefixes: list = None, columns: list = None):
+    """ Returns the predicate of the keys returned by a query: the metadata, the keys of the sensor prefixes (e.g.
+    'wind_speed' matches the value, QA flags and native codes of every wind_speed sensor) and the given columns.
+    All keys if neither prefixes nor columns are given. """
+    if sensor_prefixes is None and columns is None:
+        return None
+    prefixes = tuple(sensor_prefixes or ())
+    selected = set(QUERY_METADATA_COLUMNS) | set(columns or ())
+
+    @functools.lru_cache(maxsize=None)
+    def select_column(key: str):
+        return key in selected or key.startswith(prefixes)
+    return select_column
+
+
+def load_chunk(file_path: str, signature: list = None):
+    """ Loads a chunk pickle through the chunk cache (see CHUNK_CACHE_SIZE). Chunks of extraction dictionaries are
+    kept as list of their records, compact chunks as they are (they are decoded per query with projection). If the
+    signature of the indexed chunk is given, the chunk must not have been written again since. """
+    current_signature = chunk_signature(file_path)
+    assert signature is None or current_signature == list(signature), \
+        "%s was written again after it was indexed, rebuild the index with build_extraction_index." % file_path
+    key = (file_path, tuple(current_signature))
+    chunk = _CHUNK_CACHE.pop(key, None)
+    if chunk is None:
+        with open(file_path, 'rb') as handle:
+            chunk = pickle.load(handle)
+        if not is_compact_records(chunk):
+            chunk = {'file_ids': list(chunk), 'records': list(chunk.values())}
+    _CHUNK_CACHE[key] = chunk
+    while len(_CHUNK_CACHE) > CHUNK_CACHE_SIZE:
+        _CHUNK_CACHE.popitem(last=False)
+    return chunk
+
+
+def read_chunk_rows(output_path: str, file_name: str, rows: np.ndarray, select_column=None,
+                    signature: list = None):
+    """ Reads the rows (positions in the chunk) of a chunk pickle with only the selected keys. The positions are only
+    valid for the chunk with the signature of the index (see load_chunk). """
+    chunk = load_chunk(output_path + file_name, signature=signature)
+    if is_compact_records(chunk):
+        registry = load_schema_registry(output_path)
+        mask = np.zeros(len(chunk['file_ids']), dtype=bool)
+        mask[rows] = True
+        columns = None
+        if select_column is not None:
+            columns = {column for column in registry['columns'] if select_column(column)}
+        # Positions come back in the order of the chunk, which is the order of the rows
+        return compact_to_dataframe(chunk, registry, columns=columns, rows=mask)
+    records = {chunk['file_ids'][row]: chunk['records'][row] if select_column is None else
+               {key: value for key, value in chunk['records'][row].items() if select_column(key)}
+               for row in np.sort(rows).tolist()}
+    return pd.DataFrame.from_dict(records, orient='index')
+
+
+def query_extraction(output_path: str,
+                     station: str,
+                     start=None,
+                     end=None,
+                     sensor_prefixes: list = None,
+                     columns: list = None,
+                     latest_only: bool = False,
+                     rebuild_stale: bool = True):
+    """ Returns the extractions of a station in a time range from the indexed output folder.
+
+    The rows are found by binary search in the index, only the chunks whose statistics overlap the query and which
+    contain rows of the query are read, and only the projected keys are decoded (compact chunks) or copied. Chunks
+    which were added, written again (e.g. by an incremental extraction) or removed since the index was built make the
+    positions of the index invalid, so the index is updated first (see stale_index_chunks).
+
+    Params:
+        output_path (str) - Output folder of the extraction with an index (see build_extraction_index)
+        station (str) - Tc identifier of the station, e.g. 'ZPK'
+        start (str/pd.Timestamp) - First date_time of the range (inclusive, open if None), UTC if no time zone
+        end (str/pd.Timestamp) - Last date_time of the range (inclusive, open if None), UTC if no time zone
+        sensor_prefixes (list) - Prefixes of the returned sensor keys, e.g. ['wind_speed'] (all keys if None)
+        columns (list) - Further keys which are returned
+        latest_only (bool) - Indicator if only the highest version of each observation time is returned
+        rebuild_stale (bool) - Indicator if a stale index is updated, otherwise an AssertionError is raised
+
+    Returns:
+        df (pd.DataFrame) - Extractions sorted by date_time and version with the unique file id as index
+    """
+    index = load_extraction_index(output_path)
+    stale_chunks = stale_index_chunks(output_path, index)
+    if stale_chunks:
+        assert rebuild_stale, "The index of %s is stale (%s changed since it was built), rebuild it with " \
+                              "build_extraction_index." % (output_path, ', '.join(stale_chunks))
+        index = build_extraction_index(output_path)
+    code = index['station_codes'].get(normalize_station(station))
+    start_ns = np.iinfo(np.int64).min if start is None else timestamp_ns(start)
+    end_ns = np.iinfo(np.int64).max if end is None else timestamp_ns(end)
+    candidate_chunks = {number for number, entry in enumerate(index['chunks'])
+                        if normalize_station(station) in entry['stations'] and entry['rows']
+                        and entry['min_date_time'] <= end_ns and entry['max_date_time'] >= start_ns}
+    if code is None or not candidate_chunks:
+        return pd.DataFrame()
+
+    arrays = index['arrays']
+    first = np.searchsorted(arrays['stations'], code, side='left')
+    last = np.searchsorted(arrays['stations'], code, side='right')
+    station_times = arrays['times'][first:last]
+    positions = np.arange(first + np.searchsorted(station_times, start_ns, side='left'),
+                          first + np.searchsorted(station_times, end_ns, side='right'))
+    if latest_only and len(positions):
+        # The versions of an observation time are sorted, so the last one of each time is kept
+        times = arrays['times'][positions]
+        positions = positions[np.append(times[1:] != times[:-1], True)]
+    if not len(positions):
+        return pd.DataFrame()
+
+    select_column = query_column_selector(sensor_prefixes=sensor_prefixes, columns=columns)
+    chunk_numbers = arrays['chunks'][positions]
+    rows = arrays['rows'][positions]
+    frames = [read_chunk_rows(output_path=output_path,
+                              file_name=index['chunks'][chunk_number]['file_name'],
+                              rows=rows[chunk_numbers == chunk_number],
+                              select_column=select_column,
+                              signature=index['chunks'][chunk_number]['signature'])
+              for chunk_number in np.unique(chunk_numbers).tolist()]
+    df = pd.concat(frames, sort=False) if len(frames) > 1 else frames[0]
+    order = np.lexsort((pd.to_numeric(df['version'], errors='coerce').to_numpy(),
+                        pd.to_datetime(df['date_time'], utc=True).to_numpy()))
+    return df.iloc[order]
+
+
+def midas_error_stations(file_path: str):
+    """ Returns the tc identifiers of the stations in a MIDAS error list (e.g. CLIMAT_Stations_2019-12_MIDAS_Errors.csv)
+    in the order of the list. """
+    return [normalize_station(station) for station in pd.read_csv(file_path)['TC_ID'].dropna()]
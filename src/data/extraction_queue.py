@@ -0,0 +1,214 @@
+import contextlib
+import os
+import pickle
+import socket
+import threading
+import time
+
+from extraction_metrics import count
+
+
+# Shared Queue ########################################################################################################
+
+# Several hosts which mount the same output folder cooperate on one extraction through a queue folder, which only
+# relies on atomic file operations (exclusive create, rename and hard link) that also hold on network file systems
+# (SQLite locking is not reliable there). Each task (plan, work unit, chunk merge, finish) is claimed by a lease file
+# and done once its pickled result is published.
+QUEUE_FOLDER_NAME = 'extraction_queue/'
+LEASE_FOLDER_NAME = 'leases/'
+RESULT_FOLDER_NAME = 'results/'
+# A lease whose file was not touched by the heartbeat for this long belongs to a dead worker and is reclaimed
+LEASE_SECONDS = 300
+
+
+def queue_folder_path(output_path: str, queue_name: str):
+    """ Returns the queue folder of a named cooperative run in the output folder (created if it doesn't exist). """
+    queue_path = output_path + QUEUE_FOLDER_NAME + queue_name + '/'
+    for folder_name in (LEASE_FOLDER_NAME, RESULT_FOLDER_NAME):
+        os.makedirs(queue_path + folder_name, exist_ok=True)
+    return queue_path
+
+
+def attempt_name():
+    """ Returns a name which is unique for each attempt of a task on any host (part of the files it writes). """
+    return 'a%xp%x' % (time.time_ns(), os.getpid())
+
+
+# Task Results ########################################################################################################
+
+def task_result_path(queue_path: str, task: str):
+    return queue_path + RESULT_FOLDER_NAME + task + '.pickle'
+
+
+def task_done(queue_path: str, task: str):
+    """ Checks if the result of a task is published. """
+    return os.path.exists(task_result_path(queue_path, task))
+
+
+def publish_task_result(queue_path: str, task: str, result):
+    """ Publishes the result of a task unless another worker was faster (e.g. the worker whose lease was reclaimed
+    while it was still running). The result is written to a file of its own and hard linked, which fails if the
+    result already exists.
+
+    Returns:
+        published (bool) - Indicator if this result is the one of the task
+    """
+    result_path = task_result_path(queue_path, task)
+    temporary_path = '%s.%s.tmp' % (result_path, attempt_name())
+    with open(temporary_path, 'wb') as handle:
+        pickle.dump(result, handle, protocol=pickle.HIGHEST_PROTOCOL)
+    try:
+        os.link(temporary_path, result_path)
+        return True
+    except FileExistsError:
+        return False
+    finally:
+        os.remove(temporary_path)
+
+
+def load_task_result(queue_path: str, task: str):
+    with open(task_result_path(queue_path, task), 'rb') as handle:
+        return pickle.load(handle)
+
+
+# Leases ##############################################################################################################
+
+def lease_path(queue_path: str, task: str):
+    return queue_path + LEASE_FOLDER_NAME + task + '.lease'
+
+
+def read_lease(file_path: str):
+    """ Returns the holder written into a lease file, None if there is no lease. """
+    try:
+        with open(file_path) as lease_file:
+            return lease_file.read()
+    except FileNotFoundError:
+        return None
+
+
+def reclaim_stale_lease(file_path: str, lease_seconds: float):
+    """ Removes a lease whose heartbeat stopped for lease_seconds. The lease is renamed first, which only succeeds for
+    one of several workers reclaiming it at the same time. If the renamed lease is not the stale one (it was reclaimed
+    and claimed again in between), it is restored.
+
+    Returns:
+        reclaimed (bool) - Indicator if the lease is gone and can be claimed
+    """
+    holder = read_lease(file_path)
+    try:
+        idle_seconds = time.time() - os.stat(file_path).st_mtime
+    except FileNotFoundError:
+        return True
+    if holder is None or idle_seconds < lease_seconds:
+        return holder is None
+    stale_path = '%s.%s.stale' % (file_path, attempt_name())
+    try:
+        os.rename(file_path, stale_path)
+    except FileNotFoundError:
+        return False
+    if read_lease(stale_path) != holder:
+        with contextlib.suppress(FileExistsError):
+            os.link(stale_path, file_path)
+        os.remove(stale_path)
+        return False
+    os.remove(stale_path)
+    count('reclaimed_leases')
+    print("--- Reclaimed lease %s of %s (no heartbeat for %.0f s).---" % (
+        os.path.basename(file_path), holder.split(' ')[0], idle_seconds))
+    return True
+
+
+def claim_lease(queue_path: str, task: str, lease_seconds: float = LEASE_SECONDS):
+    """ Claims the lease of a task by hard linking a file with the holder to the lease file, which fails if the lease
+    exists (reclaiming a stale one). Unlike an exclusive create and write, a worker killed during the claim never
+    leaves a lease without holder.
+
+    Returns:
+        holder (str) - Host, process and attempt written into the lease, None if another worker holds it
+    """
+    file_path = lease_path(queue_path, task)
+    holder = '%s:%d %s' % (socket.gethostname(), os.getpid(), attempt_name())
+    temporary_path = '%s.%s.tmp' % (file_path, attempt_name())
+    with open(temporary_path, 'w') as lease_file:
+        lease_file.write(holder)
+    try:
+        for _ in range(2):
+            try:
+                os.link(temporary_path, file_path)
+                return holder
+            except FileExistsError:
+                if not reclaim_stale_lease(file_path, lease_seconds=lease_seconds):
+                    return None
+        return None
+    finally:
+        os.remove(temporary_path)
+
+
+def release_lease(queue_path: str, task: str, holder: str):
+    """ Removes the lease of a task if it is still held by the holder. """
+    file_path = lease_path(queue_path, task)
+    if read_lease(file_path) == holder:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(file_path)
+
+
+@contextlib.contextmanager
+def task_lease(queue_path: str, task: str, lease_seconds: float = LEASE_SECONDS, poll_seconds: float = None):
+    """ Context manager which claims the lease of a task and keeps it alive by touching the lease file from a
+    background thread every quarter of lease_seconds. Yields if the lease was acquired; waits until it is if
+    poll_seconds are given. The lease is released afterwards. """
+    holder = claim_lease(queue_path, task, lease_seconds=lease_seconds)
+    while holder is None and poll_seconds is not None:
+        time.sleep(poll_seconds)
+        holder = claim_lease(queue_path, task, lease_seconds=lease_seconds)
+    if holder is None:
+        yield False
+        return
+
+    stop = threading.Event()
+
+    def heartbeat():
+        while not stop.wait(lease_seconds / 4):
+            with contextlib.suppress(FileNotFoundError):
+                os.utime(lease_path(queue_path, task))
+
+    thread = threading.Thread(target=heartbeat, daemon=True)
+    thread.start()
+    try:
+        yield True
+    finally:
+        stop.set()
+        thread.join()
+        release_lease(queue_path, task, holder=holder)
+
+
+# Tasks ###############################################################################################################
+
+def try_task(queue_path: str, task: str, run_task, lease_seconds: float = LEASE_SECONDS):
+    """ Runs a task and publishes its result unless it is done or leased by another worker.
+
+    Params:
+        queue_path (str) - Queue folder (see queue_folder_path)
+        task (str) - Unique name of the task
+        run_task (callable) - Function without arguments which returns the result of the task
+        lease_seconds (float) - Seconds without heartbeat after which the lease of a worker is reclaimed
+
+    Returns:
+        published (bool) - Indicator if this worker ran the task and its result is the published one
+    """
+    if task_done(queue_path, task):
+        return False
+    with task_lease(queue_path, task, lease_seconds=lease_seconds) as acquired:
+        # The previous holder of the lease can have finished the task between the check and the claim
+        if not acquired or task_done(queue_path, task):
+            return False
+        return publish_task_result(queue_path, task, run_task())
+
+
+def wait_for_task(queue_path: str, task: str, run_task, lease_seconds: float = LEASE_SECONDS,
+                  poll_seconds: float = 5.0):
+    """ Returns the result of a task which is run by exactly one worker (see try_task), the others wait for it. """
+    while not task_done(queue_path, task):
+        if not try_task(queue_path, task, run_task=run_task, lease_seconds=lease_seconds):
+            time.sleep(poll_seconds)
+    return load_task_result(queue_path, task)
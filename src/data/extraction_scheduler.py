@@ -0,0 +1,80 @@
+import os
+import time
+
+
+# Work Units ##########################################################################################################
+
+# Partial results of the work units are flushed to this subfolder of the output folder until their chunk is merged
+UNIT_FOLDER_NAME = 'extraction_units/'
+
+
+def plan_extraction_units(file_chunks_dict: dict, max_files_per_unit: int = 250,
+                          max_bytes_per_unit: int = 64 * 2 ** 20):
+    """ Splits the chunks into work units with a bounded number of files and bytes.
+
+    Stations differ a lot in their number of files, so a chunk is split into successive units of its sorted files. The
+    extractions of a unit are the only ones a worker holds in memory at once. The units are returned largest first, so
+    the workers which pick up the next unit when they are idle end up with a similar amount of work.
+
+    Params:
+        file_chunks_dict (dict) - Chunk name as key and list of xml file paths as value
+        max_files_per_unit (int) - Maximum number of files in a unit
+        max_bytes_per_unit (int) - Maximum size of the files in a unit (a single larger file is a unit on its own)
+
+    Returns:
+        units (list) - Dictionaries with chunk name, index of the unit within the chunk, files and bytes
+    """
+    units = []
+    for chunk_name, file_list in file_chunks_dict.items():
+        unit = None
+        for file_path in sorted(file_list):
+            file_size = os.path.getsize(file_path)
+            if unit is None or len(unit['files']) >= max_files_per_unit or \
+                    unit['bytes'] + file_size > max_bytes_per_unit:
+                unit = {'chunk': chunk_name, 'index': 0 if unit is None else unit['index'] + 1, 'files': [], 'bytes': 0}
+                units.append(unit)
+            unit['files'].append(file_path)
+            unit['bytes'] += file_size
+    return sorted(units, key=lambda unit: unit['bytes'], reverse=True)
+
+
+def extraction_run_name():
+    """ Returns a name which is unique for each run and is part of the file names written by its work units. """
+    return 'u%x' % time.time_ns()
+
+
+def extraction_unit_name(unit: dict, run_name: str):
+    """ Returns the file name prefix of a work unit, which starts with the name of its chunk followed by '-'. """
+    return '%s-%s.%d' % (unit['chunk'], run_name, unit['index'])
+
+
+# Throughput ##########################################################################################################
+
+def extraction_unit_stats(unit: dict, start_time: float):
+    """ Returns the statistics of a finished work unit for the throughput report. """
+    return {'worker': os.getpid(),
+            'files': len(unit['files']),
+            'bytes': unit['bytes'],
+            'seconds': time.time() - start_time}
+
+
+def worker_throughput_report(unit_stats: list):
+    """ Aggregates the statistics of the work units per worker and prints the throughput of each worker.
+
+    Returns:
+        report (dict) - Worker process id as key and dictionary with units, files, bytes and busy seconds as value
+    """
+    report = {}
+    for stats in unit_stats:
+        worker = report.setdefault(stats['worker'], {'units': 0, 'files': 0, 'bytes': 0, 'seconds': 0.0})
+        worker['units'] += 1
+        worker['files'] += stats['files']
+        worker['bytes'] += stats['bytes']
+        worker['seconds'] += stats['seconds']
+
+    for worker_id, worker in sorted(report.items()):
+        seconds = max(worker['seconds'], 1e-9)
+        print("--- Worker %d: %d units, %d files, %.1f MB in %.1f s (%.1f files/s, %.2f MB/s).---" % (
+            worker_id, worker['units'], worker['files'], worker['bytes'] / 2 ** 20, worker['seconds'],
+            worker['files'] / seconds, worker['bytes'] / 2 ** 20 / seconds))
+    return report
@@ -0,0 +1,342 @@
+import json
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+
+from extraction_manifest import save_json
+
+
+# Store Layout ########################################################################################################
+
+# A feature store is a folder with the header 'feature_store.json' and a subfolder per partition (e.g. a month of the
+# extraction), which holds one contiguous .npy array per column and the index. The arrays are opened memory mapped,
+# so loading is independent of their size and processes reading the same store share the pages of the page cache.
+#
+# Columns are encoded by their kind:
+#   numeric  - the array of the column itself (floats, integers, booleans)
+#   datetime - int64 nanoseconds since the epoch (NaT as the minimum int64) and the time zone in '<column id>.json'
+#   category - int32 codes (-1 if missing) and the values of the codes in '<column id>.json' (all other columns)
+# The index is stored as utf-8 encoded fixed width bytes.
+#
+# Numeric columns of the same dtype can instead be stored together as column-major block 'block.npy' (see the "block"
+# of the partition entry), in which every column is still contiguous. The block is a memory mapped matrix which can be
+# passed to an estimator as it is (see partition_block), without gathering the columns into a copy.
+FEATURE_STORE_FORMAT = 'feature-store-1'
+HEADER_FILE_NAME = 'feature_store.json'
+INDEX_FILE_NAME = 'index.npy'
+BLOCK_FILE_NAME = 'block.npy'
+
+
+def load_feature_store(store_path: str):
+    """ Loads the header of a feature store (an empty header if the store doesn't exist yet).
+
+    Returns:
+        header (dict) - Columns with their id and kind, and the partitions with their rows and column dtypes
+    """
+    try:
+        with open(store_path + HEADER_FILE_NAME) as header_file:
+            header = json.load(header_file)
+    except FileNotFoundError:
+        return {'format': FEATURE_STORE_FORMAT, 'columns': {}, 'partitions': []}
+    assert header['format'] == FEATURE_STORE_FORMAT, "Unknown feature store format %s." % header['format']
+    return header
+
+
+def column_kind(values):
+    """ Returns the kind of a column (see the store layout) from its dtype. """
+    if pd.api.types.is_datetime64_any_dtype(values.dtype):
+        return 'datetime'
+    if pd.api.types.is_bool_dtype(values.dtype) or pd.api.types.is_numeric_dtype(values.dtype):
+        return 'numeric'
+    return 'category'
+
+
+def encode_store_column(values):
+    """ Encodes the values of a column as array of its kind (see column_kind).
+
+    Returns:
+        array (np.ndarray), kind (str), extra (dict) - Time zone of datetime columns or values of category codes
+    """
+    kind = column_kind(values)
+    if kind == 'datetime':
+        timezone = getattr(values.dtype, 'tz', None)
+        if timezone is not None:
+            values = values.dt.tz_convert('UTC').dt.tz_localize(None)
+        array = values.to_numpy(dtype='datetime64[ns]').view(np.int64)
+        return array, kind, {'tz': None if timezone is None else str(timezone)}
+    if kind == 'numeric':
+        if isinstance(values.dtype, np.dtype):
+            return values.to_numpy(), kind, {}
+        # Nullable extension types (e.g. Int16 of the parquet flags) become floats with NaN
+        return values.to_numpy(dtype=np.float64, na_value=np.nan), kind, {}
+    codes, categories = pd.factorize(values, use_na_sentinel=True)
+    return codes.astype(np.int32), kind, {'categories': [str(category) for category in categories]}
+
+
+def decode_store_column(array: np.ndarray, kind: str, extra: dict):
+    """ Restores the values of a column from its array (see encode_store_column). Numeric columns are returned as the
+    array itself, i.e. as view of the memory map. """
+    if kind == 'numeric':
+        return array
+    if kind == 'datetime':
+        values = pd.DatetimeIndex(array.view('datetime64[ns]'))
+        return values.tz_localize('UTC').tz_convert(extra['tz']) if extra.get('tz') else values
+    categories = np.array(extra['categories'] + [np.nan], dtype=object)
+    return categories[array]
+
+
+# Partitions ##########################################################################################################
+
+def store_columns(header: dict, partition: str = None):
+    """ Returns the columns of the store (or only those of a partition) in the order they were added. """
+    columns = header['columns'] if partition is None else partition_entry(header, partition)['columns']
+    return sorted(columns, key=lambda column: header['columns'][column]['id'])
+
+
+def partition_entry(header: dict, partition: str):
+    """ Returns the header entry of a partition (None if the store has no such partition). """
+    return next((entry for entry in header['partitions'] if entry['name'] == partition), None)
+
+
+def missing_value(kind: str, dtype):
+    """ Returns the value of a missing entry in an array of the kind and dtype (see the store layout). """
+    if kind == 'datetime':
+        return np.iinfo(np.int64).min
+    if kind == 'category':
+        return -1
+    return np.nan if np.issubdtype(np.dtype(dtype), np.floating) else 0
+
+
+def open_partition_writer(store_path: str, partition: str, num_rows: int, column_dtypes: dict,
+                          block_columns: list = None):
+    """ Creates the preallocated arrays of a new partition memory mapped in a temporary folder, where they are
+    filled in place (e.g. chunk by chunk) and which is published by commit_partition. Entries which are not filled
+    stay missing (NaN, NaT or category -1).
+
+    Params:
+        store_path (str) - Folder of the feature store (created if it doesn't exist)
+        partition (str) - Unique name of the partition, e.g. the month '2020-01' of the extraction
+        num_rows (int) - Number of rows of the partition
+        column_dtypes (dict) - Column name as key and tuple of kind and dtype of its array as value
+        block_columns (list) - Numeric columns of one dtype which are stored as column-major block in this order
+
+    Returns:
+        writer (dict) - Header of the store, temporary folder and the array of each column
+    """
+    header = load_feature_store(store_path)
+    assert partition_entry(header, partition) is None, "Partition %s already exists in %s." % (partition, store_path)
+    temporary_path = store_path + partition + '.tmp/'
+    shutil.rmtree(temporary_path, ignore_errors=True)
+    os.makedirs(temporary_path)
+
+    writer = {'store_path': store_path, 'partition': partition, 'temporary_path': temporary_path,
+              'header': header, 'num_rows': num_rows, 'arrays': {}, 'extras': {},
+              'block': [str(column) for column in block_columns or []], 'block_array': None}
+    if writer['block']:
+        block_dtypes = {column_dtypes[column] for column in block_columns}
+        assert len(block_dtypes) == 1 and next(iter(block_dtypes))[0] == 'numeric', \
+            "The columns of a block have to be numeric and of the same dtype."
+        block = np.lib.format.open_memmap(temporary_path + BLOCK_FILE_NAME, mode='w+', dtype=column_dtypes[
+            block_columns[0]][1], shape=(num_rows, len(block_columns)), fortran_order=True)
+        writer['block_array'] = block
+        block_positions = {column: position for position, column in enumerate(writer['block'])}
+    for column, (kind, dtype) in column_dtypes.items():
+        column_header = header['columns'].setdefault(str(column), {'id': len(header['columns']), 'kind': kind})
+        assert column_header['kind'] == kind, "Column %s is %s in the store but %s in the partition." % (
+            column, column_header['kind'], kind)
+        if str(column) in writer['block']:
+            array = block[:, block_positions[str(column)]]
+        else:
+            array = np.lib.format.open_memmap(temporary_path + '%d.npy' % column_header['id'], mode='w+',
+                                              dtype=dtype, shape=(num_rows,))
+        array[:] = missing_value(kind, dtype)
+        writer['arrays'][str(column)] = array
+    return writer
+
+
+def commit_partition(writer: dict, index):
+    """ Publishes the partition of a writer (see open_partition_writer): the arrays are flushed, the folder is renamed
+    once complete and the header is saved atomically afterwards, so an interrupted write leaves the store as it was.
+
+    Params:
+        writer (dict) - Writer whose arrays are filled and whose "extras" hold the json of datetime/category columns
+        index (list) - Labels of the rows
+
+    Returns:
+        header (dict) - Updated header of the store
+    """
+    header, temporary_path = writer['header'], writer['temporary_path']
+    for column, array in writer['arrays'].items():
+        if column not in writer['block']:
+            array.flush()
+    if writer['block_array'] is not None:
+        writer['block_array'].flush()
+    for column, extra in writer['extras'].items():
+        save_json(folder_path=temporary_path, file_name='%d.json' % header['columns'][column]['id'],
+                  save_object=extra)
+    np.save(temporary_path + INDEX_FILE_NAME, np.array([str(label).encode('utf-8') for label in index], dtype='S'))
+    os.replace(temporary_path, writer['store_path'] + writer['partition'] + '/')
+
+    entry = {'name': writer['partition'], 'rows': writer['num_rows'],
+             'columns': {column: str(array.dtype) for column, array in writer['arrays'].items()}}
+    if writer['block']:
+        entry['block'] = writer['block']
+    header['partitions'].append(entry)
+    save_json(folder_path=writer['store_path'], file_name=HEADER_FILE_NAME, save_object=header)
+    return header
+
+
+def append_partition(store_path: str, partition: str, df):
+    """ Adds a DataFrame as new partition to the store, without touching the arrays of the existing partitions
+    (see open_partition_writer and commit_partition). Columns unknown to the store are added, columns of the store
+    missing in the partition are missing values (NaN) when the store is read.
+
+    Params:
+        store_path (str) - Folder of the feature store (created if it doesn't exist)
+        partition (str) - Unique name of the partition, e.g. the month '2020-01' of the extraction
+        df (pd.DataFrame) - Rows of the partition with unique string column names
+
+    Returns:
+        header (dict) - Updated header of the store
+    """
+    assert df.columns.is_unique, "The columns of a partition have to be unique."
+    encoded_columns = {str(column): encode_store_column(df[column]) for column in df.columns}
+    writer = open_partition_writer(store_path=store_path, partition=partition, num_rows=len(df),
+                                   column_dtypes={column: (kind, array.dtype)
+                                                  for column, (array, kind, _) in encoded_columns.items()})
+    for column, (array, _, extra) in encoded_columns.items():
+        writer['arrays'][column][:] = array
+        if extra:
+            writer['extras'][column] = extra
+    return commit_partition(writer=writer, index=df.index)
+
+
+def remove_partition(store_path: str, partition: str):
+    """ Removes a partition (e.g. to append it again after a re-extraction). The header is saved before the arrays are
+    deleted, so readers never see a partition without arrays. """
+    header = load_feature_store(store_path)
+    entry = partition_entry(header, partition)
+    if entry is None:
+        return header
+    header['partitions'].remove(entry)
+    save_json(folder_path=store_path, file_name=HEADER_FILE_NAME, save_object=header)
+    shutil.rmtree(store_path + partition + '/', ignore_errors=True)
+    return header
+
+
+def partition_arrays(store_path: str, partition: str, columns: list = None, header: dict = None):
+    """ Opens the encoded arrays of a partition memory mapped (read-only). Columns missing in the partition are left
+    out.
+
+    Returns:
+        arrays (dict) - Column name as key and memory mapped array as value
+    """
+    header = header or load_feature_store(store_path)
+    entry = partition_entry(header, partition)
+    assert entry is not None, "Partition %s doesn't exist in %s." % (partition, store_path)
+    partition_path = store_path + partition + '/'
+    block_positions = {column: position for position, column in enumerate(entry.get('block', []))}
+    block = np.load(partition_path + BLOCK_FILE_NAME, mmap_mode='r') if block_positions else None
+    return {column: (block[:, block_positions[column]] if column in block_positions else
+                     np.load(partition_path + '%d.npy' % header['columns'][column]['id'], mmap_mode='r'))
+            for column in (store_columns(header, partition) if columns is None else columns)
+            if column in entry['columns']}
+
+
+def partition_block(store_path: str, partition: str, header: dict = None):
+    """ Opens the column-major block of a partition memory mapped (read-only), e.g. as input of sklearn estimators,
+    which use it in place (see open_partition_writer).
+
+    Returns:
+        block (np.ndarray) - Matrix with one row per row of the partition and one column per block column
+        columns (list) - Columns of the block in the order of the matrix
+    """
+    header = header or load_feature_store(store_path)
+    entry = partition_entry(header, partition)
+    assert entry is not None and entry.get('block'), "Partition %s of %s has no block." % (partition, store_path)
+    return np.load(store_path + partition + '/' + BLOCK_FILE_NAME, mmap_mode='r'), list(entry['block'])
+
+
+def partition_index(store_path: str, partition: str):
+    """ Returns the index of a partition as list of strings. """
+    return [label.decode('utf-8') for label in np.load(store_path + partition + '/' + INDEX_FILE_NAME).tolist()]
+
+
+def _column_extra(store_path: str, partition: str, column_id: int):
+    try:
+        with open(store_path + partition + '/%d.json' % column_id) as extra_file:
+            return json.load(extra_file)
+    except FileNotFoundError:
+        return {}
+
+
+def read_partition(store_path: str, partition: str, columns: list = None, header: dict = None,
+                   rows: np.ndarray = None):
+    """ Reads a partition as DataFrame. Numeric columns are not copied but views of the memory maps (read-only),
+    columns of the store missing in the partition are NaN. If rows are given, only these positions are read (and
+    copied) from each column. """
+    header = header or load_feature_store(store_path)
+    columns = store_columns(header, partition) if columns is None else columns
+    arrays = partition_arrays(store_path=store_path, partition=partition, columns=columns, header=header)
+    index = partition_index(store_path, partition)
+    if rows is not None:
+        index = [index[row] for row in rows.tolist()]
+    data = {}
+    for column in columns:
+        if column not in arrays:
+            data[column] = np.full(len(index), np.nan)
+            continue
+        column_header = header['columns'][column]
+        extra = {} if column_header['kind'] == 'numeric' else _column_extra(store_path, partition, column_header['id'])
+        array = arrays[column] if rows is None else arrays[column][rows]
+        data[column] = decode_store_column(array, kind=column_header['kind'], extra=extra)
+    return pd.DataFrame(data, index=index, copy=False)
+
+
+def read_feature_store(store_path: str, columns: list = None, partitions: list = None):
+    """ Reads the partitions of the store (all if None) as one DataFrame with the columns of the store (all if None).
+    A single partition is not copied (see read_partition). """
+    header = load_feature_store(store_path)
+    columns = store_columns(header) if columns is None else columns
+    partitions = [entry['name'] for entry in header['partitions']] if partitions is None else partitions
+    frames = [read_partition(store_path=store_path, partition=partition, columns=columns, header=header)
+              for partition in partitions]
+    if len(frames) == 1:
+        return frames[0]
+    return pd.concat(frames) if frames else pd.DataFrame(columns=columns)
+
+
+def feature_store_matrix(store_path: str, columns: list, rows: np.ndarray = None, partitions: list = None,
+                         dtype=np.float32):
+    """ Gathers numeric columns of the store into a preallocated column-major matrix (the layout of the store, e.g.
+    as input of sklearn estimators), reading only the requested rows of each memory mapped column.
+
+    Params:
+        store_path (str) - Folder of the feature store
+        columns (list) - Numeric columns in the order of the matrix (missing values are NaN)
+        rows (np.ndarray) - Positions of the rows over the partitions in their order (all rows if None)
+        partitions (list) - Partitions which are read in this order (all if None)
+        dtype (np.dtype) - Type of the matrix
+
+    Returns:
+        matrix (np.ndarray) - Matrix with one row per requested row and one column per column
+    """
+    header = load_feature_store(store_path)
+    partitions = [entry['name'] for entry in header['partitions']] if partitions is None else partitions
+    num_rows = [partition_entry(header, partition)['rows'] for partition in partitions]
+    offsets = np.concatenate([[0], np.cumsum(num_rows)]).astype(np.int64)
+    rows = np.arange(offsets[-1]) if rows is None else np.asarray(rows)
+    matrix = np.full((len(rows), len(columns)), np.nan, dtype=dtype, order='F')
+    for partition_number, partition in enumerate(partitions):
+        in_partition = np.flatnonzero((rows >= offsets[partition_number]) & (rows < offsets[partition_number + 1]))
+        if not len(in_partition):
+            continue
+        local_rows = rows[in_partition] - offsets[partition_number]
+        arrays = partition_arrays(store_path=store_path, partition=partition, columns=columns, header=header)
+        for position, column in enumerate(columns):
+            if column in arrays:
+                assert header['columns'][column]['kind'] == 'numeric', "Column %s is not numeric." % column
+                matrix[in_partition, position] = arrays[column][local_rows]
+    return matrix
@@ -0,0 +1,342 @@
+import asyncio
+import concurrent.futures
+import contextlib
+import functools
+import os
+import time
+
+import numpy as np
+import pandas as pd
+from lxml import etree
+
+from xml2dict import extraction_file_id, xml_extraction_complete_compose
+
+
+# Notification Feed ###################################################################################################
+
+# Feed of the DMS listing the payloads of the last days (&time=<n>d) with their path as title and their url as link
+NOTIFICATION_FEED_URL = ('http://dms.cmc.ec.gc.ca:8180/notification?path=/msc/observation/atmospheric/surface_weather/'
+                         'ca-1.1-ascii/decoded_qa_enhanced-xml-2.0&time=%s')
+# Supporting xmls (e.g. daily summaries) are listed in the same feed but are no hourly observations
+EXCLUDED_TITLE_WORDS = ('supp_1440',)
+
+
+def notification_feed_urls(days: int = 1):
+    """ Returns the feed urls of the last days like the Detection notebook (the windows overlap, see parse_feed_items).
+    """
+    return [NOTIFICATION_FEED_URL % ('%dd' % day) for day in range(1, days + 1)]
+
+
+def parse_feed_items(feed_content: bytes):
+    """ Parses the items of a notification feed (RSS <item> or Atom <entry>) into their title and link.
+
+    Returns:
+        items (list) - Tuples of title (path of the payload) and url of the payload
+    """
+    root = etree.fromstring(feed_content, parser=etree.XMLParser(recover=True, huge_tree=True))
+    items = []
+    if root is None:
+        return items
+    for node in root.iter('{*}item', '{*}entry'):
+        title = node.find('{*}title')
+        link = node.find('{*}link')
+        if title is None or link is None:
+            continue
+        url = (link.text or link.get('href') or '').strip()
+        if url:
+            items.append(((title.text or '').strip(), url))
+    return items
+
+
+def feed_item_station(title: str):
+    """ Returns the station (tc identifier) of a feed item from its title, e.g. '/20200101T0000/wic/...' -> 'wic'. """
+    parts = title.split('/')
+    return parts[2].lower() if len(parts) > 2 else None
+
+
+def select_feed_items(items: list, fetched_urls: set, station_ids: set = None,
+                      excluded_title_words=EXCLUDED_TITLE_WORDS):
+    """ Selects the items which are not yet fetched, belong to one of the stations (all if None) and are no supporting
+    xmls. Items listed several times (the feed windows overlap) are only selected once.
+
+    Returns:
+        urls (list) - Urls of the payloads to fetch
+        num_known (int) - Number of items which were already fetched
+    """
+    urls = []
+    selected = set()
+    num_known = 0
+    for title, url in items:
+        if any(word in title for word in excluded_title_words):
+            continue
+        if station_ids is not None and feed_item_station(title) not in station_ids:
+            continue
+        if url in fetched_urls:
+            num_known += 1
+        elif url not in selected:
+            selected.add(url)
+            urls.append(url)
+    return urls, num_known
+
+
+def load_fetched_urls(state_path: str):
+    """ Loads the urls which were fetched by previous runs (one url per line, empty set if there is no state). """
+    if state_path is None or not os.path.exists(state_path):
+        return set()
+    with open(state_path) as state_file:
+        return {line.strip() for line in state_file if line.strip()}
+
+
+def save_fetched_urls(state_path: str, urls: list):
+    """ Appends newly fetched urls to the state file, so they are not fetched again by the next run. """
+    if state_path is None or not urls:
+        return
+    with open(state_path, 'a') as state_file:
+        state_file.write(''.join(url + '\n' for url in urls))
+
+
+# Columnar Buffer #####################################################################################################
+
+def new_observation_buffer(capacity: int = 4096):
+    """ Returns an empty buffer holding the extractions as preallocated object column per key. Rows are written in
+    place and the columns are only reallocated (doubled) when the capacity is exceeded, so appending an observation
+    never copies the previous rows like DataFrame.append. """
+    return {'size': 0, 'capacity': capacity, 'file_ids': [], 'columns': {}}
+
+
+def append_observation(buffer: dict, station_data: dict):
+    """ Writes an extraction dictionary into the next row of the buffer. Unknown keys get a new column which is NaN
+    for all previous rows. """
+    if buffer['size'] == buffer['capacity']:
+        capacity = 2 * buffer['capacity']
+        for key, column in buffer['columns'].items():
+            grown_column = np.full(capacity, np.nan, dtype=object)
+            grown_column[:buffer['size']] = column[:buffer['size']]
+            buffer['columns'][key] = grown_column
+        buffer['capacity'] = capacity
+
+    row = buffer['size']
+    columns = buffer['columns']
+    for key, value in station_data.items():
+        column = columns.get(key)
+        if column is None:
+            column = columns[key] = np.full(buffer['capacity'], np.nan, dtype=object)
+        column[row] = value
+    buffer['file_ids'].append(extraction_file_id(station_data))
+    buffer['size'] += 1
+    return buffer
+
+
+def buffer_to_dataframe(buffer: dict):
+    """ Creates the DataFrame of the buffered observations with the unique file id as index (the same as
+    pd.DataFrame.from_dict(records, orient='index') of the extraction dictionaries). """
+    size = buffer['size']
+    return pd.DataFrame({key: column[:size] for key, column in buffer['columns'].items()},
+                        index=buffer['file_ids'])
+
+
+# Async Ingestion #####################################################################################################
+
+def _import_aiohttp():
+    try:
+        import aiohttp
+    except ImportError:
+        raise ImportError("The ingestion of the notification feed requires the package aiohttp.")
+    return aiohttp
+
+
+async def fetch_content(session, url: str, retries: int = 2, backoff_seconds: float = 0.5):
+    """ Fetches the content of an url with the pooled session and retries connection errors and server errors.
+
+    Returns:
+        content (bytes) - Body of the response or None if it failed
+    """
+    aiohttp = _import_aiohttp()
+    for attempt in range(retries + 1):
+        try:
+            async with session.get(url) as response:
+                if response.status < 500:
+                    response.raise_for_status()
+                    return await response.read()
+        except aiohttp.ClientResponseError:
+            return None
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            pass
+        if attempt < retries:
+            await asyncio.sleep(backoff_seconds * 2 ** attempt)
+    return None
+
+
+def extract_payload(url: str, content: bytes, backend: str = 'lxml',
+                    qa_category_list=('presence', 'range', 'integrity', 'intervariable_comparison', 'temporal'),
+                    output_subtests: bool = True, native_codes: bool = True):
+    """ Extracts a fetched payload (see xml2dict.xml_extraction_complete_compose), runs in the parse executor.
+
+    Returns:
+        station_data (dict) - Extraction dictionary or None if the payload is no observation
+    """
+    try:
+        station_data = xml_extraction_complete_compose(xml_path=url,
+                                                       qa_category_list=qa_category_list,
+                                                       output_subtests=output_subtests,
+                                                       native_codes=native_codes,
+                                                       backend=backend,
+                                                       xml_content=content)
+    except (etree.XMLSyntaxError, KeyError, AttributeError, IndexError):
+        return None
+    return station_data if 'source_uri' in station_data else None
+
+
+def new_parse_executor(parse_workers: int = None):
+    """ Returns the executor the payloads are extracted in, so the parsing doesn't block the event loop while the
+    other payloads are fetched: a pool of parse_workers processes (all cores if None) or None for the default thread
+    pool of the event loop if parse_workers is 0 (the extraction then shares the GIL with the fetches). """
+    if parse_workers == 0:
+        return None
+    return concurrent.futures.ProcessPoolExecutor(max_workers=parse_workers)
+
+
+async def ingest_payloads(session, urls: list, buffer: dict, max_concurrency: int = 32, backend: str = 'lxml',
+                          executor: concurrent.futures.Executor = None, **extraction_kwargs):
+    """ Fetches the payloads with at most max_concurrency requests at once and extracts each payload as soon as it
+    arrives into the buffer. The extraction runs in the executor (see new_parse_executor), so at most max_concurrency
+    payloads are fetched or parsed at once and the event loop only writes the extracted dictionaries to the buffer.
+
+    Params:
+        extraction_kwargs - qa_category_list, output_subtests and native_codes (see extract_payload)
+
+    Returns:
+        fetched_urls (list) - Urls which were fetched and extracted
+        failed_urls (list) - Urls which could not be fetched or extracted
+    """
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue()
+    for url in urls:
+        queue.put_nowait(url)
+    fetched_urls = []
+    failed_urls = []
+
+    async def worker():
+        while True:
+            try:
+                url = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            content = await fetch_content(session, url)
+            station_data = None
+            if content:
+                station_data = await loop.run_in_executor(executor, functools.partial(
+                    extract_payload, url, content, backend=backend, **extraction_kwargs))
+            if station_data is None:
+                failed_urls.append(url)
+                continue
+            append_observation(buffer=buffer, station_data=station_data)
+            fetched_urls.append(url)
+
+    await asyncio.gather(*(worker() for _ in range(min(max_concurrency, len(urls)))))
+    return fetched_urls, failed_urls
+
+
+async def poll_notification_feed(feed_urls: list,
+                                 buffer: dict,
+                                 fetched_urls: set,
+                                 station_ids: set = None,
+                                 max_concurrency: int = 32,
+                                 interval_seconds: float = 300,
+                                 max_polls: int = 1,
+                                 state_path: str = None,
+                                 backend: str = 'lxml',
+                                 parse_workers: int = None,
+                                 **extraction_kwargs):
+    """ Polls the notification feeds and ingests all new payloads into the buffer.
+
+    All requests share a single session whose connection pool keeps at most max_concurrency connections open, so the
+    payloads of the same host are fetched over reused connections. The payloads are extracted in a pool of processes
+    which is kept for all polls.
+
+    Params:
+        feed_urls (list) - Urls of the notification feeds (see notification_feed_urls)
+        buffer (dict) - Columnar buffer the extractions are written to (see new_observation_buffer)
+        fetched_urls (set) - Urls which are already fetched, is updated with the newly fetched ones
+        station_ids (set) - Lower case tc identifiers of the stations to ingest (all if None)
+        max_concurrency (int) - Maximum number of concurrent requests
+        interval_seconds (float) - Seconds between the start of two polls
+        max_polls (int) - Number of polls (None polls until cancelled)
+        state_path (str) - File the fetched urls are appended to (see load_fetched_urls)
+        backend ("bs4"/"lxml") - Parser used for the extraction (lxml by default for the latency)
+        parse_workers (int) - Number of processes extracting the payloads (see new_parse_executor)
+        extraction_kwargs - qa_category_list, output_subtests and native_codes (see xml_extraction_complete_compose)
+
+    Returns:
+        stats (list) - Dictionary with the new, known and failed items and seconds of each poll
+    """
+    aiohttp = _import_aiohttp()
+    stats = []
+    connector = aiohttp.TCPConnector(limit=max_concurrency, ttl_dns_cache=300)
+    timeout = aiohttp.ClientTimeout(total=60)
+    # The processes are kept for all polls and shut down when polling ends (also when it is cancelled)
+    with new_parse_executor(parse_workers) or contextlib.nullcontext() as executor:
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+            poll = 0
+            while max_polls is None or poll < max_polls:
+                start_time = time.time()
+                feed_contents = await asyncio.gather(*(fetch_content(session, feed_url) for feed_url in feed_urls))
+                items = [item for feed_content in feed_contents if feed_content
+                         for item in parse_feed_items(feed_content)]
+                urls, num_known = select_feed_items(items=items, fetched_urls=fetched_urls, station_ids=station_ids)
+                new_urls, failed_urls = await ingest_payloads(session=session,
+                                                              urls=urls,
+                                                              buffer=buffer,
+                                                              max_concurrency=max_concurrency,
+                                                              backend=backend,
+                                                              executor=executor,
+                                                              **extraction_kwargs)
+                fetched_urls.update(new_urls)
+                save_fetched_urls(state_path=state_path, urls=new_urls)
+
+                seconds = time.time() - start_time
+                stats.append({'new': len(new_urls), 'known': num_known, 'failed': len(failed_urls), 'seconds': seconds})
+                print("--- Ingested %d new observations (%d known, %d failed) in %.1f s (%.0f per minute).---" % (
+                    len(new_urls), num_known, len(failed_urls), seconds, 60 * len(new_urls) / max(seconds, 1e-9)))
+                poll += 1
+                if max_polls is None or poll < max_polls:
+                    await asyncio.sleep(max(interval_seconds - seconds, 0))
+    return stats
+
+
+def ingest_notification_feed(feed_urls: list = None,
+                             station_ids: list = None,
+                             max_concurrency: int = 32,
+                             state_path: str = None,
+                             backend: str = 'lxml',
+                             parse_workers: int = None,
+                             **extraction_kwargs):
+    """ Ingests all new payloads of the notification feeds once and returns them as DataFrame (replaces the loop of
+    requests.get and DataFrame.append in the Detection notebook).
+
+    Params:
+        feed_urls (list) - Urls of the notification feeds (the last day if not given, see notification_feed_urls)
+        station_ids (list) - Tc identifiers of the stations to ingest (all if None)
+        max_concurrency (int) - Maximum number of concurrent requests
+        state_path (str) - File with the urls fetched by previous runs, which are skipped and extended
+        backend ("bs4"/"lxml") - Parser used for the extraction
+        parse_workers (int) - Number of processes extracting the payloads (see new_parse_executor)
+        extraction_kwargs - qa_category_list, output_subtests and native_codes (see xml_extraction_complete_compose)
+
+    Returns:
+        df (pd.DataFrame) - One row per new observation with the unique file id as index
+    """
+    buffer = new_observation_buffer()
+    if station_ids is not None:
+        station_ids = {station.lower() for station in station_ids}
+    asyncio.run(poll_notification_feed(feed_urls=feed_urls or notification_feed_urls(),
+                                       buffer=buffer,
+                                       fetched_urls=load_fetched_urls(state_path),
+                                       station_ids=station_ids,
+                                       max_concurrency=max_concurrency,
+                                       max_polls=1,
+                                       state_path=state_path,
+                                       backend=backend,
+                                       parse_workers=parse_workers,
+                                       **extraction_kwargs))
+    return buffer_to_dataframe(buffer)
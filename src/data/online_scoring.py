@@ -0,0 +1,235 @@
+import queue
+import threading
+import time
+
+import numpy as np
+
+from xml2dict import extraction_file_id, read_pickle, save_pickle, xml_extraction_complete_compose
+
+
+# Feature Layout ######################################################################################################
+
+# Features the notebooks derive from date_time (hour_of_day in Train_and_test, the date parts in Detection)
+TIME_FEATURES = {'hour_of_day': (11, 13), 'yearz': (0, 4), 'monthz': (5, 7), 'dayz': (8, 10)}
+# Dummy columns of the station created by pd.get_dummies(df.tc_identifier, prefix="station") in convert_datatypes
+STATION_PREFIX = 'station_'
+# Keys of the extraction with the same prefix which are no station dummies (besides the sensors like station_pressure)
+STATION_METADATA = ('station_elevation', 'station_identifier', 'station_name', 'station_time_identifier')
+NATIVE_CODES = {'N': 0.0, 'Y': 1.0}
+
+
+def is_station_dummy(column: str):
+    """ Checks if a column is a station dummy ('station_<tc_identifier>') and no key of the extraction. """
+    return column.startswith(STATION_PREFIX) and column.count('_') == 1 and column not in STATION_METADATA
+
+
+def compile_feature_layout(feature_columns: list, fill_value: float = np.nan):
+    """ Compiles the columns a model was trained on into a fixed layout, which maps an extraction dictionary directly
+    to the feature vector without building a DataFrame.
+
+    Each column is one of: a time feature (see TIME_FEATURES), a station dummy ('station_<tc_identifier>'), a native
+    code (mapped N/Y to 0/1) or a numeric key of the extraction (converted like pd.to_numeric(errors='coerce')).
+
+    Params:
+        feature_columns (list) - Columns of the training data in the order of the model input
+        fill_value (float) - Value of missing or unparsable features
+
+    Returns:
+        layout (dict) - Columns, fill value and positions of each kind of feature
+    """
+    layout = {'columns': list(feature_columns), 'fill_value': fill_value,
+              'numeric': [], 'native': [], 'stations': {}, 'time': []}
+    for position, column in enumerate(feature_columns):
+        if column in TIME_FEATURES:
+            layout['time'].append((position, TIME_FEATURES[column]))
+        elif is_station_dummy(column):
+            layout['stations'][column[len(STATION_PREFIX):]] = position
+        elif 'native' in column:
+            layout['native'].append((position, column))
+        else:
+            layout['numeric'].append((position, column))
+    return layout
+
+
+def features_from_record(station_data: dict, layout: dict, out: np.ndarray = None):
+    """ Maps an extraction dictionary (see xml2dict.xml_extraction_complete_compose) to its feature vector.
+
+    Params:
+        station_data (dict) - Extraction dictionary of a single xml
+        layout (dict) - Feature layout of the model (see compile_feature_layout)
+        out (np.ndarray) - Row the features are written to (a new vector if not given)
+
+    Returns:
+        features (np.ndarray) - Float vector in the column order of the layout
+    """
+    if out is None:
+        out = np.empty(len(layout['columns']), dtype=np.float64)
+    out.fill(layout['fill_value'])
+
+    for position, key in layout['numeric']:
+        value = station_data.get(key)
+        if value is not None:
+            try:
+                out[position] = float(value)
+            except ValueError:
+                pass
+    for position, key in layout['native']:
+        out[position] = NATIVE_CODES.get(station_data.get(key), layout['fill_value'])
+    if layout['stations']:
+        for position in layout['stations'].values():
+            out[position] = 0.0
+        station_position = layout['stations'].get(station_data.get('tc_identifier'))
+        if station_position is not None:
+            out[station_position] = 1.0
+    date_time = station_data.get('date_time') or ''
+    for position, (start, end) in layout['time']:
+        if date_time[start:end].isdigit():
+            out[position] = float(date_time[start:end])
+    return out
+
+
+def feature_matrix(records: list, layout: dict):
+    """ Maps a list of extraction dictionaries into a preallocated feature matrix (one row per record). """
+    matrix = np.empty((len(records), len(layout['columns'])), dtype=np.float64)
+    for row, station_data in enumerate(records):
+        features_from_record(station_data=station_data, layout=layout, out=matrix[row])
+    return matrix
+
+
+# Scoring Model #######################################################################################################
+
+def save_scoring_model(folder_path: str, file_name: str, model, feature_columns: list = None,
+                       fill_value: float = np.nan):
+    """ Saves a fitted model together with its compiled feature layout. The columns are taken from the model
+    (feature_names_in_ of sklearn estimators fitted on a DataFrame) if not given. """
+    if feature_columns is None:
+        feature_columns = getattr(model, 'feature_names_in_', None)
+    assert feature_columns is not None, "The feature columns of the model are unknown and have to be given."
+    scoring_model = {'model': model, 'layout': compile_feature_layout(feature_columns, fill_value=fill_value)}
+    save_pickle(folder_path=folder_path, file_name=file_name, save_object=scoring_model)
+    return scoring_model
+
+
+def load_scoring_model(file: str):
+    """ Loads a model saved with save_scoring_model. """
+    return read_pickle(file=file)
+
+
+def score_records(scoring_model: dict, records: list, probability: bool = False):
+    """ Scores a batch of extraction dictionaries with a single predict call.
+
+    Returns:
+        predictions (np.ndarray) - Prediction (or probability of the positive class if probability) per record
+    """
+    matrix = feature_matrix(records=records, layout=scoring_model['layout'])
+    if probability:
+        return scoring_model['model'].predict_proba(matrix)[:, 1]
+    return scoring_model['model'].predict(matrix)
+
+
+def score_xml(scoring_model: dict, xml_content: bytes, xml_path: str = None, backend: str = 'lxml',
+              probability: bool = False):
+    """ Extracts a single payload (e.g. from the notification feed) and scores it.
+
+    Returns:
+        station_data (dict), prediction
+    """
+    station_data = xml_extraction_complete_compose(xml_path=xml_path, backend=backend, xml_content=xml_content)
+    return station_data, score_records(scoring_model, [station_data], probability=probability)[0]
+
+
+# Micro-Batching ######################################################################################################
+
+def read_stream(records, arrivals: queue.Queue, stop: threading.Event):
+    """ Puts every record of the stream with its arrival time into the queue and finally None (or the exception which
+    ended the stream), runs in the reader thread of score_stream. No further record is requested once stop is set. """
+    try:
+        for station_data in records:
+            arrivals.put((station_data, time.perf_counter()))
+            if stop.is_set():
+                return
+    except Exception as exception:
+        arrivals.put(exception)
+    else:
+        arrivals.put(None)
+
+
+def score_stream(scoring_model: dict, records, max_batch_size: int = 64, max_wait_seconds: float = 0.5,
+                 probability: bool = False, latencies: dict = None):
+    """ Generator which scores arriving extraction dictionaries in micro-batches. A batch is scored as soon as it has
+    max_batch_size records or its first record waited max_wait_seconds, and at the end of the stream.
+
+    The records are read by a background thread, so the deadline of a batch is kept even if no further record arrives
+    (e.g. a single hourly observation), as long as the caller iterates over the predictions. If the generator is
+    closed (or garbage collected) before the end of the stream, the thread stops reading the records and is joined,
+    which waits for the record it is currently reading.
+
+    Params:
+        scoring_model (dict) - Model with its feature layout (see load_scoring_model)
+        records (iterable) - Extraction dictionaries in the order of their arrival
+        max_batch_size (int) - Maximum number of records per predict call
+        max_wait_seconds (float) - Maximum time the first record of a batch waits for further records
+        probability (bool) - Indicator if the probability of the positive class is returned
+        latencies (dict) - Dictionary whose lists "observation" and "batch" are extended by the latencies in seconds
+
+    Yields:
+        unique_file_id (str), prediction
+    """
+    if latencies is None:
+        latencies = {}
+    latencies.setdefault('observation', [])
+    latencies.setdefault('batch', [])
+    batch = []
+    arrival_times = []
+
+    def flush():
+        start_time = time.perf_counter()
+        predictions = score_records(scoring_model, batch, probability=probability)
+        end_time = time.perf_counter()
+        latencies['batch'].append(end_time - start_time)
+        latencies['observation'].extend(end_time - arrival_time for arrival_time in arrival_times)
+        return [(extraction_file_id(station_data), prediction) for station_data, prediction in zip(batch, predictions)]
+
+    arrivals = queue.Queue()
+    stop = threading.Event()
+    reader = threading.Thread(target=read_stream, args=(records, arrivals, stop), name='score_stream_reader',
+                              daemon=True)
+    reader.start()
+    try:
+        while True:
+            try:
+                if batch:
+                    arrival = arrivals.get(timeout=max(arrival_times[0] + max_wait_seconds - time.perf_counter(), 0))
+                else:
+                    arrival = arrivals.get()
+            except queue.Empty:
+                # The first record of the batch reached its deadline
+                yield from flush()
+                batch, arrival_times = [], []
+                continue
+            if arrival is None or isinstance(arrival, Exception):
+                break
+            batch.append(arrival[0])
+            arrival_times.append(arrival[1])
+            if len(batch) >= max_batch_size or time.perf_counter() - arrival_times[0] >= max_wait_seconds:
+                yield from flush()
+                batch, arrival_times = [], []
+        if batch:
+            yield from flush()
+    finally:
+        stop.set()
+        reader.join()
+    if arrival is not None:
+        raise arrival
+
+
+def latency_report(latencies: dict):
+    """ Prints and returns the p50 and p99 latency in milliseconds per observation and per batch. """
+    report = {}
+    for name, values in latencies.items():
+        if not values:
+            continue
+        p50, p99 = np.percentile(np.array(values) * 1000, [50, 99])
+        report[name] = {'count': len(values), 'p50_ms': p50, 'p99_ms': p99}
+        print("--- Latency per %s: p50 %.2f ms, p99 %.2f ms (%d).---" % (name, p50, p99, len(values)))
+    return report
@@ -0,0 +1,110 @@
+import csv
+import gzip
+import io
+import os
+
+
+# Export Files ########################################################################################################
+
+# Columns of the data_payload_all export (see SQL/historic_getter.sql) holding the uri and the xml of a payload
+EXPORT_URI_COLUMN = 'data_payload_uri'
+EXPORT_CONTENT_COLUMN = 'data_payload_content'
+
+GZIP_MAGIC = b'\x1f\x8b'
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+
+
+def open_export(export_path: str):
+    """ Opens a bulk export as text stream for the csv reader. Gzip and zstd compressed exports are detected by their
+    first bytes and decompressed while reading, so the export is never unpacked on disk.
+
+    Zstd requires the optional package zstandard.
+    """
+    with open(export_path, 'rb') as export:
+        magic = export.read(4)
+
+    if magic.startswith(GZIP_MAGIC):
+        binary = gzip.open(export_path, 'rb')
+    elif magic.startswith(ZSTD_MAGIC):
+        try:
+            import zstandard
+        except ImportError:
+            raise ImportError("Reading the zstd compressed export %s requires the package zstandard." % export_path)
+        binary = io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(open(export_path, 'rb'), closefd=True))
+    else:
+        binary = open(export_path, 'rb')
+    return io.TextIOWrapper(binary, encoding='utf-8-sig', newline='')
+
+
+def payload_content_bytes(content: str):
+    """ Returns the xml of an exported payload as bytes. Blob columns can be exported as hex strings, which are decoded.
+
+    Returns:
+        xml_content (bytes) - Content of the payload or None if it is no xml
+    """
+    content = content.strip()
+    if content.startswith('<'):
+        return content.encode('utf-8')
+    try:
+        content = bytes.fromhex(content).lstrip(b'\xef\xbb\xbf \t\r\n')
+    except ValueError:
+        return None
+    return content if content.startswith(b'<') else None
+
+
+def iter_export_payloads(export_path: str, delimiter: str = ',', quotechar: str = '"'):
+    """ Generator which reads a bulk export sequentially and yields one payload after the other.
+
+    The export is a delimited text file (csv or a loader file with e.g. delimiter '|') with a header row which contains
+    at least the columns data_payload_uri and data_payload_content. The xml content can span multiple lines as long as
+    it is enclosed by the quotechar.
+
+    Params:
+        export_path (str) - Path of the (optionally gzip or zstd compressed) export
+        delimiter (str) - Field delimiter of the export
+        quotechar (str) - Character enclosing fields with delimiters or line breaks
+
+    Yields:
+        data_payload_uri (str), xml_content (bytes)
+    """
+    # Payloads are much larger than the default field size limit of the csv module
+    csv.field_size_limit(max(csv.field_size_limit(), 2 ** 31 - 1))
+    with open_export(export_path) as export:
+        reader = csv.DictReader(export, delimiter=delimiter, quotechar=quotechar)
+        reader.fieldnames = [column.strip().lower() for column in reader.fieldnames or []]
+        assert EXPORT_URI_COLUMN in reader.fieldnames and EXPORT_CONTENT_COLUMN in reader.fieldnames, \
+            "Export %s needs the columns %s and %s." % (export_path, EXPORT_URI_COLUMN, EXPORT_CONTENT_COLUMN)
+
+        for row in reader:
+            xml_content = payload_content_bytes(row[EXPORT_CONTENT_COLUMN] or '')
+            if xml_content is None:
+                print("Payload %s is no xml and is skipped." % row[EXPORT_URI_COLUMN])
+                continue
+            yield row[EXPORT_URI_COLUMN], xml_content
+
+
+def export_payload_chunks(payloads, chunksize: int = 1000):
+    """ Generator which groups successive payloads to chunks named '<start>_to_<end>' like list_chunking.
+
+    Yields:
+        chunk_name (str), payload_list (list)
+    """
+    chunk = []
+    start_item = 0
+    for payload in payloads:
+        chunk.append(payload)
+        if len(chunk) >= chunksize:
+            yield str(start_item) + '_to_' + str(start_item + len(chunk)), chunk
+            start_item += len(chunk)
+            chunk = []
+    if chunk:
+        yield str(start_item) + '_to_' + str(start_item + len(chunk)), chunk
+
+
+def export_name(export_path: str):
+    """ Returns the file name of an export without the compression and file endings. """
+    file_name = os.path.basename(export_path)
+    for ending in ('.gz', '.zst', '.csv', '.ldr', '.dsv', '.txt'):
+        if file_name.endswith(ending):
+            file_name = file_name[:-len(ending)]
+    return file_name
@@ -0,0 +1,218 @@
+import datetime
+import os
+import random
+
+
+# Synthetic Payloads ##################################################################################################
+
+# Sensors of the generated observations: name, orig-name, mean and spread of the value and number of decimals
+SYNTHETIC_SENSORS = [('air_temperature', '12', -5.0, 10.0, 1),
+                     ('dew_point', '13', -8.0, 10.0, 1),
+                     ('relative_humidity', '14', 70.0, 20.0, 0),
+                     ('station_pressure', '2', 98.5, 1.5, 3),
+                     ('mean_sea_level_pressure', '3', 101.3, 1.5, 3),
+                     ('wind_speed', '24', 15.0, 10.0, 1),
+                     ('wind_direction', '25', 180.0, 100.0, 0),
+                     ('wind_gust_speed', '26', 25.0, 10.0, 1),
+                     ('precipitation_amount', '31', 0.5, 1.0, 1),
+                     ('snow_depth', '3022', 20.0, 15.0, 0),
+                     ('visibility', '40', 20.0, 5.0, 1),
+                     ('total_cloud_amount', '45', 5.0, 3.0, 0)]
+SYNTHETIC_QA_CATEGORIES = ['presence', 'range', 'integrity', 'intervariable_comparison', 'temporal']
+# Flag values (see xml2dict.QA_FLAG_COUNT_NAMES) with their share of all assessments
+SYNTHETIC_FLAG_WEIGHTS = {'100': 0.9, '10': 0.04, '0': 0.03, '-1': 0.02, '-10': 0.01}
+SYNTHETIC_NAMESPACES = ('xmlns="http://dms.ec.gc.ca/schema/point-observation/2.1" '
+                        'xmlns:om="http://www.opengis.net/om/1.0" xmlns:xlink="http://www.w3.org/1999/xlink"')
+SOURCE_URI_PREFIX = '/data/msc/observation/atmospheric/surface_weather/ca-1.1-ascii/decoded_qa_enhanced-xml-2.0/'
+
+
+def synthetic_source_uri(tc_identifier: str, station_identifier: str, timestamp: datetime.datetime, version: int):
+    """ Returns the source uri of a payload in the layout used by the archive. """
+    return SOURCE_URI_PREFIX + '%s/%s/%s/orig/data_%d' % (timestamp.strftime('%Y%m%d%H%M'), station_identifier,
+                                                          tc_identifier, version)
+
+
+def synthetic_flag(rng: random.Random):
+    """ Draws a QA flag value with the shares of SYNTHETIC_FLAG_WEIGHTS. """
+    return rng.choices(list(SYNTHETIC_FLAG_WEIGHTS), weights=list(SYNTHETIC_FLAG_WEIGHTS.values()))[0]
+
+
+def synthetic_observation(rng: random.Random, sensor: tuple, element_index: int, num_subtests: int,
+                          status_indicators: bool = False, sensor_index: int = None):
+    """ Creates a single observation (<element> with element-index) with native codes, QA results per category and
+    optionally the status-indicators of a manual correction.
+
+    Returns:
+        observation (str), overall_qa_summary (str)
+    """
+    name, orig_name, mean, spread, decimals = sensor
+    value = '%.*f' % (decimals, rng.gauss(mean, spread))
+    qualifiers = ''
+    if sensor_index is not None:
+        qualifiers = '<qualifier name="sensor_index" value="%d" uom="unitless"/>' % sensor_index
+
+    category_flags = []
+    categories = ''
+    for category in SYNTHETIC_QA_CATEGORIES:
+        subtest_flags = [synthetic_flag(rng) for _ in range(num_subtests)]
+        category_flag = min(subtest_flags, key=lambda flag: SYNTHETIC_FLAG_WEIGHTS[flag]) if subtest_flags else '100'
+        category_flags.append(category_flag)
+        subtests = ''.join('<element name="qa_test" group="assessment" value="/qa/tests/%s/%d/%d">'
+                           '<qualifier name="flag_value" value="%s" group="assessment"/></element>'
+                           % (category, element_index, 100 + subtest_num, flag)
+                           for subtest_num, flag in enumerate(subtest_flags))
+        categories += '<element name="%s_summary" group="assessment" value="%s">%s</element>' % (
+            category, category_flag, subtests)
+    overall_flag = min(category_flags, key=lambda flag: SYNTHETIC_FLAG_WEIGHTS[flag])
+
+    status = ''
+    if status_indicators:
+        if rng.random() < 0.5:
+            override = '<element name="qa_flag_override" value="%s"/>' % rng.choice(['100', '0', '-10'])
+        else:
+            override = '<element name="value_override" value="%s"/>' % value
+        status = '<status-indicators>%s<element name="qc_remark" value="%s"/></status-indicators>' % (
+            override, rng.choice(['sensor fault', 'checked ok', 'snow on sensor']))
+
+    observation = ('<element name="%s" orig-name="%s" element-index="%d" value="%s" orig-value="%s" uom="unit" '
+                   'group="measured" std-pkg-id="1.0.%s">%s'
+                   '<quality-controlled><native>'
+                   '<qualifier name="error" group="quality" value="%s"/>'
+                   '<qualifier name="suspect" group="quality" value="N"/>'
+                   '<qualifier name="suppressed" group="value" value="N"/>'
+                   '</native><real-time>'
+                   '<element name="overall_qa_summary" group="assessment" value="%s">%s</element>'
+                   '</real-time></quality-controlled>%s</element>'
+                   % (name, orig_name, element_index, value, value, orig_name, qualifiers,
+                      rng.choice(['N', 'N', 'N', 'Y']), overall_flag, categories, status))
+    return observation, overall_flag
+
+
+def synthetic_xml(tc_identifier: str = 'wic',
+                  station_identifier: str = '2402604',
+                  timestamp: datetime.datetime = datetime.datetime(2019, 1, 1),
+                  version: int = 0,
+                  num_sensors: int = 12,
+                  num_subtests: int = 3,
+                  status_indicators: bool = True,
+                  seed: int = 0):
+    """ Creates a synthetic decoded_qa_enhanced-xml-2.0 payload which both extraction backends accept.
+
+    Version 0 contains all sensors, derived values and the qa_summary counts of the flags. Corrected versions only
+    contain a part of the sensors, which have status-indicators with an override and a qc remark if status_indicators.
+
+    Params:
+        tc_identifier (str) - Three letter identifier of the station
+        station_identifier (str) - Climate identifier of the station
+        timestamp (datetime) - Observation time
+        version (int) - Version of the payload (0 = original, >0 = manual correction)
+        num_sensors (int) - Number of observations (sensors are repeated with dummy_bypass_sensor if necessary)
+        num_subtests (int) - Number of subtests per QA category
+        status_indicators (bool) - Indicator if corrected versions contain status-indicators
+        seed (int) - Seed of the random values, the same arguments always create the same payload
+
+    Returns:
+        xml (str)
+    """
+    rng = random.Random('%s-%s-%s-%d-%d' % (tc_identifier, station_identifier, timestamp.isoformat(), version, seed))
+    observations = []
+    flags = []
+    for element_index in range(1, num_sensors + 1):
+        if version > 0 and rng.random() < 0.7:
+            continue
+        if element_index <= len(SYNTHETIC_SENSORS):
+            sensor, sensor_index = SYNTHETIC_SENSORS[element_index - 1], None
+        else:
+            sensor, sensor_index = ('dummy_bypass_sensor', '999', 0.0, 1.0, 0), element_index
+        observation, flag = synthetic_observation(rng=rng,
+                                                  sensor=sensor,
+                                                  element_index=element_index,
+                                                  num_subtests=num_subtests,
+                                                  status_indicators=status_indicators and version > 0,
+                                                  sensor_index=sensor_index)
+        observations.append(observation)
+        flags.append(flag)
+
+    derived = ''
+    if version == 0:
+        derived = ('<element name="relative_humidity" value="%d" group="calculated" std-pkg-id="9.1">'
+                   '<qualifier name="method" value="derived"/></element>'
+                   '<element name="maximum_air_temperature_time" value="%s" group="calculated" std-pkg-id="9.2"/>'
+                   % (rng.randint(20, 100), timestamp.strftime('%H%M')))
+
+    identification = [('date_time', timestamp.strftime('%Y-%m-%dT%H:%M:%S.000Z')),
+                      ('tc_identifier', tc_identifier.upper()),
+                      ('station_name', 'SYNTHETIC %s' % tc_identifier.upper()),
+                      ('station_elevation', '%.1f' % rng.uniform(0, 1500)),
+                      ('latitude', '%.4f' % rng.uniform(42, 82)),
+                      ('longitude', '%.4f' % rng.uniform(-140, -52)),
+                      ('version', str(version)),
+                      ('correction', '0' if version == 0 else 'CC%s' % chr(ord('A') + version - 1)),
+                      ('source_uri', synthetic_source_uri(tc_identifier, station_identifier, timestamp, version)),
+                      ('station_identifier', station_identifier)]
+    qa_summary = [('missing_count', flags.count('-1')),
+                  ('erroneous_count', flags.count('0')),
+                  ('accepted_count', flags.count('100')),
+                  ('suppressed_count', flags.count('-10')),
+                  ('doubtful_count', flags.count('10')),
+                  ('elements_quality_assessed_count', len(flags)),
+                  ('elements_reported_count', len(flags))]
+    identification_elements = ''.join('<element name="%s" value="%s"/>' % item for item in identification)
+    identification_elements += ''.join('<element name="%s" group="qa_summary" value="%d"/>' % item
+                                       for item in qa_summary)
+
+    return ('<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<om:ObservationCollection %s><om:member><om:Observation><om:metadata><set>'
+            '<general><author name="synthetic" version="1.0"/></general>'
+            '<identification-elements>%s</identification-elements></set></om:metadata>'
+            '<om:result><elements>%s%s</elements></om:result></om:Observation></om:member></om:ObservationCollection>'
+            % (SYNTHETIC_NAMESPACES, identification_elements, derived, ''.join(observations)))
+
+
+def synthetic_file_name(tc_identifier: str, station_identifier: str, timestamp: datetime.datetime, version: int):
+    """ Returns the file name of a payload like the separate files of a loader export. """
+    return '%s_%s_%s_orig_data_%d_payload.ldr' % (tc_identifier, station_identifier, timestamp.strftime('%Y%m%d%H%M'),
+                                                  version)
+
+
+def write_synthetic_folder(folder_path: str,
+                           num_stations: int = 3,
+                           num_hours: int = 24,
+                           num_versions: int = 2,
+                           num_sensors: int = 12,
+                           num_subtests: int = 3,
+                           status_indicators: bool = True,
+                           seed: int = 0):
+    """ Writes a folder of synthetic payloads, one for every station, hour and version.
+
+    Params:
+        folder_path (str) - Folder the payloads are written to (created if necessary)
+        num_stations (int) - Number of stations
+        num_hours (int) - Number of hourly observation times per station (starting 2019-01-01)
+        num_versions (int) - Number of versions per observation time (original plus corrections)
+        num_sensors, num_subtests, status_indicators, seed - See synthetic_xml
+
+    Returns:
+        file_paths (list) - Paths of the written payloads
+    """
+    os.makedirs(folder_path, exist_ok=True)
+    file_paths = []
+    for station_num in range(num_stations):
+        tc_identifier = 'w' + ''.join(chr(ord('a') + (station_num // 26 ** power) % 26) for power in (1, 0))
+        station_identifier = str(1000000 + station_num * 1013)
+        for hour in range(num_hours):
+            timestamp = datetime.datetime(2019, 1, 1) + datetime.timedelta(hours=hour)
+            for version in range(num_versions):
+                xml = synthetic_xml(tc_identifier=tc_identifier,
+                                    station_identifier=station_identifier,
+                                    timestamp=timestamp,
+                                    version=version,
+                                    num_sensors=num_sensors,
+                                    num_subtests=num_subtests,
+                                    status_indicators=status_indicators,
+                                    seed=seed)
+                file_path = folder_path + synthetic_file_name(tc_identifier, station_identifier, timestamp, version)
+                with open(file_path, 'w') as file:
+                    file.write(xml)
+                file_paths.append(file_path)
+    return file_paths
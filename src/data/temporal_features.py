@@ -0,0 +1,215 @@
+import numpy as np
+import pandas as pd
+from numpy.lib.stride_tricks import sliding_window_view
+
+
+# Engine State ########################################################################################################
+
+# Rolling statistics over the hours before an observation (the observation itself is not included)
+TEMPORAL_STATISTICS = ('mean', 'std', 'min', 'max')
+# Hour stored in an empty slot of a ring buffer
+EMPTY_HOUR = np.iinfo(np.int64).min
+NANOSECONDS_PER_HOUR = 3600 * 10 ** 9
+
+
+def new_temporal_state(lags=(1, 2, 3, 24), windows=(3, 24), station_column: str = 'tc_identifier',
+                       sensor_prefixes: list = None):
+    """ Returns the empty state of the temporal feature engine.
+
+    The state keeps a ring buffer per station with the values of the last hours (as many as the largest lag or
+    window), so new observations only need the buffer instead of the history. It can be saved with save_pickle and
+    updated by the next run.
+
+    Params:
+        lags (tuple) - Hours of the lagged values and deltas, e.g. 1 for the value of the previous hour
+        windows (tuple) - Hours of the rolling statistics (see TEMPORAL_STATISTICS)
+        station_column (str) - Key of the station ('tc_identifier' or 'station_identifier')
+        sensor_prefixes (list) - Prefixes of the sensors (see xml2dict.observation_extract_prefix), all sensors with
+            a '_value' key if None
+
+    Returns:
+        state (dict) - Configuration, sensors and the ring buffer of each station
+    """
+    return {'lags': tuple(lags),
+            'windows': tuple(windows),
+            'ring_size': max(tuple(lags) + tuple(windows)),
+            'station_column': station_column,
+            'sensors': list(sensor_prefixes or []),
+            'fixed_sensors': sensor_prefixes is not None,
+            'stations': {}}
+
+
+def value_prefixes(columns):
+    """ Returns the sensor prefixes of the measured values among the columns (keys '<prefix>_value'). """
+    return [column[:-len('_value')] for column in columns if column.endswith('_value')]
+
+
+def temporal_feature_names(prefix: str, state: dict):
+    """ Returns the names of the temporal features of a sensor, e.g. air_temperature_12_value_lag_1. """
+    names = ['%s_value_lag_%d' % (prefix, lag) for lag in state['lags']]
+    names += ['%s_value_delta_%d' % (prefix, lag) for lag in state['lags']]
+    names += ['%s_value_rolling_%s_%d' % (prefix, statistic, window)
+              for window in state['windows'] for statistic in TEMPORAL_STATISTICS]
+    return names
+
+
+def new_station_ring(ring_size: int, num_sensors: int):
+    """ Returns an empty ring buffer: the hour (since the epoch) held by each slot and the values per slot and sensor.
+    The slot of an hour is hour % ring_size, so a slot is only valid if it holds the expected hour (gaps are NaN). """
+    return {'hours': np.full(ring_size, EMPTY_HOUR, dtype=np.int64),
+            'values': np.full((ring_size, num_sensors), np.nan),
+            'latest_hour': EMPTY_HOUR}
+
+
+# Vectorized Statistics ###############################################################################################
+
+def window_statistics(windows: np.ndarray):
+    """ Computes the statistics of windows (last axis) ignoring missing values, NaN if a window has no value (or only
+    one for the std, which uses ddof=1 like pandas).
+
+    Returns:
+        statistics (dict) - Statistic name as key and array of the windows' shape without the last axis as value
+    """
+    missing = np.isnan(windows)
+    counts = (~missing).sum(axis=-1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = np.where(missing, 0.0, windows).sum(axis=-1) / counts
+        squared_deviations = np.where(missing, 0.0, windows - means[..., np.newaxis]) ** 2
+        stds = np.sqrt(squared_deviations.sum(axis=-1) / (counts - 1))
+    minimums = np.where(missing, np.inf, windows).min(axis=-1)
+    maximums = np.where(missing, -np.inf, windows).max(axis=-1)
+    empty = counts == 0
+    minimums[empty] = np.nan
+    maximums[empty] = np.nan
+    stds[counts < 2] = np.nan
+    return {'mean': means, 'std': stds, 'min': minimums, 'max': maximums}
+
+
+def hour_intervals(hours: np.ndarray, ring_size: int, end_hour: int):
+    """ Returns the disjoint intervals of hours the features of a batch and the update of its ring buffer depend on:
+    the ring_size hours before each observation and the observation itself, and the last ring_size hours up to
+    end_hour. Overlapping and adjacent intervals are merged, gaps between them (e.g. before a late observation) are
+    left out.
+
+    Returns:
+        starts (np.ndarray), ends (np.ndarray) - First and last hour of each interval in ascending order
+    """
+    starts = np.append(hours - ring_size, end_hour - ring_size + 1)
+    ends = np.append(hours, end_hour)
+    order = np.argsort(starts, kind='stable')
+    starts, ends = starts[order], np.maximum.accumulate(ends[order])
+    new_interval = starts[1:] > ends[:-1] + 1
+    return starts[np.append(True, new_interval)], ends[np.append(new_interval, True)]
+
+
+def grid_positions(grid_hours: np.ndarray, starts: np.ndarray, ends: np.ndarray, offsets: np.ndarray):
+    """ Returns the positions of hours in the grid of the intervals (see hour_intervals) and if they are inside. """
+    interval = np.maximum(np.searchsorted(starts, grid_hours, side='right') - 1, 0)
+    inside = (grid_hours >= starts[interval]) & (grid_hours <= ends[interval])
+    return offsets[interval] + grid_hours - starts[interval], inside
+
+
+def station_batch_features(ring: dict, hours: np.ndarray, values: np.ndarray, state: dict):
+    """ Computes the temporal features of a batch of one station and updates its ring buffer.
+
+    The ring buffer and the batch are written into an hourly grid, from which the lags and rolling windows of all
+    observations are taken at once. The grid consists of the intervals the features and the buffer depend on (see
+    hour_intervals), one after the other, so a late observation only adds the ring_size hours before it instead of
+    all hours up to the latest one. No window crosses the border of an interval. The batch overrides buffered values
+    of the same hour and can contain late observations in any order. Afterwards the buffer holds the last ring_size
+    hours, so the cost of an update only depends on the batch.
+
+    Params:
+        ring (dict) - Ring buffer of the station (see new_station_ring)
+        hours (np.ndarray) - Hour since the epoch of each observation
+        values (np.ndarray) - Values of the observations with one column per sensor of the state
+        state (dict) - State of the engine (see new_temporal_state)
+
+    Returns:
+        features (np.ndarray) - Features of each observation, per sensor in the order of temporal_feature_names
+    """
+    ring_size = state['ring_size']
+    end_hour = max(hours.max(), ring['latest_hour'])
+    starts, ends = hour_intervals(hours=hours, ring_size=ring_size, end_hour=end_hour)
+    offsets = np.concatenate([[0], np.cumsum(ends - starts + 1)])
+    grid = np.full((offsets[-1], values.shape[1]), np.nan)
+    buffered = ring['hours'] != EMPTY_HOUR
+    ring_positions, inside = grid_positions(ring['hours'][buffered], starts, ends, offsets)
+    grid[ring_positions[inside]] = ring['values'][buffered][inside]
+    positions, _ = grid_positions(hours, starts, ends, offsets)
+    grid[positions] = values
+
+    current = grid[positions]
+    lagged = [grid[positions - lag] for lag in state['lags']]
+    features = lagged + [current - lagged_values for lagged_values in lagged]
+    for window in state['windows']:
+        # Window of position p are the hours p - window ... p - 1
+        statistics = window_statistics(sliding_window_view(grid, window, axis=0)[positions - window])
+        features += [statistics[statistic] for statistic in TEMPORAL_STATISTICS]
+    num_sensors = values.shape[1]
+    # One block of features per sensor, ordered like temporal_feature_names
+    features = np.stack(features, axis=-1).reshape(len(hours), num_sensors * len(features))
+
+    ring_hours = np.arange(end_hour - ring_size + 1, end_hour + 1)
+    slots = ring_hours % ring_size
+    ring['hours'][slots] = ring_hours
+    ring['values'][slots] = grid[grid_positions(ring_hours, starts, ends, offsets)[0]]
+    ring['latest_hour'] = end_hour
+    return features
+
+
+# Engine ##############################################################################################################
+
+def update_temporal_features(state: dict, df):
+    """ Computes the temporal features of new observations and adds them to the state.
+
+    Each station is processed as one vectorized batch, using only its ring buffer as history. Several rows of the same
+    station and hour (e.g. versions of an observation) are treated as updates, the last row wins. Like the history,
+    the batch should therefore contain the originals (version 0) or flat records.
+
+    Params:
+        state (dict) - State of the engine (see new_temporal_state), is updated
+        df (pd.DataFrame) - Observations with the station column, date_time and the '<prefix>_value' columns (strings
+            of the extraction or numbers)
+
+    Returns:
+        features (pd.DataFrame) - Temporal features of each observation with the index of df
+    """
+    if not state['fixed_sensors']:
+        state['sensors'] += [prefix for prefix in value_prefixes(df.columns) if prefix not in state['sensors']]
+    sensors = state['sensors']
+    columns = [name for prefix in sensors for name in temporal_feature_names(prefix, state)]
+    features = np.full((len(df), len(columns)), np.nan)
+    if not len(df):
+        return pd.DataFrame(features, index=df.index, columns=columns)
+
+    times = pd.to_datetime(df['date_time'], errors='coerce', utc=True)
+    hours = np.floor_divide(times.to_numpy(dtype='datetime64[ns]').view(np.int64), NANOSECONDS_PER_HOUR)
+    values = np.column_stack([pd.to_numeric(df[prefix + '_value'], errors='coerce').to_numpy(dtype=np.float64)
+                              if prefix + '_value' in df else np.full(len(df), np.nan) for prefix in sensors])
+    valid_time = times.notna().to_numpy()
+    stations = df[state['station_column']].to_numpy()
+
+    for station in pd.unique(stations[valid_time]):
+        rows = np.flatnonzero((stations == station) & valid_time)
+        ring = state['stations'].get(station)
+        if ring is None:
+            ring = state['stations'][station] = new_station_ring(state['ring_size'], len(sensors))
+        elif ring['values'].shape[1] < len(sensors):
+            # Sensors which were first seen in this batch have no history yet
+            padding = np.full((state['ring_size'], len(sensors) - ring['values'].shape[1]), np.nan)
+            ring['values'] = np.hstack([ring['values'], padding])
+        features[rows] = station_batch_features(ring=ring, hours=hours[rows], values=values[rows], state=state)
+    return pd.DataFrame(features, index=df.index, columns=columns)
+
+
+def temporal_features(df, lags=(1, 2, 3, 24), windows=(3, 24), station_column: str = 'tc_identifier',
+                      sensor_prefixes: list = None):
+    """ Computes the temporal features of a complete DataFrame at once (see update_temporal_features).
+
+    Returns:
+        features (pd.DataFrame), state (dict) - Features and the state to continue with new observations
+    """
+    state = new_temporal_state(lags=lags, windows=windows, station_column=station_column,
+                               sensor_prefixes=sensor_prefixes)
+    return update_temporal_features(state=state, df=df), state
@@ -0,0 +1,397 @@
+import argparse
+import multiprocessing
+import os
+import shutil
+import time
+
+import numpy as np
+import pandas as pd
+from joblib import Parallel, delayed, parallel_backend
+
+from chunk_union import collect_column_union, combine_chunks
+from dataset_builder import build_store_target_dataset, build_target_dataset, row_filter_columns, target_column_selector
+from extraction_manifest import save_json
+from extraction_metrics import collect_metrics, merge_metrics, metrics_report, stage_timer
+from feature_store import commit_partition, open_partition_writer, partition_arrays, partition_block
+from online_scoring import save_scoring_model
+from xml2dict import ensure_folder_exists
+
+
+# Training Setup ######################################################################################################
+
+# Model of Train_and_test (rfc(n_estimators=1000, min_samples_leaf=2) with ADASYN), n_jobs is set by the core budget
+DEFAULT_MODEL_PARAMS = {'n_estimators': 1000, 'min_samples_leaf': 2}
+RESAMPLERS = ('adasyn', 'smote', 'random')
+FEATURE_FOLDER_NAME = 'training_features/'
+SUMMARY_FILE_NAME = 'training_summary.json'
+# Column of the target and the partitions of the train and test rows in the feature store of a dataset
+TARGET_COLUMN = 'target'
+TRAIN_PARTITION = 'train'
+TEST_PARTITION = 'test'
+# Feature store with the columns of the extraction output read by the datasets of all targets of a run
+EXTRACTION_STORE_FOLDER_NAME = 'extraction/'
+EXTRACTION_PARTITION = 'records'
+
+
+def core_budget(num_targets: int, num_cores: int = None, max_parallel_models: int = None):
+    """ Splits the cores between the models trained at once (processes) and the trees of each model (n_jobs).
+
+    Models are parallelized first, as their dataset handling, resampling and evaluation are mostly single threaded.
+    The remaining cores go to the trees, so e.g. 3 targets on 8 cores are trained in 3 processes with 2 jobs each.
+
+    Returns:
+        model_processes (int), tree_jobs (int)
+    """
+    num_cores = num_cores or multiprocessing.cpu_count()
+    model_processes = max(min(num_targets, num_cores, max_parallel_models or num_cores), 1)
+    return model_processes, max(num_cores // model_processes, 1)
+
+
+def _import_imblearn():
+    try:
+        import imblearn.over_sampling
+    except ImportError:
+        raise ImportError("Resampling the training data requires the package imbalanced-learn.")
+    return imblearn.over_sampling
+
+
+def resample(X, y, resampler: str, random_state: int = 42):
+    """ Oversamples the minority class of the training data (see RESAMPLERS, None keeps the data). The data is kept
+    if the resampler can't be fitted, e.g. because the minority class has fewer samples than ADASYN's neighbors. """
+    if resampler is None:
+        return X, y
+    assert resampler in RESAMPLERS, "Resampler has to be one of %s or None." % (RESAMPLERS,)
+    over_sampling = _import_imblearn()
+    sampler = {'adasyn': over_sampling.ADASYN,
+               'smote': over_sampling.SMOTE,
+               'random': over_sampling.RandomOverSampler}[resampler](random_state=random_state)
+    try:
+        return sampler.fit_resample(X, y)
+    except (ValueError, RuntimeError) as error:
+        print("--- Resampling with %s failed, the original training data is used: %s.---" % (resampler, error))
+        return X, y
+
+
+# Feature Store #######################################################################################################
+
+def build_extraction_store(output_path: str, feature_path: str, target_vars: list, dataset_kwargs: dict = None):
+    """ Combines the columns of the chunk pickles which are read by the datasets of the targets into one memory mapped
+    partition (see chunk_union.combine_chunks), so the extraction output is read once for all targets instead of by
+    each dataset task. An existing store of a previous run is replaced.
+
+    Returns:
+        store_path (str) - Folder of the feature store with the combined columns
+    """
+    dataset_kwargs = dataset_kwargs or {}
+    store_path = feature_path + EXTRACTION_STORE_FOLDER_NAME
+    shutil.rmtree(store_path, ignore_errors=True)
+    selectors = [target_column_selector(target_var=target_var, feature_prefixes=dataset_kwargs.get('feature_prefixes'))
+                 for target_var in target_vars]
+    filter_columns = {column for target_var in target_vars
+                      for column in row_filter_columns(target_var=target_var,
+                                                       only_qa_failed=dataset_kwargs.get('only_qa_failed', True),
+                                                       versions=dataset_kwargs.get('versions'))}
+    columns = [column for column in collect_column_union(output_path)['columns']
+               if column in filter_columns or any(select_column(column) for select_column in selectors)]
+    combine_chunks(output_path=output_path, columns=columns, store_path=store_path, partition=EXTRACTION_PARTITION)
+    return store_path
+
+
+def target_store_path(feature_path: str, target_var: str):
+    """ Returns the folder of the feature store which holds the dataset of a target. """
+    return feature_path + target_var + '/'
+
+
+def split_rows(y, test_size: float = 0.2, random_state: int = 42):
+    """ Splits the rows of a dataset into train and test rows like train_test_split in Train_and_test (stratified by
+    the target if both classes have at least two rows).
+
+    Returns:
+        train_rows (np.ndarray), test_rows (np.ndarray) - Sorted positions of the rows
+    """
+    from sklearn.model_selection import train_test_split
+
+    if not len(y):
+        return np.arange(0), np.arange(0)
+    stratify = y if np.bincount(y, minlength=2).min() >= 2 else None
+    train_rows, test_rows = train_test_split(np.arange(len(y)), test_size=test_size, random_state=random_state,
+                                             stratify=stratify)
+    return np.sort(train_rows), np.sort(test_rows)
+
+
+def save_target_features(feature_path: str, target_var: str, X, y, test_size: float = 0.2, random_state: int = 42):
+    """ Saves the dataset of a target as feature store with the partitions of the train and the test rows (see
+    split_rows). The features of each partition are a column-major block (see feature_store.partition_block), so the
+    training processes pass the memory mapped rows to the estimators instead of copying them. The rows are gathered
+    one column at a time into the block. An existing dataset of the target is replaced. """
+    store_path = target_store_path(feature_path, target_var)
+    shutil.rmtree(store_path, ignore_errors=True)
+    column_dtypes = {column: ('numeric', dtype) for column, dtype in X.dtypes.items()}
+    column_dtypes[TARGET_COLUMN] = ('numeric', y.dtype)
+    for partition, rows in zip((TRAIN_PARTITION, TEST_PARTITION),
+                               split_rows(y.to_numpy(), test_size=test_size, random_state=random_state)):
+        writer = open_partition_writer(store_path=store_path, partition=partition, num_rows=len(rows),
+                                       column_dtypes=column_dtypes, block_columns=list(X.columns))
+        for column in X.columns:
+            writer['arrays'][column][:] = X[column].to_numpy()[rows]
+        writer['arrays'][TARGET_COLUMN][:] = y.to_numpy()[rows]
+        commit_partition(writer=writer, index=X.index[rows])
+
+
+def load_target_features(feature_path: str, target_var: str, partition: str = TRAIN_PARTITION):
+    """ Opens the features and target of the train or test rows of a target's dataset (see save_target_features)
+    memory mapped and read-only, nothing is copied.
+
+    Returns:
+        X (np.ndarray), y (np.ndarray), columns (list)
+    """
+    store_path = target_store_path(feature_path, target_var)
+    X, columns = partition_block(store_path=store_path, partition=partition)
+    y = partition_arrays(store_path=store_path, partition=partition, columns=[TARGET_COLUMN])[TARGET_COLUMN]
+    return X, y, columns
+
+
+# Tasks ###############################################################################################################
+
+def build_target_features(output_path: str, feature_path: str, target_var: str, dataset_kwargs: dict = None,
+                          test_size: float = 0.2, random_state: int = 42):
+    """ Task which builds the dataset of a target from the combined columns of the extraction (see
+    build_extraction_store), or from the parquet dataset of the output for the dataset source "parquet", and saves it
+    to the feature store split into train and test rows (see save_target_features).
+
+    Returns:
+        result (dict) - Target, rows, features, positives and metrics of the task
+    """
+    dataset_kwargs = dict(dataset_kwargs or {})
+    with collect_metrics() as metrics:
+        if dataset_kwargs.get('source') == 'parquet':
+            X, y = build_target_dataset(output_path=output_path, target_var=target_var, **dataset_kwargs)
+        else:
+            dataset_kwargs.pop('source', None)
+            dataset_kwargs.pop('batch_size', None)
+            X, y = build_store_target_dataset(store_path=feature_path + EXTRACTION_STORE_FOLDER_NAME,
+                                              partition=EXTRACTION_PARTITION, target_var=target_var, **dataset_kwargs)
+        with stage_timer('save_features'):
+            save_target_features(feature_path=feature_path, target_var=target_var, X=X, y=y, test_size=test_size,
+                                 random_state=random_state)
+    return {'target': target_var, 'rows': len(X), 'features': X.shape[1], 'positives': int(y.sum()),
+            'metrics': metrics}
+
+
+def evaluation_scores(y_true, y_pred, y_score=None):
+    """ Returns the confusion matrix and the scores of the positive class (changed in the manual correction). """
+    from sklearn.metrics import confusion_matrix, f1_score, precision_score, recall_score, roc_auc_score
+
+    scores = {'confusion_matrix': confusion_matrix(y_true, y_pred, labels=[0, 1]).tolist(),
+              'precision': precision_score(y_true, y_pred, zero_division=0),
+              'recall': recall_score(y_true, y_pred, zero_division=0),
+              'f1': f1_score(y_true, y_pred, zero_division=0),
+              'roc_auc': None}
+    if y_score is not None and len(np.unique(y_true)) == 2:
+        scores['roc_auc'] = roc_auc_score(y_true, y_score)
+    return scores
+
+
+def train_target_model(feature_path: str,
+                       model_path: str,
+                       target_var: str,
+                       tree_jobs: int = 1,
+                       resampler: str = 'adasyn',
+                       model_params: dict = None,
+                       random_state: int = 42,
+                       num_importances: int = 20,
+                       permutation_repeats: int = 5,
+                       num_partial_dependence: int = 3):
+    """ Task which trains and evaluates the model of a target on its memory mapped features.
+
+    The memory mapped train and test rows are passed to the estimator as they are (copies are only made by the
+    resampling, which creates a new training set, and the inspection). The model is saved with its feature
+    layout (see online_scoring.save_scoring_model) and the metrics as '<target_var>_metrics.json', both to model_path.
+
+    Params:
+        feature_path (str) - Folder of the feature store (see save_target_features)
+        model_path (str) - Folder the model and the metrics are saved to
+        target_var (str) - Prefix of the target sensor, e.g. snow_depth_3022
+        tree_jobs (int) - Number of threads used for the trees and the permutation importance
+        resampler (str) - Oversampling of the training data (see RESAMPLERS, None for no resampling)
+        model_params (dict) - Parameters of the RandomForestClassifier (see DEFAULT_MODEL_PARAMS)
+        random_state (int) - Seed of the resampling and the model (the split is made by save_target_features)
+        num_importances (int) - Number of features with the highest importance which are kept
+        permutation_repeats (int) - Repeats of the permutation importance on the test rows (0 uses the impurity
+            based feature_importances_ of the forest instead, which costs no predictions)
+        num_partial_dependence (int) - Number of the most important features whose partial dependence is computed
+
+    Returns:
+        result (dict) - Scores, importances, partial dependence and metrics (timers) of the task
+    """
+    from sklearn.ensemble import RandomForestClassifier
+    from sklearn.inspection import partial_dependence, permutation_importance
+
+    with collect_metrics() as metrics:
+        with stage_timer('load_features'):
+            X_train, y_train, columns = load_target_features(feature_path, target_var, partition=TRAIN_PARTITION)
+            X_test, y_test, _ = load_target_features(feature_path, target_var, partition=TEST_PARTITION)
+        with stage_timer('resample'):
+            X_train, y_train = resample(X=X_train, y=y_train, resampler=resampler, random_state=random_state)
+        with stage_timer('fit'):
+            model = RandomForestClassifier(n_jobs=tree_jobs, random_state=random_state,
+                                           **dict(DEFAULT_MODEL_PARAMS, **(model_params or {})))
+            model.fit(X_train, y_train)
+        with stage_timer('evaluate'):
+            y_score = model.predict_proba(X_test)[:, list(model.classes_).index(1)] if 1 in model.classes_ else None
+            scores = evaluation_scores(y_true=y_test, y_pred=model.predict(X_test), y_score=y_score)
+        # The process is a worker of the runner, its nested jobs run as threads instead of starting further processes
+        with parallel_backend('threading', n_jobs=tree_jobs):
+            with stage_timer('importance'):
+                if permutation_repeats:
+                    importance = permutation_importance(model, X_test, y_test, n_repeats=permutation_repeats,
+                                                        random_state=random_state, n_jobs=tree_jobs)
+                    importances_mean, importances_std = importance.importances_mean, importance.importances_std
+                else:
+                    importances_mean = model.feature_importances_
+                    importances_std = np.std([tree.feature_importances_ for tree in model.estimators_], axis=0)
+            top_features = np.argsort(importances_mean)[::-1][:num_importances]
+            with stage_timer('partial_dependence'):
+                dependences = {}
+                for feature in top_features[:num_partial_dependence].tolist():
+                    dependence = partial_dependence(model, X_test, [feature], grid_resolution=20)
+                    dependences[columns[feature]] = {'grid': dependence['grid_values'][0].tolist(),
+                                                     'average': dependence['average'][0].tolist()}
+        with stage_timer('save_model'):
+            save_scoring_model(folder_path=model_path, file_name=target_var + '_random_forest', model=model,
+                               feature_columns=columns)
+
+    result = dict(scores,
+                  target=target_var,
+                  train_rows=len(y_train),
+                  test_rows=len(y_test),
+                  tree_jobs=tree_jobs,
+                  worker=os.getpid(),
+                  importances=[(columns[feature], float(importances_mean[feature]), float(importances_std[feature]))
+                               for feature in top_features.tolist()],
+                  partial_dependence=dependences,
+                  seconds={stage: round(seconds, 3) for stage, (_, seconds) in metrics['timers'].items()})
+    save_json(folder_path=model_path, file_name=target_var + '_metrics.json', save_object=result)
+    result['metrics'] = metrics
+    return result
+
+
+# Runner ##############################################################################################################
+
+def train_targets(output_path: str,
+                  model_path: str,
+                  target_vars: list,
+                  num_cores: int = None,
+                  max_parallel_models: int = None,
+                  resampler: str = 'adasyn',
+                  model_params: dict = None,
+                  dataset_kwargs: dict = None,
+                  test_size: float = 0.2,
+                  random_state: int = 42,
+                  **training_kwargs):
+    """ Builds the datasets and trains and evaluates the models of several target variables on a process pool.
+
+    The columns of the extraction output read by any target are combined once into a memory mapped store (see
+    build_extraction_store), from which the datasets are built (one task per target on all cores) into the feature
+    store '<model_path>training_features/', where the training processes map them read-only. Targets without rows
+    are skipped and listed in the summary. The models are then trained with the cores split by
+    core_budget, the largest datasets first so the longest tasks don't end up last.
+
+    Params:
+        output_path (str) - Output folder of the extraction with flat records (see dataset_builder)
+        model_path (str) - Folder the models, their metrics and the summary are saved to
+        target_vars (list) - Prefixes of the target sensors, e.g. ['snow_depth_3022', 'wind_speed_3005']
+        num_cores (int) - Number of cores which are used (all if None)
+        max_parallel_models (int) - Maximum number of models which are trained at once (e.g. to limit the memory)
+        resampler (str) - Oversampling of the training data (see RESAMPLERS, None for no resampling)
+        model_params (dict) - Parameters of the RandomForestClassifier (see DEFAULT_MODEL_PARAMS)
+        dataset_kwargs (dict) - Arguments of dataset_builder.build_store_target_dataset (e.g. feature_prefixes) or
+            of dataset_builder.build_target_dataset for the source "parquet"
+        test_size (float) - Share of the rows which are used for the evaluation
+        random_state (int) - Seed of the split, the resampling and the models
+        training_kwargs - Further arguments of train_target_model (e.g. num_importances, num_partial_dependence)
+
+    Returns:
+        results (list) - Result of each target (see train_target_model)
+    """
+    num_cores = num_cores or multiprocessing.cpu_count()
+    feature_path = model_path + FEATURE_FOLDER_NAME
+    ensure_folder_exists(feature_path)
+    model_processes, tree_jobs = core_budget(num_targets=len(target_vars), num_cores=num_cores,
+                                             max_parallel_models=max_parallel_models)
+    print("--- Training %d targets in %d processes with %d tree jobs each.---" % (
+        len(target_vars), model_processes, tree_jobs))
+
+    start_time = time.time()
+    from_store = (dataset_kwargs or {}).get('source') != 'parquet'
+    with collect_metrics() as run_metrics:
+        if from_store:
+            with stage_timer('combine_chunks'):
+                store_path = build_extraction_store(output_path=output_path, feature_path=feature_path,
+                                                    target_vars=target_vars, dataset_kwargs=dataset_kwargs)
+        with stage_timer('build_datasets'):
+            datasets = Parallel(n_jobs=min(len(target_vars), num_cores), batch_size=1)(
+                delayed(build_target_features)(output_path, feature_path, target_var, dataset_kwargs,
+                                               test_size=test_size, random_state=random_state)
+                for target_var in target_vars)
+        if from_store:
+            shutil.rmtree(store_path, ignore_errors=True)
+        for dataset in datasets:
+            merge_metrics(total=run_metrics, metrics=dataset.pop('metrics'), parent='build_datasets')
+        skipped_targets = [dataset['target'] for dataset in datasets if not dataset['rows']]
+        if skipped_targets:
+            print("--- No rows for the targets %s, their models are skipped.---" % ', '.join(skipped_targets))
+        datasets = [dataset for dataset in datasets if dataset['rows'] > 0]
+        datasets.sort(key=lambda dataset: -dataset['rows'] * dataset['features'])
+
+        with stage_timer('train_models'):
+            results = Parallel(n_jobs=model_processes, batch_size=1)(
+                delayed(train_target_model)(feature_path=feature_path,
+                                            model_path=model_path,
+                                            target_var=dataset['target'],
+                                            tree_jobs=tree_jobs,
+                                            resampler=resampler,
+                                            model_params=model_params,
+                                            random_state=random_state,
+                                            **training_kwargs)
+                for dataset in datasets)
+        for result in results:
+            merge_metrics(total=run_metrics, metrics=result.pop('metrics'), parent='train_models')
+    metrics_report(metrics=run_metrics)
+
+    for dataset, result in zip(datasets, results):
+        print("--- %s: %d rows, %d features, precision %.3f, recall %.3f, f1 %.3f in %.1f s.---" % (
+            result['target'], dataset['rows'], dataset['features'], result['precision'], result['recall'],
+            result['f1'], sum(result['seconds'].values())))
+    save_json(folder_path=model_path, file_name=SUMMARY_FILE_NAME,
+              save_object={'targets': target_vars,
+                           'skipped_targets': skipped_targets,
+                           'datasets': datasets,
+                           'results': [{key: result[key] for key in ('target', 'precision', 'recall', 'f1', 'roc_auc',
+                                                                     'worker', 'seconds')} for result in results],
+                           'model_processes': model_processes,
+                           'tree_jobs': tree_jobs,
+                           'seconds': round(time.time() - start_time, 3),
+                           'stage_seconds': {stage: round(seconds, 3)
+                                             for stage, (_, seconds) in run_metrics['timers'].items()}})
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Trains the models of several target variables in parallel.")
+    parser.add_argument('output_path', help="Output folder of the extraction with flat records")
+    parser.add_argument('model_path', help="Folder the models and metrics are saved to")
+    parser.add_argument('targets', nargs='+', help="Target variables, e.g. snow_depth_3022 wind_speed_3005")
+    parser.add_argument('--cores', type=int, default=None, help="Number of cores (default all)")
+    parser.add_argument('--max-parallel-models', type=int, default=None, help="Maximum number of models at once")
+    parser.add_argument('--resampler', choices=list(RESAMPLERS) + ['none'], default='adasyn')
+    parser.add_argument('--n-estimators', type=int, default=DEFAULT_MODEL_PARAMS['n_estimators'])
+    arguments = parser.parse_args()
+
+    train_targets(output_path=arguments.output_path,
+                  model_path=arguments.model_path,
+                  target_vars=arguments.targets,
+                  num_cores=arguments.cores,
+                  max_parallel_models=arguments.max_parallel_models,
+                  resampler=None if arguments.resampler == 'none' else arguments.resampler,
+                  model_params={'n_estimators': arguments.n_estimators})
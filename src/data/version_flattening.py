@@ -0,0 +1,95 @@
+# Version States ######################################################################################################
+
+# The xml of an observation time is sent again with an increased version for every manual correction. A flat record
+# pairs the original (version 0, state after the automatic QA) with the latest correction (state after the manual
+# correction), whose keys get the suffix '_post_mc'.
+POST_MC_SUFFIX = '_post_mc'
+# A correction is only relevant if it contains any key with one of these words (the values orig-value and
+# value_override are included in "value"), others are e.g. only created by the system.
+RELEVANT_CHANGE_WORDS = ('value', 'overall_qa_summary', 'qa_flag_override')
+
+
+def station_time_identifier(station_data: dict):
+    """ Returns the identifier of the station and observation time (<tc_identifier>_<climate id>_<time>) which is
+    shared by all versions of an observation. """
+    return "_".join(station_data['source_uri'].split(sep="/")[10:7:-1])
+
+
+def is_relevant_correction(station_data: dict, relevant_words=RELEVANT_CHANGE_WORDS):
+    """ Checks if a correction contains any relevant change (see RELEVANT_CHANGE_WORDS). """
+    return any(value is not None and any(word in key for word in relevant_words)
+               for key, value in station_data.items())
+
+
+def update_version_state(state: dict, station_data: dict):
+    """ Adds an extraction to the state of its station and observation time, which only keeps the original and the
+    correction with the highest version seen so far. The extractions can be added in any order.
+
+    Params:
+        state (dict) - Station time identifier as key and dictionary with "original" and "correction" as value
+        station_data (dict) - Extraction dictionary (see xml2dict.xml_extraction_complete_compose)
+
+    Returns:
+        state (dict) - Updated state
+    """
+    entry = state.setdefault(station_time_identifier(station_data), {'original': None, 'correction': None})
+    if station_data['version'] == '0':
+        entry['original'] = station_data
+    elif entry['correction'] is None or int(station_data['version']) > int(entry['correction']['version']):
+        entry['correction'] = station_data
+    return state
+
+
+def merge_version_states(state: dict, other_state: dict):
+    """ Adds the entries of another state (e.g. of another work unit of the same chunk) to the state. """
+    for key, other_entry in other_state.items():
+        for station_data in (other_entry['original'], other_entry['correction']):
+            if station_data is not None:
+                update_version_state(state=state, station_data=station_data)
+    return state
+
+
+# Flat Records ########################################################################################################
+
+def flat_record(entry: dict, relevant_words=RELEVANT_CHANGE_WORDS):
+    """ Creates the flat record of a station and observation time from its state entry.
+
+    The record equals a row of the left merge of the originals with the latest corrections (filtered by their
+    relevance) on the station_time_identifier: the keys of the original, the keys of the latest correction with the
+    suffix '_post_mc' if it is relevant, and "_merge" with "both" or "left_only" (no relevant correction).
+
+    Returns:
+        record (dict) - Flat record or None if the original is missing
+    """
+    original, correction = entry['original'], entry['correction']
+    if original is None:
+        return None
+    record = dict(original)
+    record['station_time_identifier'] = station_time_identifier(original)
+    if correction is not None and is_relevant_correction(correction, relevant_words=relevant_words):
+        record.update((key + POST_MC_SUFFIX, value) for key, value in correction.items())
+        record['station_time_identifier' + POST_MC_SUFFIX] = record['station_time_identifier']
+        record['_merge'] = 'both'
+    else:
+        record['_merge'] = 'left_only'
+    return record
+
+
+def flatten_version_state(state: dict, only_changed: bool = False, relevant_words=RELEVANT_CHANGE_WORDS):
+    """ Creates the flat records of all station and observation times of a state (see flat_record).
+
+    Params:
+        state (dict) - State of the versions (see update_version_state)
+        only_changed (bool) - Indicator if only records with a relevant correction are kept
+        relevant_words (tuple) - Words of which a relevant correction contains at least one in its keys
+
+    Returns:
+        flat_records (dict) - Station time identifier as key and flat record as value
+    """
+    flat_records = {}
+    for key, entry in state.items():
+        record = flat_record(entry=entry, relevant_words=relevant_words)
+        if record is None or (only_changed and record['_merge'] == 'left_only'):
+            continue
+        flat_records[key] = record
+    return flat_records
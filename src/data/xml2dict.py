@@ -1,7 +1,10 @@
+import functools
+import io
 import math
 import os
 import pickle
 import time
+import zlib
 
 from joblib import Parallel, delayed
 import multiprocessing
@@ -9,89 +12,249 @@ import multiprocessing
 import pandas as pd
 
 from bs4 import BeautifulSoup
+from lxml import etree
+
+from chunk_union import CHUNK_COLUMNS_SUFFIX, save_chunk_columns
+from compact_records import compact_records, load_schema_registry, read_records_pickle, save_schema_registry
+from extraction_manifest import (discard_manifest_journals, extraction_options, file_manifest_entry,
+                                 filter_chunks_to_extract, load_extraction_manifest, manifest_chunking,
+                                 removed_file_chunks,
+                                 save_extraction_manifest, write_manifest_journal)
+from extraction_metrics import (PROFILE_FOLDER_NAME, collect_metrics, count, merge_metrics, metrics_report,
+                                new_metrics, profile_block, record_anomaly, save_metrics, stage_timer)
+from extraction_parquet import parquet_chunk_files, remove_parquet_chunk_rows, write_parquet_records
+from extraction_queue import (LEASE_SECONDS, attempt_name, load_task_result, queue_folder_path, task_done,
+                              task_lease, try_task, wait_for_task)
+from extraction_scheduler import (UNIT_FOLDER_NAME, extraction_run_name, extraction_unit_name, extraction_unit_stats,
+                                  plan_extraction_units, worker_throughput_report)
+from payload_export import export_name, export_payload_chunks, iter_export_payloads
+from version_flattening import (flatten_version_state, merge_version_states, station_time_identifier,
+                                update_version_state)
 
 
 # XML Load ############################################################################################################
 
-def xml2soup(xml_path: str):
+def xml2soup(xml_path: str, xml_content: bytes = None):
     """ Loads xml into BeautifulSoup object.
 
     Params:
         xml_path (string) - Path to xml to be loaded
+        xml_content (bytes) - Content of the xml which is used instead of reading xml_path (e.g. from an export)
 
     Returns:
         soup (BeautifulSoup object)
     """
-    with open(xml_path) as xml:
-        soup = BeautifulSoup(xml, 'lxml')
-        return soup
+    if xml_content is None:
+        with stage_timer('read'), open(xml_path) as xml:
+            xml_content = xml.read()
+    count('bytes', len(xml_content))
+    with stage_timer('parse'):
+        soup = BeautifulSoup(xml_content, 'lxml')
+    return soup
+
+
+def is_xml_payload(file_path: str, head_size: int = 512):
+    """ Cheap check if a file is a xml payload by only reading its first bytes (instead of parsing it completely).
+
+    Params:
+        file_path (str) - Path to the file to check
+        head_size (int) - Number of bytes read from the start of the file
+
+    Returns:
+        is_payload (bool) - True if the file starts with a xml declaration or tag
+    """
+    if not os.path.isfile(file_path):
+        return False
+    with open(file_path, 'rb') as file:
+        head = file.read(head_size)
+    head = head.lstrip(b'\xef\xbb\xbf \t\r\n')
+    return head.startswith(b'<?xml') or (head.startswith(b'<') and not head.startswith(b'<!--'))
+
+
+def iter_header_elements(xml_path: str, block_size: int = 8192, xml_content: bytes = None):
+    """ Generator which yields the <element> tags of the identification-elements at the top of a xml without loading
+    the whole file.
+
+    The file is fed block by block into a pull parser which stops at the end of the identification-elements (or as
+    soon as the caller stops iterating), therefore usually only the first block of the file is read. A file which is
+    no valid xml ends the iteration.
+
+    Params:
+        xml_path (str) - Path to xml to be scanned
+        block_size (int) - Number of bytes read at once
+        xml_content (bytes) - Content of the xml which is scanned instead of reading xml_path
+
+    Yields:
+        element (lxml.etree element)
+    """
+    parser = etree.XMLPullParser(events=('end',), tag=('{*}element', '{*}identification-elements'))
+    with (open(xml_path, 'rb') if xml_content is None else io.BytesIO(xml_content)) as xml:
+        for block in iter(lambda: xml.read(block_size), b''):
+            try:
+                parser.feed(block)
+            except etree.XMLSyntaxError:
+                return
+            for _, node in parser.read_events():
+                if _local_tag(node) == 'identification-elements':
+                    return
+                parent = node.getparent()
+                if parent is not None and _local_tag(parent) == 'identification-elements':
+                    yield node
+
+
+def xml_header_source_uri(xml_path: str, block_size: int = 8192):
+    """ Reads the source uri from the identification-elements at the top of a xml (see iter_header_elements).
+
+    Params:
+        xml_path (str) - Path to xml to be scanned
+        block_size (int) - Number of bytes read at once
+
+    Returns:
+        source_uri (str) - Value of the element source_uri or None if the file is no valid xml payload
+    """
+    for node in iter_header_elements(xml_path=xml_path, block_size=block_size):
+        if node.get('name') == 'source_uri':
+            return node.get('value')
+    return None
+
+
+def xml_header_comparision_value(xml_path: str, xml_content: bytes = None):
+    """ Reads the summary statistics of the QA flag values from the identification-elements at the top of a xml
+    (see iter_header_elements). Returns the same dictionary as xml_extract_comparision_value without parsing the file.
+    """
+    qa_summary = {node.get('name'): node.get('value')
+                  for node in iter_header_elements(xml_path=xml_path, xml_content=xml_content)
+                  if node.get('group') == 'qa_summary'}
+    return qa_summary_comparision_value(qa_summary=qa_summary)
+
+
+def source_uri_payload_name(source_uri: str):
+    """ Returns a file name for a payload read from an export (e.g. wic_2402604_201901010000_orig_data_0). """
+    uri_parts = source_uri.split(sep="/")
+    return "_".join(uri_parts[10:7:-1] + uri_parts[11:])
+
+
+def source_uri_station(source_uri: str):
+    """ Returns the station identifier ('<tc_identifier>_<station_identifier>') contained in the source uri. """
+    return "_".join(source_uri.split(sep="/")[10:8:-1])
+
+
+# XML Index ###########################################################################################################
+
+# Wildcard for the name or group part of an index key
+ANY = '*'
+
+
+def soup_index(soup_tag):
+    """ Indexes all tags below a BeautifulSoup tag in a single walk.
+
+    Every tag is registered under its (tag, name, group) attributes as well as under the keys where name and/or group
+    are replaced by the wildcard ANY. Lookups in the index replace repeated findChild/findChildren scans of the same
+    block, which each walk through the complete subtree again.
+
+    Params:
+        soup_tag (BeautifulSoup object) - Tag whose descendants should be indexed
+
+    Returns:
+        index (dict) - Dictionary with (tag, name, group) as key and a list of matching tags in document order as value
+    """
+    index = {}
+    for node in soup_tag.find_all(True):
+        tag, name, group = node.name, node.get('name'), node.get('group')
+        for key in ((tag, name, group), (tag, name, ANY), (tag, ANY, group), (tag, ANY, ANY)):
+            index.setdefault(key, []).append(node)
+    return index
+
+
+def etree_index(etree_node):
+    """ lxml equivalent of soup_index, tags are indexed by their name without namespace. """
+    index = {}
+    for node in etree_node.iterdescendants():
+        if not isinstance(node.tag, str):
+            # Comments and processing instructions
+            continue
+        tag, name, group = node.tag.rpartition('}')[2], node.get('name'), node.get('group')
+        for key in ((tag, name, group), (tag, name, ANY), (tag, ANY, group), (tag, ANY, ANY)):
+            index.setdefault(key, []).append(node)
+    return index
+
+
+def index_first(index: dict, tag: str, name=ANY, group=ANY):
+    """ Returns the first indexed tag matching tag, name and group or None (equivalent to findChild). """
+    nodes = index.get((tag, name, group))
+    return nodes[0] if nodes else None
+
+
+def index_all(index: dict, tag: str, name=ANY, group=ANY):
+    """ Returns all indexed tags matching tag, name and group (equivalent to findChildren). """
+    return index.get((tag, name, group), [])
 
 
 # Extractions: Metadata, Counts and Derived Values from Single XML ####################################################
 
-def xml_extract_metadata(xml_soup, output_dict: dict):
+# Identification elements extracted as metadata of every xml (besides the station_identifier, which can be missing)
+METADATA_ELEMENTS = ('date_time', 'tc_identifier', 'station_name', 'station_elevation',
+                     'latitude', 'longitude', 'version', 'correction', 'source_uri')
+
+
+def xml_extract_metadata(xml_soup, output_dict: dict, id_index: dict = None):
     """ Extracts metadata for identification (station, time and location) from top of xml.
 
     Params:
         output_dict (dict) - Dictionary to add information to
         xml_soup (BeautifulSoup object) - beautifulSoup object containing the loaded xml information.
+        id_index (dict) - Index of the identification-elements (see soup_index), is created if not given.
 
     Returns:
         output_dict (dict) - Updated dictionary with added metadata information
     """
-    identification_elements = xml_soup.find("identification-elements")
-    id_element_list = ['date_time', 'tc_identifier', 'station_name', 'station_elevation',
-                       'latitude', 'longitude', 'version', 'correction', 'source_uri']
-    for id_element in id_element_list:
+    if id_index is None:
+        id_index = soup_index(xml_soup.find("identification-elements"))
+    for id_element in METADATA_ELEMENTS:
         try:
-            output_dict[id_element] = identification_elements.findChild(name='element',
-                                                                        attrs={'name': id_element}
-                                                                        ).get("value")
-        except AttributeError as error:
-            print(error, ". Possibly element '%s' is missing." % id_element)
+            output_dict[id_element] = index_first(id_index, 'element', name=id_element).get("value")
+        except AttributeError:
+            record_anomaly('missing_metadata_element', "Element '%s' is missing." % id_element)
 
     # Station identifier are missing in some xml files
-    try:
-        output_dict['station_identifier'] = identification_elements.findChild(name='element',
-                                                                              attrs={'name': 'station_identifier'}
-                                                                              ).get("value")
-    finally:
-        return output_dict
+    station_identifier = index_first(id_index, 'element', name='station_identifier')
+    if station_identifier is None:
+        record_anomaly('missing_station_identifier', "Element 'station_identifier' is missing in %s." % (
+            output_dict.get('source_uri')))
+    else:
+        output_dict['station_identifier'] = station_identifier.get("value")
+    return output_dict
 
 
-def xml_extract_comparision_value(xml_soup):
+def xml_extract_comparision_value(xml_soup, id_index: dict = None):
     """ Extracts summary statistics from xml (counts of occurrences of all QA flag values).
 
     These codes only exist in some files and therefore are an indicator of the availability is also added.
 
     Params:
         xml_soup (BeautifulSoup object) - beautifulSoup object containing the loaded xml information.
+        id_index (dict) - Index of the identification-elements (see soup_index), is created if not given.
 
     Returns:
         check_stat (dict) - Dictionary with counts for each automatic labeling category
     """
-    check_stat = {}
+    if id_index is None:
+        id_index = soup_index(xml_soup.find("identification-elements"))
+    qa_summary = {node.get('name'): node.get('value') for node in index_all(id_index, 'element', group='qa_summary')}
+    return qa_summary_comparision_value(qa_summary=qa_summary)
+
 
-    identification_elements = xml_soup.find("identification-elements")
-    if len(identification_elements.findChildren(name='element', attrs={'group': 'qa_summary'})) == 7:
-        check_stat["missing_count"] = identification_elements.findChild(name='element',
-                                                                        attrs={'name': 'missing_count'}
-                                                                        ).get("value")
-        check_stat["erroneous_count"] = identification_elements.findChild(name='element',
-                                                                          attrs={'name': 'erroneous_count'}
-                                                                          ).get("value")
-        check_stat["accepted_count"] = identification_elements.findChild(name='element',
-                                                                         attrs={'name': 'accepted_count'}
-                                                                         ).get("value")
-        check_stat["suppressed_count"] = identification_elements.findChild(name='element',
-                                                                           attrs={'name': 'suppressed_count'}
-                                                                           ).get("value")
-        check_stat["doubtful_count"] = identification_elements.findChild(name='element',
-                                                                         attrs={'name': 'doubtful_count'}
-                                                                         ).get("value")
-        check_stat["total_qa_count"] = identification_elements.findChild(name='element',
-                                                                         attrs={'name': 'elements_quality_assessed_count'}
-                                                                         ).get("value")
+def qa_summary_comparision_value(qa_summary: dict):
+    """ Builds the summary statistics (see xml_extract_comparision_value) from the values of the qa_summary elements
+    with their name as key. """
+    check_stat = {}
+    if len(qa_summary) == 7:
+        check_stat["missing_count"] = qa_summary.get('missing_count')
+        check_stat["erroneous_count"] = qa_summary.get('erroneous_count')
+        check_stat["accepted_count"] = qa_summary.get('accepted_count')
+        check_stat["suppressed_count"] = qa_summary.get('suppressed_count')
+        check_stat["doubtful_count"] = qa_summary.get('doubtful_count')
+        check_stat["total_qa_count"] = qa_summary.get('elements_quality_assessed_count')
         check_stat['missing_qa_summary_stat'] = False
     else:
         check_stat['missing_qa_summary_stat'] = True
@@ -122,16 +285,14 @@ def xml_extract_derived_values(xml_soup, output_dict: dict):
                 'std-pkg-id') + '-derived'
             output_dict[var_name] = observation.get('value')
         elif observation.get('group') != "qa_summary":
-            print("Found unexpected element while parsing for derived values:")
-            print(observation.get("name"))
-            print(observation)
+            record_anomaly('unexpected_derived_element', str(observation))
 
     return output_dict
 
 
 # Observations: Extractions from Single Observation in XML ############################################################
 
-def observation_extract_prefix(observation_soup):
+def observation_extract_prefix(observation_soup, observation_index: dict = None):
     """ Construct unique identify for each transmitted test which can be used as prefix
 
         Prefix consists of description (name) plus unique identifier (orig-name) as sometimes measurements
@@ -139,6 +300,7 @@ def observation_extract_prefix(observation_soup):
 
         Params:
             observation_soup (BeautifulSoup object) - beautifulSoup object containing single <element> tag from the xml
+            observation_index (dict) - Index of the observation (see soup_index), is created if needed and not given.
 
         Returns:
              prefix (str) - unique identifier for an observation which can be prefixed to identify all related values
@@ -146,7 +308,9 @@ def observation_extract_prefix(observation_soup):
     if observation_soup.get("name") == "dummy_bypass_sensor":
         # name="dummy_bypass_sensor" and orig-name="999" is not unique
         # (only exception and not necessarily important but valuable to keep for count check)
-        sensor_index = observation_soup.findChild("qualifier", attrs={"name": "sensor_index"}).get("value")
+        if observation_index is None:
+            observation_index = soup_index(observation_soup)
+        sensor_index = index_first(observation_index, "qualifier", name="sensor_index").get("value")
         prefix = observation_soup.get("name") + "_" + observation_soup.get(
             "orig-name") + '_sensor_index_' + sensor_index
     else:
@@ -154,32 +318,32 @@ def observation_extract_prefix(observation_soup):
     return prefix
 
 
-def observation_extract_native_codes(observation_soup, output_dict: dict, prefix: str):
+def observation_extract_native_codes(observation_soup, output_dict: dict, prefix: str, observation_index: dict = None):
     """Extracts native error codes send by stations/provider from a given single <element> tag (aka observation)
 
     Params:
         observation_soup (BeautifulSoup object) - beautifulSoup object containing single <element> tag from the xml
         output_dict (dict) - Dictionary to add information to
         prefix (string) - String to append before all extracted values to define referenced variable.
+        observation_index (dict) - Index of the observation (see soup_index), is created if not given.
 
     Returns:
         output_dict (dict) - Updated dictionary with added key-value pairs for native error codes
     """
+    if observation_index is None:
+        observation_index = soup_index(observation_soup)
     # values related to native error codes send by stations/provider
-    output_dict[prefix + "_native-error"] = observation_soup.findChild(name='qualifier',
-                                                                       attrs={'name': 'error', 'group': 'quality'},
-                                                                       recursive=True).get("value")
-    output_dict[prefix + "_native-suspect"] = observation_soup.findChild(name='qualifier',
-                                                                         attrs={'name': 'suspect', 'group': 'quality'},
-                                                                         recursive=True).get("value")
-    output_dict[prefix + "_native-suppressed"] = observation_soup.findChild(name='qualifier',
-                                                                            attrs={'name': 'suppressed',
-                                                                                   "group": "value"},
-                                                                            recursive=True).get("value")
+    output_dict[prefix + "_native-error"] = index_first(observation_index, 'qualifier',
+                                                        name='error', group='quality').get("value")
+    output_dict[prefix + "_native-suspect"] = index_first(observation_index, 'qualifier',
+                                                          name='suspect', group='quality').get("value")
+    output_dict[prefix + "_native-suppressed"] = index_first(observation_index, 'qualifier',
+                                                             name='suppressed', group='value').get("value")
     return output_dict
 
 
-def observation_extract_qa_category_results(observation_soup, output_dict, category, prefix, output_subtests=True):
+def observation_extract_qa_category_results(observation_soup, output_dict, category, prefix, output_subtests=True,
+                                            observation_index: dict = None):
     """ Extracts the flag values for a given category of the QA assessment from a single observation.
 
     Params:
@@ -187,6 +351,7 @@ def observation_extract_qa_category_results(observation_soup, output_dict, categ
         output_dict (dict) - Dictionary to add information to
         prefix (string) - String to append before all extracted values to define referenced variable.
         output_subtests (boolean) - Indicator if only summary flag (False) or all flag values (True) should be added.
+        observation_index (dict) - Index of the observation (see soup_index), is created if not given.
 
     Returns:
         output_dict (dict) - Updated dictionary with added key-value pairs with QA assessment results for category
@@ -194,20 +359,45 @@ def observation_extract_qa_category_results(observation_soup, output_dict, categ
 
     assert category in ['presence', 'range', 'integrity', 'intervariable_comparison', 'temporal']
 
-    obs_category_results = observation_soup.findChild(name='element',
-                                                      attrs={'name': category + '_summary', "group": "assessment"},
-                                                      recursive=True)
+    if observation_index is None:
+        observation_index = soup_index(observation_soup)
+    obs_category_results = index_first(observation_index, 'element', name=category + '_summary', group='assessment')
     if obs_category_results:
         output_dict[prefix + "_qa-" + category + '_summary'] = obs_category_results.get("value")
         if output_subtests:
-            for subtest in obs_category_results.findChildren(name='element'):
+            # The flag_value qualifiers are indexed in document order, each belongs to the subtest element it is a
+            # child of, whose parent is the summary of its category
+            for flag_value in index_all(observation_index, 'qualifier', name='flag_value'):
+                subtest = flag_value.parent
+                if subtest.parent is not obs_category_results:
+                    continue
                 # Unique identifier for each test is the number in the last level of the test path
-                test_path = subtest.get('value')
-                test_num = os.path.basename(test_path)
-                output_dict[prefix + "_qa-" + category + "_" + test_num] = subtest.findChild(name="qualifier",
-                                                                                             attrs={
-                                                                                                 "name": "flag_value"}
-                                                                                             ).get("value")
+                test_num = os.path.basename(subtest.get('value'))
+                output_dict[prefix + "_qa-" + category + "_" + test_num] = flag_value.get("value")
+    return output_dict
+
+
+def observation_extract_status_indicators(observation_index: dict, output_dict: dict, prefix: str,
+                                          index_function=soup_index):
+    """ Extracts the manual correction (overrides and remark) from the status-indicators of a corrected observation.
+
+    Params:
+        observation_index (dict) - Index of the observation (see soup_index)
+        output_dict (dict) - Dictionary to add information to
+        prefix (string) - String to append before all extracted values to define referenced variable.
+        index_function (function) - Function to index the status-indicators (soup_index or etree_index)
+
+    Returns:
+        output_dict (dict) - Updated dictionary with added key-value pairs for the overrides and the qc remark
+    """
+    status_index = index_function(index_first(observation_index, "status-indicators"))
+    qa_flag_override = index_first(status_index, "element", name="qa_flag_override")
+    value_override = index_first(status_index, "element", name="value_override")
+    if qa_flag_override is not None:
+        output_dict[prefix + "_qa_flag_override"] = qa_flag_override.get("value")
+    elif value_override is not None:
+        output_dict[prefix + "_value_override"] = value_override.get("value")
+    output_dict[prefix + "_qc_remark"] = index_first(status_index, "element", name="qc_remark").get("value")
     return output_dict
 
 
@@ -242,44 +432,40 @@ def xml_extraction_loop_observations(output_dict: dict,
     elements = xml_soup.find("elements").findChildren("element", attrs={"element-index": True,
                                                                         "name": True,
                                                                         "orig-name": True}, recursive=False)
+    count('elements', len(elements))
 
     for observation in elements:
-        if (version == '0') or (observation.findChild("status-indicators", recursive=True)):
-            prefix = observation_extract_prefix(observation)
+        # All lookups within the observation are served by an index which is built in a single walk
+        observation_index = soup_index(observation)
+        if (version == '0') or index_first(observation_index, "status-indicators"):
+            count('observations')
+            prefix = observation_extract_prefix(observation, observation_index=observation_index)
             if observation.has_attr('orig-value'):
                 output_dict[prefix + "_orig-value"] = observation.get("orig-value")
             if observation.has_attr('value'):
                 output_dict[prefix + "_value"] = observation.get("value")
 
-            output_dict[prefix + "_overall_qa_summary"] = observation.findChild(name='element',
-                                                                                attrs={'name': 'overall_qa_summary'},
-                                                                                recursive=True).get("value")
+            output_dict[prefix + "_overall_qa_summary"] = index_first(observation_index, 'element',
+                                                                      name='overall_qa_summary').get("value")
 
             for qa_category in qa_category_list:
                 output_dict = observation_extract_qa_category_results(observation_soup=observation,
                                                                       output_dict=output_dict,
                                                                       category=qa_category,
                                                                       prefix=prefix,
-                                                                      output_subtests=output_subtests)
+                                                                      output_subtests=output_subtests,
+                                                                      observation_index=observation_index)
 
             if native_codes:
                 output_dict = observation_extract_native_codes(observation,
                                                                output_dict,
-                                                               prefix=prefix)
+                                                               prefix=prefix,
+                                                               observation_index=observation_index)
 
             if version != '0':
-                status_indicator = observation.findChild("status-indicators", recursive=True)
-                if status_indicator.findChild("element", attrs={"name": "qa_flag_override"}):
-                    output_dict[prefix + "_qa_flag_override"] = status_indicator.findChild("element",
-                                                                                           attrs={"name": "qa_flag_override"}
-                                                                                           ).get("value")
-                elif status_indicator.findChild("element", attrs={"name": "value_override"}):
-                    output_dict[prefix + "_value_override"] = status_indicator.findChild("element",
-                                                                                         attrs={"name": "value_override"}
-                                                                                         ).get("value")
-                output_dict[prefix + "_qc_remark"] = status_indicator.findChild("element",
-                                                                                attrs={"name": "qc_remark"}
-                                                                                ).get("value")
+                output_dict = observation_extract_status_indicators(observation_index=observation_index,
+                                                                    output_dict=output_dict,
+                                                                    prefix=prefix)
 
     return output_dict
 
@@ -288,24 +474,219 @@ def xml_extraction_complete_compose(xml_path: str,
                                     qa_category_list=('presence', 'range', 'integrity', 'intervariable_comparison',
                                                       'temporal'),
                                     output_subtests: bool = True,
-                                    native_codes: bool = True):
+                                    native_codes: bool = True,
+                                    backend: str = 'bs4',
+                                    xml_content: bytes = None):
     """ Composes an unified extraction dictionary per xml containing the meta data, derived values and
     measurements/tests as well as the original filename for verification.
+
+    The backend "bs4" builds a complete BeautifulSoup tree per file, while "lxml" streams through the file once with
+    lxml.etree.iterparse (see etree_extraction_complete_compose). Both return the same dictionary.
+    If the xml_content is given (e.g. a payload of an export), it is extracted in memory and xml_path is only used as
+    origin_filename.
     """
+    assert backend in EXTRACTION_BACKENDS
+    if backend == 'lxml':
+        return etree_extraction_complete_compose(xml_path=xml_path,
+                                                 qa_category_list=qa_category_list,
+                                                 output_subtests=output_subtests,
+                                                 native_codes=native_codes,
+                                                 xml_content=xml_content)
+
+    count('files')
     station_data = {}
-    soup = xml2soup(xml_path)
-    station_data = xml_extract_metadata(xml_soup=soup, output_dict=station_data)
+    soup = xml2soup(xml_path, xml_content=xml_content)
+    with stage_timer('metadata'):
+        station_data = xml_extract_metadata(xml_soup=soup, output_dict=station_data)
 
     # Only the original versions contain the derived values.
     if station_data['version'] == '0':
-        station_data = xml_extract_derived_values(xml_soup=soup,
-                                                  output_dict=station_data)
-    station_data = xml_extraction_loop_observations(output_dict=station_data,
-                                                    qa_category_list=qa_category_list,
-                                                    xml_soup=soup,
-                                                    output_subtests=output_subtests,
-                                                    native_codes=native_codes,
-                                                    version=station_data['version'])
+        with stage_timer('derived'):
+            station_data = xml_extract_derived_values(xml_soup=soup,
+                                                      output_dict=station_data)
+    with stage_timer('observations'):
+        station_data = xml_extraction_loop_observations(output_dict=station_data,
+                                                        qa_category_list=qa_category_list,
+                                                        xml_soup=soup,
+                                                        output_subtests=output_subtests,
+                                                        native_codes=native_codes,
+                                                        version=station_data['version'])
+    # For debugging purposes we will add the source information
+    station_data['origin_filename'] = xml_path
+    return station_data
+
+
+# Streaming Extraction (lxml) #########################################################################################
+
+EXTRACTION_BACKENDS = ('bs4', 'lxml')
+
+# The xml uses a default namespace whose version differs between files, therefore all lookups match the local name.
+_XPATH_QUALIFIER_BY_NAME = etree.XPath("(.//*[local-name()='qualifier'][@name=$name])[1]")
+_XPATH_QUALIFIER_DERIVED = etree.XPath("(.//*[local-name()='qualifier'][@value='derived'])[1]")
+_XPATH_ALL_ELEMENTS = etree.XPath(".//*[local-name()='element']")
+
+_ETREE_STREAM_TAGS = ('{*}identification-elements', '{*}element')
+
+
+def _xpath_first(xpath, node, **variables):
+    """ Returns the first node found by a compiled XPath or None (equivalent to findChild of BeautifulSoup). """
+    result = xpath(node, **variables)
+    return result[0] if result else None
+
+
+def _local_tag(node):
+    """ Returns the tag of an lxml element without its namespace. """
+    return node.tag.rpartition('}')[2]
+
+
+def etree_extract_derived_value(observation, output_dict: dict):
+    """ lxml equivalent of xml_extract_derived_values for a single <element> without element-index. """
+    if (_xpath_first(_XPATH_QUALIFIER_DERIVED, observation) is not None) or (
+            observation.get('name') in ['minimum_air_temperature_time', 'maximum_air_temperature_time']):
+        var_name = observation.get('group') + '-' + observation.get('name') + '-' + observation.get(
+            'std-pkg-id') + '-derived'
+        output_dict[var_name] = observation.get('value')
+    elif observation.get('group') != "qa_summary":
+        record_anomaly('unexpected_derived_element', etree.tostring(observation, encoding='unicode'))
+    return output_dict
+
+
+def etree_extract_observation(observation,
+                              output_dict: dict,
+                              qa_category_list=('presence', 'range', 'integrity', 'intervariable_comparison',
+                                                'temporal'),
+                              output_subtests: bool = True,
+                              native_codes: bool = True,
+                              version='0'):
+    """ lxml equivalent of a single iteration of xml_extraction_loop_observations.
+
+    Params:
+        observation (lxml element) - Completely parsed <element> tag with an element-index.
+        output_dict (dict) - Dictionary to add information to
+        qa_category_list (list) - List of all QA categories whose flag values should be extracted
+        output_subtests (boolean) - Indicator if only summary flag (False) or all flag values (True) should be added.
+        native_codes (boolean) - Indicator if natives codes are to be extracted
+        version (str) - String with the version number from the XML
+
+    Returns:
+        output_dict (dict) - Updated dictionary with added key-value pairs for the sensor
+    """
+    count('elements')
+    observation_index = etree_index(observation)
+    status_indicator = index_first(observation_index, "status-indicators")
+    if (version != '0') and (status_indicator is None):
+        return output_dict
+    count('observations')
+
+    prefix = observation_extract_prefix(observation, observation_index=observation_index)
+
+    if observation.get('orig-value') is not None:
+        output_dict[prefix + "_orig-value"] = observation.get("orig-value")
+    if observation.get('value') is not None:
+        output_dict[prefix + "_value"] = observation.get("value")
+
+    output_dict[prefix + "_overall_qa_summary"] = index_first(observation_index, 'element',
+                                                              name='overall_qa_summary').get("value")
+
+    for category in qa_category_list:
+        obs_category_results = index_first(observation_index, 'element', name=category + '_summary',
+                                           group='assessment')
+        if obs_category_results is not None:
+            output_dict[prefix + "_qa-" + category + '_summary'] = obs_category_results.get("value")
+            if output_subtests:
+                for subtest in _XPATH_ALL_ELEMENTS(obs_category_results):
+                    test_num = os.path.basename(subtest.get('value'))
+                    output_dict[prefix + "_qa-" + category + "_" + test_num] = _xpath_first(
+                        _XPATH_QUALIFIER_BY_NAME, subtest, name="flag_value").get("value")
+
+    if native_codes:
+        output_dict = observation_extract_native_codes(observation,
+                                                       output_dict,
+                                                       prefix=prefix,
+                                                       observation_index=observation_index)
+
+    if version != '0':
+        output_dict = observation_extract_status_indicators(observation_index=observation_index,
+                                                            output_dict=output_dict,
+                                                            prefix=prefix,
+                                                            index_function=etree_index)
+    return output_dict
+
+
+def etree_extraction_complete_compose(xml_path: str,
+                                      qa_category_list=('presence', 'range', 'integrity', 'intervariable_comparison',
+                                                        'temporal'),
+                                      output_subtests: bool = True,
+                                      native_codes: bool = True,
+                                      xml_content: bytes = None):
+    """ Streaming version of xml_extraction_complete_compose based on lxml.etree.iterparse.
+
+    The file is read once and only the end events of <identification-elements> and <element> tags are dispatched.
+    Each top level <element> of the first <elements> block is extracted as soon as it is complete and freed afterwards,
+    so at no time the complete tree is held in memory. Lookups within an observation use its index (see etree_index).
+
+    Params:
+        xml_path (str) - Path to xml to be extracted
+        qa_category_list (list) - List of all QA categories whose flag values should be extracted
+        output_subtests (boolean) - Indicator if only summary flag (False) or all flag values (True) should be added.
+        native_codes (boolean) - Indicator if natives codes are to be extracted
+        xml_content (bytes) - Content of the xml which is streamed instead of reading xml_path
+
+    Returns:
+        station_data (dict) - Same dictionary as xml_extraction_complete_compose with the "bs4" backend
+    """
+    assert all(cat in ['presence', 'range', 'integrity', 'intervariable_comparison', 'temporal']
+               for cat in qa_category_list)
+
+    station_data = {}
+    # Derived values precede the observations in the dictionary independent of their position in the xml
+    derived_data = {}
+    observation_data = {}
+    metadata_done = False
+    elements_block = None
+
+    xml_source = xml_path if xml_content is None else io.BytesIO(xml_content)
+    count('files')
+    count('bytes', os.path.getsize(xml_path) if xml_content is None else len(xml_content))
+    # Reading, parsing and extraction are interleaved by iterparse and therefore timed as a single stage
+    with stage_timer('stream_extract'):
+        for _, node in etree.iterparse(xml_source, events=('end',), tag=_ETREE_STREAM_TAGS):
+            parent = node.getparent()
+            if _local_tag(node) == 'identification-elements':
+                if not metadata_done:
+                    station_data = xml_extract_metadata(xml_soup=None, output_dict=station_data,
+                                                        id_index=etree_index(node))
+                    metadata_done = True
+                node.clear()
+                continue
+
+            if parent is None or _local_tag(parent) != 'elements':
+                # Nested <element> tags are handled when their enclosing observation is complete
+                continue
+            if elements_block is None:
+                elements_block = parent
+            elif parent is not elements_block:
+                continue
+
+            if node.get('element-index') is not None:
+                if node.get('name') is not None and node.get('orig-name') is not None:
+                    observation_data = etree_extract_observation(observation=node,
+                                                                 output_dict=observation_data,
+                                                                 qa_category_list=qa_category_list,
+                                                                 output_subtests=output_subtests,
+                                                                 native_codes=native_codes,
+                                                                 version=station_data['version'])
+            elif node.get('name') is not None and station_data['version'] == '0':
+                # Only the original versions contain the derived values.
+                derived_data = etree_extract_derived_value(observation=node, output_dict=derived_data)
+
+            # Free the consumed observation and all its predecessors
+            node.clear()
+            while node.getprevious() is not None:
+                del parent[0]
+
+    station_data.update(derived_data)
+    station_data.update(observation_data)
     # For debugging purposes we will add the source information
     station_data['origin_filename'] = xml_path
     return station_data
@@ -318,40 +699,224 @@ def compare_to_count_values(xml_dict: dict, compare_dict: dict):
     if compare_dict['missing_qa_summary_stat']:
         print("No comparision values for test in XML.")
     else:
-        df_xml = pd.DataFrame({"xml": xml_dict})
-        index = [i for i in df_xml.index if i.endswith('overall_qa_summary')]
-        df_xml = df_xml.loc[index]
-        xml_counts = df_xml['xml'].value_counts()
-
-        flag_meaning = {'-1': 'missing_count',
-                        '0': 'erroneous_count',
-                        '100': 'accepted_count',
-                        '-10': 'suppressed_count',
-                        '10': 'doubtful_count',
-                        'total': 'total_qa_count'}
-
-        xml_counts.index = xml_counts.reset_index()['index'].replace(flag_meaning).values
-        xml_counts = pd.DataFrame(xml_counts)
-        assert xml_counts.xml.sum() == int(compare_dict['total_qa_count']), print(
-            'Extracted %d values from xml, expected %d' % (
-                xml_counts.xml.sum(), int(compare_dict['total_qa_count'])))
-        df_check = pd.DataFrame({"check_sum": compare_dict})
-        df_check.drop('total_qa_count', inplace=True)
-        df_check.drop('missing_qa_summary_stat', inplace=True)
-        df_check = df_check.merge(xml_counts, how='left', left_index=True, right_index=True).fillna(0)
-        df_check['valid'] = (df_check.check_sum.astype(int) == df_check.xml)
+        df_check = batch_compare_to_count_values(df_xml=pd.DataFrame([xml_dict]),
+                                                 df_counts=pd.DataFrame([compare_dict]),
+                                                 only_mismatches=False)
         assert df_check.valid.all(), print('Some categories have an unexpected number of values extracted \n', df_check)
         print("All value counts for flag categories match the value count in the extraction for file.",
               xml_dict["station_name"],
               xml_dict["date_time"])
 
 
+# Meaning of the QA flag values counted in the qa_summary of the identification-elements
+QA_FLAG_COUNT_NAMES = {'-1': 'missing_count',
+                       '0': 'erroneous_count',
+                       '100': 'accepted_count',
+                       '-10': 'suppressed_count',
+                       '10': 'doubtful_count'}
+
+
+def sampled_for_validation(file_name: str, validation_rate: float):
+    """ Decides based on the checksum of the file name if a file belongs to the sample which is validated. """
+    return validation_rate > 0 and zlib.crc32(file_name.encode()) / 2 ** 32 < validation_rate
+
+
+def batch_compare_to_count_values(df_xml, df_counts, only_mismatches: bool = True):
+    """ Vectorized version of compare_to_count_values for many extractions at once which reports the mismatches
+    instead of raising on the first one.
+
+    Params:
+        df_xml (pd.DataFrame) - Extractions with one row per file (e.g. pd.DataFrame.from_dict(chunk, orient='index'))
+        df_counts (pd.DataFrame) - Comparision values with the same index (see xml_extract_comparision_value), files
+                                   without summary statistics in the xml are left out
+        only_mismatches (bool) - Indicator if only the categories with differing counts are reported
+
+    Returns:
+        report (pd.DataFrame) - Expected and extracted count per file (index level "file_id") and flag category
+                                (index level "category") with the indicator "valid"
+    """
+    df_counts = df_counts[~df_counts['missing_qa_summary_stat'].astype(bool)]
+    df_counts = df_counts.loc[df_counts.index.intersection(df_xml.index)]
+    summary_columns = [column for column in df_xml.columns if column.endswith('overall_qa_summary')]
+    flags = df_xml.loc[df_counts.index, summary_columns].to_numpy(dtype=object)
+
+    extracted = {count_name: (flags == flag).sum(axis=1) for flag, count_name in QA_FLAG_COUNT_NAMES.items()}
+    extracted['total_qa_count'] = pd.notna(flags).sum(axis=1)
+    df_extracted = pd.DataFrame(extracted, index=df_counts.index)
+    df_expected = df_counts[list(df_extracted.columns)].astype(int)
+
+    report = pd.DataFrame({'expected': df_expected.stack(), 'extracted': df_extracted.stack()})
+    report.index.names = ['file_id', 'category']
+    report['valid'] = report['expected'] == report['extracted']
+    if only_mismatches:
+        report = report[~report['valid']]
+    return report
+
+
+def save_validation_report(output_path: str, report):
+    """ Prints a summary of a validation report (see batch_compare_to_count_values) and saves its mismatches to the
+    file extraction_validation.csv in the output folder (which is removed if there are none). """
+    mismatches = report[~report['valid']]
+    mismatch_files = mismatches.index.get_level_values('file_id').unique()
+    print("--- Validated %d files against their summary statistics: %d with mismatching flag counts.---" % (
+        report.index.get_level_values('file_id').nunique(), len(mismatch_files)))
+    if len(mismatches):
+        mismatches.to_csv(output_path + 'extraction_validation.csv')
+    elif os.path.exists(output_path + 'extraction_validation.csv'):
+        os.remove(output_path + 'extraction_validation.csv')
+
+
+def compare_extraction_backends(xml_paths: list,
+                                qa_category_list=('presence', 'range', 'integrity', 'intervariable_comparison',
+                                                  'temporal'),
+                                output_subtests: bool = True,
+                                native_codes: bool = True):
+    """ Sanity check that all extraction backends produce the same dictionary for each of the given xml files, e.g.
+    for a sample of the archive before switching the backend (tests/test_backend_parity.py covers the payload layouts).
+
+    Params:
+        xml_paths (list) - List of paths to the xml files which should be compared
+        qa_category_list (list) - List of all QA categories whose flag values should be extracted
+        output_subtests (boolean) - Indicator if only summary flag (False) or all flag values (True) should be added.
+        native_codes (boolean) - Indicator if natives codes are to be extracted
+    """
+    for xml_path in xml_paths:
+        results = {backend: xml_extraction_complete_compose(xml_path,
+                                                            qa_category_list=qa_category_list,
+                                                            output_subtests=output_subtests,
+                                                            native_codes=native_codes,
+                                                            backend=backend)
+                   for backend in EXTRACTION_BACKENDS}
+        reference = results[EXTRACTION_BACKENDS[0]]
+        for backend, station_data in results.items():
+            differences = {key for key in set(reference) | set(station_data)
+                           if reference.get(key) != station_data.get(key)}
+            assert not differences, 'Backend %s differs from %s for %s in keys: %s' % (
+                backend, EXTRACTION_BACKENDS[0], xml_path, sorted(differences))
+            assert list(reference) == list(station_data), \
+                'Backend %s returns the keys in a different order for %s' % (backend, xml_path)
+    print("All extraction backends return identical dictionaries for %d files." % len(xml_paths))
+
+
+# QA Prefilter ########################################################################################################
+
+# Key marking the light records of files whose automatic QA passed completely (see qa_prefilter)
+QA_PREFILTER_KEY = 'qa_prefilter'
+
+
+def xml_header_values(xml_path: str, xml_content: bytes = None):
+    """ Reads the values of the identification-elements at the top of a xml (see iter_header_elements).
+
+    Returns:
+        metadata (dict), qa_summary (dict) - Values of the elements by their name, the ones of the group qa_summary
+                                             separately
+    """
+    metadata = {}
+    qa_summary = {}
+    for node in iter_header_elements(xml_path=xml_path, xml_content=xml_content):
+        values = qa_summary if node.get('group') == 'qa_summary' else metadata
+        values.setdefault(node.get('name'), node.get('value'))
+    return metadata, qa_summary
+
+
+def qa_header_states(file_paths: list):
+    """ Reads the header of each file and returns its observation time, version and the state of its automatic QA
+    according to the qa_summary counts: "passed" (all flags are 100), "failed" or "unknown" (no counts). """
+    header_states = []
+    for file_path in file_paths:
+        metadata, qa_summary = xml_header_values(file_path)
+        if 'source_uri' not in metadata:
+            continue
+        check_stat = qa_summary_comparision_value(qa_summary=qa_summary)
+        if check_stat['missing_qa_summary_stat']:
+            qa_state = 'unknown'
+        else:
+            qa_state = 'passed' if check_stat['accepted_count'] == check_stat['total_qa_count'] else 'failed'
+        header_states.append((file_path, station_time_identifier(metadata), metadata.get('version'), qa_state))
+    return header_states
+
+
+def qa_prefilter(file_paths: list, multi_process: bool = True):
+    """ Decides from the headers of the files which ones are extracted completely for qa_failed_only.
+
+    Training only uses records whose automatic QA did not pass (any overall_qa_summary not null and not 100) and the
+    post-MC labels of corrected observations. So all manual corrections (version > 0), the originals of corrected
+    observation times and files whose qa_summary counts contain any flag other than 100 are extracted completely. Files
+    whose flags are all 100 only get a light record (see qa_light_record). Files without counts are scanned for a
+    failed overall_qa_summary first (see xml_observations_passed).
+
+    Params:
+        file_paths (list) - Paths of all xml files of the extraction (the versions of an observation time can be in
+                            different chunks)
+        multi_process (bool) - Indicator if the headers are read by all available kernels
+
+    Returns:
+        prefilter (dict) - File path as key and "light" or "scan" as value, files which are not contained are
+                           extracted completely
+    """
+    if multi_process:
+        header_states = [header_state for chunk_states in Parallel(n_jobs=multiprocessing.cpu_count())(
+            delayed(qa_header_states)(file_chunk) for file_chunk in list_chunking(file_paths).values())
+            for header_state in chunk_states]
+    else:
+        header_states = qa_header_states(file_paths)
+    corrected = {station_time for _, station_time, version, _ in header_states if version != '0'}
+    prefilter = {}
+    for file_path, station_time, version, qa_state in header_states:
+        if version != '0' or station_time in corrected or qa_state == 'failed':
+            continue
+        prefilter[file_path] = 'light' if qa_state == 'passed' else 'scan'
+    print("--- QA prefilter: %d of %d files passed the automatic QA, %d without counts are scanned.---" % (
+        sum(state == 'light' for state in prefilter.values()), len(file_paths),
+        sum(state == 'scan' for state in prefilter.values())))
+    return prefilter
+
+
+def xml_observations_passed(xml_path: str):
+    """ Checks if the automatic QA of all observations passed by streaming only the overall_qa_summary elements, the
+    scan stops at the first failed observation (overall_qa_summary not null and not 100). """
+    with stage_timer('qa_scan'):
+        for _, node in etree.iterparse(xml_path, events=('end',), tag='{*}element'):
+            if node.get('name') == 'overall_qa_summary' and node.get('value') not in (None, '100'):
+                return False
+            node.clear()
+    return True
+
+
+def qa_light_record(xml_path: str):
+    """ Returns the light record of a file whose automatic QA passed: only the metadata (see xml_extract_metadata) and
+    the qa_summary counts from its header, marked with QA_PREFILTER_KEY. """
+    count('light_records')
+    metadata, qa_summary = xml_header_values(xml_path)
+    station_data = {name: metadata[name] for name in METADATA_ELEMENTS + ('station_identifier',) if name in metadata}
+    station_data.update(qa_summary)
+    station_data[QA_PREFILTER_KEY] = 'passed'
+    station_data['origin_filename'] = xml_path
+    return station_data
+
+
 # Helper functions #####################################################################################################
 
 def save_pickle(folder_path: str, file_name: str, save_object):
-    """Helper function to save an object to a pickle file """
-    with open(folder_path + file_name + '.pickle', 'wb') as handle:
+    """Helper function to save an object to a pickle file (written to a temporary file and renamed, so an interrupted
+    process never leaves a truncated pickle behind) """
+    temporary_path = folder_path + file_name + '.tmp'
+    with stage_timer('pickle'), open(temporary_path, 'wb') as handle:
         pickle.dump(save_object, handle, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(temporary_path, folder_path + file_name + '.pickle')
+
+
+def save_chunk_pickle(folder_path: str, chunk_name: str, chunk, registry: dict = None):
+    """ Saves a chunk pickle of the output folder together with its column sidecar (see chunk_union), so the
+    columns of the extraction can be combined without loading every chunk first. """
+    save_pickle(folder_path=folder_path, file_name=chunk_name, save_object=chunk)
+    save_chunk_columns(folder_path=folder_path, chunk_name=chunk_name, chunk=chunk, registry=registry)
+
+
+def read_pickle(file: str):
+    """Helper function to load an object from a pickle file """
+    with open(file, 'rb') as handle:
+        return pickle.load(handle)
 
 
 # Main usage for the inversion of the mapping between filename and station to get for each station all file names at once.
@@ -365,6 +930,12 @@ def inverse_dict(input_dict: dict):
     return inv_map
 
 
+def extraction_output_path(input_folder_path: str):
+    """ Returns the output folder of the extraction of an input folder (the input folder with 'raw' replaced by
+    'interim'). """
+    return input_folder_path.replace('raw', 'interim')
+
+
 def ensure_folder_exists(folder_path: str):
     """" Check whether folder exists and if not create folder. """
     if not os.path.exists(folder_path):
@@ -396,18 +967,27 @@ def dict_keys_containing_substring(xml_dict: dict, sub_string: str, sensor_value
 
 # Chunking Methods ####################################################################################################
 
+def list_xml_payloads(folder_path: str):
+    """ Lists the names of all xml payloads in a folder (see is_xml_payload). """
+    return [file for file in os.listdir(folder_path) if is_xml_payload(folder_path + file)]
+
+
 def create_mapping_filename2station(folder: list, folder_path: str, multi_process: bool):
     """ Creates a dictionary with the xml filename as key and station as a value. This enables the chunking of the data
     by station instead of randomly processing a certain amount of files.
+
+    Only the header of each file is read (see xml_header_source_uri). Files without a source uri are no valid payloads
+    and are mapped to None, so that later runs neither read nor report them again.
     """
     result_dict = {}
     if not multi_process:
         for file in folder:
-            soup = xml2soup(folder_path+file)
-            id_elements = soup.find("identification-elements")
-            source_uri = id_elements.findChild(name='element', attrs={'name': "source_uri"}).get("value")
-            unique_file_id = "_".join(source_uri.split(sep="/")[10:8:-1])
-            result_dict[file] = unique_file_id
+            source_uri = xml_header_source_uri(folder_path+file) if os.path.isfile(folder_path+file) else None
+            if source_uri is None:
+                print("File %s is no valid xml payload and is skipped." % file)
+                result_dict[file] = None
+                continue
+            result_dict[file] = source_uri_station(source_uri)
     elif multi_process:
         chunks_dict = list_chunking(folder)
         dict_iterable = Parallel(n_jobs=multiprocessing.cpu_count())(delayed(create_mapping_filename2station
@@ -421,34 +1001,46 @@ def create_mapping_filename2station(folder: list, folder_path: str, multi_proces
 
 
 def get_mapping_filename2station(folder_path: str, multi_process: bool = True):
-    """ Returns a dict with mappings between file names and stations by either loading an existing pickle file
-    or by running through all files (and leaving a pickle file for future iterations)
+    """ Returns a dict with mappings between file names and stations by loading an existing pickle file and
+    updating it with all files which were added to or removed from the folder since (leaving the updated pickle file
+    for future iterations). Only the headers of the added files are read.
 
     Params:
         folder_path (str) - path to the folder with XML files
 
     Returns:
-        result_dict (dict) - Dictionary mapping each filename (key) to a station (value) the information comes from
+        result_dict (dict) - Dictionary mapping each filename (key) to a station (value) the information comes from,
+                             files which are no valid xml payloads are mapped to None
 
     Conditional Byproduct:
-        mapping_filename2station (pickle file) - Pickled version of result_dict saved to folder if not already existent
+        mapping_filename2station (pickle file) - Pickled version of result_dict saved to folder if it changed
     """
     try:
         with open(folder_path + 'mapping_filename2station.pickle', 'rb') as pickle_file:
             result_dict = pickle.load(pickle_file)
         print("--- Loaded existing mapping between file names and stations.---")
     except FileNotFoundError:
-        folder = os.listdir(folder_path)
-        # TODO for Prod: Replace length check (>38) with real verification of XML without reading all files
-        folder = [file for file in folder if len(file) > 38]
-        result_dict = create_mapping_filename2station(folder=folder,
+        result_dict = {}
+
+    folder = set(os.listdir(folder_path))
+    removed_files = [file for file in result_dict if file not in folder]
+    for file in removed_files:
+        del result_dict[file]
+    new_files = sorted(folder - set(result_dict) - {'mapping_filename2station.pickle'})
+    new_mapping = {}
+    if new_files:
+        new_mapping = create_mapping_filename2station(folder=new_files,
                                                       folder_path=folder_path,
                                                       multi_process=multi_process)
+        result_dict.update(new_mapping)
 
+    if new_mapping or removed_files:
         save_pickle(folder_path=folder_path,
                     file_name='mapping_filename2station',
                     save_object=result_dict)
-        print("--- Created and saved mapping between file names and stations.---")
+        print("--- Updated and saved mapping between file names and stations (%d new, %d rejected, %d removed "
+              "files).---" % (sum(station is not None for station in new_mapping.values()),
+                              sum(station is None for station in new_mapping.values()), len(removed_files)))
     return result_dict
 
 
@@ -457,7 +1049,8 @@ def get_mapping_station2filename(folder_path: str):
     If the folder doesn't already contain a pickle file with the opposite mapping then this is created first.
     """
     mapping_dict = get_mapping_filename2station(folder_path)
-    inverse_mapping_dict = inverse_dict(mapping_dict)
+    inverse_mapping_dict = inverse_dict({file: station for file, station in mapping_dict.items()
+                                         if station is not None})
     return inverse_mapping_dict
 
 
@@ -478,28 +1071,389 @@ def list_chunking(input_list: list, chunksize: int = None):
 
 # End2End-Methods ####################################################################################################
 
-def xml_list_to_pickled_extraction_dict(input_files: list, output_path: str):
-    """Extract all potentially interesting values from a list of xml files and combine them to a single dict """
-    result_dict = {}
+def extraction_file_id(station_data: dict):
+    """ Returns the unique identifier (station, time and version) of an extraction based on its source uri. """
+    source_uri = station_data['source_uri']
+    return "_".join(source_uri.split(sep="/")[10:7:-1]) + '_' + source_uri.split(sep="/")[12]
+
+
+def xml_list_extraction_records(input_files: list,
+                                chunk_name: str,
+                                manifest_entries: dict,
+                                backend: str = 'bs4',
+                                qa_category_list=('presence', 'range', 'integrity', 'intervariable_comparison',
+                                                  'temporal'),
+                                output_subtests: bool = True,
+                                native_codes: bool = True,
+                                output_format: str = 'pickle',
+                                validation_rate: float = 0.0,
+                                validation_reports: list = None,
+                                qa_prefilter: dict = None):
+    """ Generator which extracts one xml file after the other and yields the unique file id with the extracted values.
+
+    A share of validation_rate of the files is checked against the summary statistics in their header once all files
+    are extracted (see batch_compare_to_count_values), which is cheap because the header is read without parsing.
+    With a qa_prefilter, files whose automatic QA passed only get a light record (see qa_light_record), which is
+    not validated.
+
+    Params:
+        input_files (list) - Paths of the xml files to extract
+        chunk_name (str) - Name of the chunk the extractions are saved to
+        manifest_entries (dict) - Dictionary which is filled with the manifest entry of each extracted file
+        backend ("bs4"/"lxml") - Parser used for the extraction (see xml_extraction_complete_compose).
+        qa_category_list (list) - List of all QA categories whose flag values should be extracted
+        output_subtests (boolean) - Indicator if only summary flag (False) or all flag values (True) should be added.
+        native_codes (boolean) - Indicator if natives codes are to be extracted
+        output_format ("pickle"/"parquet") - Format the extractions are saved in (recorded in the manifest)
+        validation_rate (float) - Share of the files (0 to 1) which are validated, always the same for a file name
+        validation_reports (list) - List the report of all validated files is appended to (see validation_rate)
+        qa_prefilter (dict) - Prefilter of the files (see qa_prefilter), only given for qa_failed_only
+
+    Yields:
+        unique_file_id (str), station_data (dict)
+    """
+    options = extraction_options(qa_category_list=qa_category_list,
+                                 output_subtests=output_subtests,
+                                 native_codes=native_codes,
+                                 output_format=output_format,
+                                 qa_failed_only=qa_prefilter is not None)
+    validation_records = {}
+    validation_counts = {}
     for file in input_files:
-        station_data = xml_extraction_complete_compose(file, output_subtests=True, native_codes=True)
-        source_uri = station_data['source_uri']
-        unique_file_id = "_".join(source_uri.split(sep="/")[10:7:-1]) + '_' + source_uri.split(sep="/")[12]
-        result_dict[unique_file_id] = station_data
+        prefilter_state = (qa_prefilter or {}).get(file)
+        light = prefilter_state == 'light' or (prefilter_state == 'scan' and xml_observations_passed(file))
+        if light:
+            station_data = qa_light_record(file)
+        else:
+            station_data = xml_extraction_complete_compose(file,
+                                                           qa_category_list=qa_category_list,
+                                                           output_subtests=output_subtests,
+                                                           native_codes=native_codes,
+                                                           backend=backend)
+        unique_file_id = extraction_file_id(station_data)
+        with stage_timer('manifest'):
+            manifest_entries[os.path.basename(file)] = file_manifest_entry(file_path=file,
+                                                                           chunk_name=chunk_name,
+                                                                           file_id=unique_file_id,
+                                                                           options=options)
+        if not light and sampled_for_validation(file_name=os.path.basename(file), validation_rate=validation_rate):
+            validation_records[unique_file_id] = station_data
+            with stage_timer('validation'):
+                validation_counts[unique_file_id] = xml_header_comparision_value(file)
+        yield unique_file_id, station_data
+
+    if validation_records:
+        with stage_timer('validation'):
+            validation_reports.append(batch_compare_to_count_values(
+                df_xml=pd.DataFrame.from_dict(validation_records, orient='index'),
+                df_counts=pd.DataFrame.from_dict(validation_counts, orient='index'),
+                only_mismatches=False))
+
+
+def read_chunk_extractions(output_path: str, excluded_file_names: set):
+    """ Loads an existing chunk pickle without the extractions of the excluded xml files ({} if there is none). """
+    if not os.path.exists(output_path + '.pickle'):
+        return {}
+    return {unique_file_id: station_data
+            for unique_file_id, station_data in read_records_pickle(output_path + '.pickle').items()
+            if os.path.basename(station_data['origin_filename']) not in excluded_file_names}
+
+
+PARQUET_FOLDER_NAME = 'parquet/'
+EXTRACTION_FORMATS = ('pickle', 'parquet', 'compact', 'flat')
+# Formats whose work units are saved to UNIT_FOLDER_NAME and merged into the chunk pickle by the parent
+UNIT_MERGE_FORMATS = ('pickle', 'compact', 'flat')
+
+
+def xml_unit_extraction(unit: dict,
+                        output_path: str,
+                        run_name: str,
+                        output_format: str = 'pickle',
+                        batch_size: int = 500,
+                        backend: str = 'bs4',
+                        qa_category_list=('presence', 'range', 'integrity', 'intervariable_comparison', 'temporal'),
+                        output_subtests: bool = True,
+                        native_codes: bool = True,
+                        validation_rate: float = 0.0,
+                        metrics: bool = False,
+                        profile_path: str = None):
+    """ Extracts a work unit (see extraction_scheduler.plan_extraction_units) and flushes its partial result.
+
+    For the output_formats "pickle" and "compact" the extractions of the unit are saved to the folder
+    'extraction_units/' until they are merged into their chunk (see merge_chunk_units). For "flat" only the original
+    and the latest correction of each station and observation time are kept while the files stream through the
+    extraction (see version_flattening.update_version_state) and saved instead. For "parquet" the unit writes its own
+    files into the dataset, which are named after the chunk and therefore belong to it without any merge.
+
+    If metrics, the stage timers and counters of the unit are collected (see extraction_metrics) and returned with its
+    stats, so the parent process can aggregate them over all workers. If a profile_path is given, the unit is profiled
+    with cProfile and the statistics are saved to '<profile_path><unit name>.prof'.
 
-    file_name = os.path.basename(output_path)
-    folder_path = output_path.replace(file_name, '')
-    save_pickle(folder_path=folder_path, file_name=file_name, save_object=result_dict)
+    Returns:
+        unit (dict) - The extracted unit
+        manifest_entries (dict) - Manifest entry for each extracted file (see extraction_manifest.file_manifest_entry)
+        stats (dict) - Worker, files, bytes and seconds of the unit (see extraction_scheduler.worker_throughput_report)
+                       and its metrics (only if metrics)
+        validation_reports (list) - Reports of the validated files (see xml_list_extraction_records)
+    """
+    start_time = time.time()
+    unit_name = extraction_unit_name(unit=unit, run_name=run_name)
+    manifest_entries = {}
+    validation_reports = []
+    with collect_metrics(enabled=metrics) as unit_metrics, profile_block(profile_path=profile_path, name=unit_name):
+        records = xml_list_extraction_records(input_files=unit['files'],
+                                              chunk_name=unit['chunk'],
+                                              manifest_entries=manifest_entries,
+                                              backend=backend,
+                                              qa_category_list=qa_category_list,
+                                              output_subtests=output_subtests,
+                                              native_codes=native_codes,
+                                              output_format=output_format,
+                                              validation_rate=validation_rate,
+                                              validation_reports=validation_reports,
+                                              qa_prefilter=unit.get('qa_prefilter'))
+        if output_format in ('pickle', 'compact'):
+            save_pickle(folder_path=output_path + UNIT_FOLDER_NAME, file_name=unit_name, save_object=dict(records))
+        elif output_format == 'flat':
+            version_state = {}
+            for _, station_data in records:
+                update_version_state(state=version_state, station_data=station_data)
+            save_pickle(folder_path=output_path + UNIT_FOLDER_NAME, file_name=unit_name, save_object=version_state)
+        elif output_format == 'parquet':
+            write_parquet_records(records=records,
+                                  output_root=output_path + PARQUET_FOLDER_NAME,
+                                  chunk_name=unit_name,
+                                  batch_size=batch_size)
+    stats = extraction_unit_stats(unit=unit, start_time=start_time)
+    if unit_metrics is not None:
+        stats['metrics'] = unit_metrics
+    return unit, manifest_entries, stats, validation_reports
+
+
+def merge_chunk_units(output_path: str,
+                      chunk_name: str,
+                      unit_names: list,
+                      output_format: str = 'pickle',
+                      merge_existing: bool = False,
+                      excluded_file_names: set = None,
+                      schema_registry: dict = None,
+                      remove_units: bool = True):
+    """ Merges the partial results of the units of a chunk into the chunk pickle in the order of the units, so the
+    extractions are ordered by file name independent of which unit finished first. Parquet units need no merge.
+
+    Compact chunks are encoded here (see compact_records.compact_records), so the shared schema registry is only
+    extended by a single process. The registry is saved before the chunk, so every saved chunk can be decoded.
+    For flat chunks the version states of the units are combined, as the versions of an observation time can be split
+    between successive units, and the chunk is saved with one flat record per station and observation time
+    (see version_flattening.flat_record).
+
+    Params:
+        output_path (str) - Output folder of the extraction
+        chunk_name (str) - Name of the chunk (pickle file without ending)
+        unit_names (list) - Names of the units of the chunk sorted by their index
+        output_format ("pickle"/"parquet"/"compact"/"flat") - Format the units were saved in
+        merge_existing (boolean) - Indicator if the existing chunk pickle is kept except for the excluded files
+        excluded_file_names (set) - Names of the xml files which were extracted again (only used for merge_existing)
+        schema_registry (dict) - Schema registry of the output folder (only used for "compact")
+        remove_units (bool) - Indicator if the partial results of the units are removed once the chunk is saved
+    """
+    if output_format not in UNIT_MERGE_FORMATS:
+        return
+    unit_paths = [output_path + UNIT_FOLDER_NAME + unit_name + '.pickle' for unit_name in unit_names]
+    if output_format == 'flat':
+        version_state = {}
+        for unit_path in unit_paths:
+            merge_version_states(state=version_state, other_state=read_pickle(unit_path))
+        save_chunk_pickle(folder_path=output_path, chunk_name=chunk_name, chunk=flatten_version_state(version_state))
+    else:
+        merge_chunk_records(output_path=output_path,
+                            chunk_name=chunk_name,
+                            unit_paths=unit_paths,
+                            output_format=output_format,
+                            merge_existing=merge_existing,
+                            excluded_file_names=excluded_file_names,
+                            schema_registry=schema_registry)
+    # The units are only removed once the chunk is saved, so an interrupted merge can be repeated
+    if remove_units:
+        for unit_path in unit_paths:
+            os.remove(unit_path)
+
+
+def merge_chunk_records(output_path: str,
+                        chunk_name: str,
+                        unit_paths: list,
+                        output_format: str,
+                        merge_existing: bool,
+                        excluded_file_names: set,
+                        schema_registry: dict):
+    """ Merges the extraction dictionaries of the units of a "pickle" or "compact" chunk (see merge_chunk_units). """
+    result_dict = {}
+    if merge_existing:
+        result_dict = read_chunk_extractions(output_path=output_path + chunk_name,
+                                             excluded_file_names=excluded_file_names)
+    for unit_path in unit_paths:
+        result_dict.update(read_pickle(unit_path))
+    if merge_existing:
+        # Re-extracted files take the position they would have in a complete extraction of the chunk
+        result_dict = dict(sorted(result_dict.items(),
+                                  key=lambda item: os.path.basename(item[1]['origin_filename'])))
+    if output_format == 'compact':
+        result_dict, registry_changed = compact_records(records=result_dict, registry=schema_registry)
+        if registry_changed:
+            save_schema_registry(folder_path=output_path, registry=schema_registry)
+    save_chunk_pickle(folder_path=output_path, chunk_name=chunk_name, chunk=result_dict, registry=schema_registry)
+
+
+def remove_chunk_extractions(output_path: str, chunk_name: str, file_names: set, output_format: str):
+    """ Removes the extractions of xml files which were deleted from the input folder from a chunk which is not
+    extracted again by an incremental run. The chunk is removed if none of its files is left (flat chunks are only
+    passed in this case, the others are flattened again).
+    """
+    if output_format == 'parquet':
+        remove_parquet_chunk_rows(output_root=output_path + PARQUET_FOLDER_NAME, chunk_name=chunk_name,
+                                  origin_file_names=file_names)
+        return
+    if output_format != 'flat' and read_chunk_extractions(output_path=output_path + chunk_name,
+                                                          excluded_file_names=file_names):
+        schema_registry = load_schema_registry(folder_path=output_path) if output_format == 'compact' else None
+        merge_chunk_records(output_path=output_path, chunk_name=chunk_name, unit_paths=[],
+                            output_format=output_format, merge_existing=True, excluded_file_names=file_names,
+                            schema_registry=schema_registry)
+        return
+    for file_name in (chunk_name + '.pickle', chunk_name + CHUNK_COLUMNS_SUFFIX):
+        if os.path.exists(output_path + file_name):
+            os.remove(output_path + file_name)
+
+
+def prepare_folder_extraction(input_folder_path: str,
+                              chunk_by: str,
+                              chunksize: int,
+                              file_chunks_dict: dict,
+                              incremental: bool,
+                              output_format: str,
+                              options: dict,
+                              max_files_per_unit: int,
+                              max_bytes_per_unit: int,
+                              qa_failed_only: bool = False,
+                              multi_process: bool = True):
+    """ Plans the extraction of a folder (see xml_folder_to_pickled_extraction_dicts): chunks the xml files, keeps
+    only the new or changed ones if incremental, clears the partial results of an interrupted run and splits the
+    chunks into work units. For qa_failed_only each unit gets the prefilter of its files (see qa_prefilter).
+
+    Returns:
+        manifest (dict) - Manifest of the previous runs (empty if not incremental)
+        chunk_file_names (dict) - Chunk name as key and set of the names of its xml files to extract as value
+        units (list) - Work units, largest first (see extraction_scheduler.plan_extraction_units)
+    """
+    if chunk_by == 'station':
+        # The mapping only reads the headers of the files which were added to the folder since the last run
+        station_mapping = {file: station for file, station in get_mapping_filename2station(
+            folder_path=input_folder_path, multi_process=multi_process).items() if station is not None}
+        folder = [input_folder_path + file for file in sorted(station_mapping)]
+    else:
+        folder = [input_folder_path + file for file in list_xml_payloads(input_folder_path)]
+    output_path = extraction_output_path(input_folder_path)
+
+    if folder:
+        ensure_folder_exists(output_path)
+    else:
+        print("Nothing to do. Folder doesn't contain xml files.")
+
+    if incremental:
+        manifest = load_extraction_manifest(output_path=output_path)
+    else:
+        manifest = {}
+        discard_manifest_journals(output_path=output_path)
+
+    if chunk_by == 'station' and not file_chunks_dict:
+        file_chunks_dict = inverse_dict(station_mapping)
+        file_chunks_dict = append_prefix_to_mapping_values(mapping_dict=file_chunks_dict, prefix=input_folder_path)
+    elif chunk_by == "chunksize" and incremental:
+        file_chunks_dict = manifest_chunking(input_list=folder, manifest=manifest, chunksize=chunksize)
+    elif chunk_by == "chunksize":
+        file_chunks_dict = list_chunking(input_list=folder, chunksize=chunksize)
+
+    removed_chunks = {}
+    if incremental:
+        changed_chunks_dict, refreshed_entries = filter_chunks_to_extract(file_chunks_dict=file_chunks_dict,
+                                                                          manifest=manifest,
+                                                                          options=options)
+        manifest.update(refreshed_entries)
+        removed_chunks = removed_file_chunks(manifest=manifest, file_names={os.path.basename(file) for file in folder})
+        for file_names in removed_chunks.values():
+            for file_name in file_names:
+                del manifest[file_name]
+        if output_format == 'flat' or qa_failed_only:
+            # A flat record depends on all versions of its observation time, so changed chunks are flattened again.
+            # The prefilter does as well: a new correction requires the complete extraction of its original.
+            changed_chunks_dict = {name_key: file_chunks_dict[name_key]
+                                   for name_key in set(changed_chunks_dict) | set(removed_chunks)
+                                   if file_chunks_dict.get(name_key)}
+        file_chunks_dict = changed_chunks_dict
+        print("--- %d new or changed files in %d chunks to extract, %d files were removed.---" % (
+            sum(len(file_list) for file_list in file_chunks_dict.values()), len(file_chunks_dict),
+            sum(len(file_names) for file_names in removed_chunks.values())))
+
+    chunk_file_names = {name_key: {os.path.basename(file) for file in file_list}
+                        for name_key, file_list in file_chunks_dict.items()}
+    for name_key, file_names in removed_chunks.items():
+        if name_key in chunk_file_names:
+            # The extractions of the removed files are left out when the chunk is merged
+            chunk_file_names[name_key] |= file_names
+        else:
+            remove_chunk_extractions(output_path=output_path, chunk_name=name_key, file_names=file_names,
+                                     output_format=output_format)
+    if output_format in UNIT_MERGE_FORMATS:
+        # Partial results of an interrupted run are incomplete, their files are extracted again
+        ensure_folder_exists(output_path + UNIT_FOLDER_NAME)
+        for unit_file in os.listdir(output_path + UNIT_FOLDER_NAME):
+            os.remove(output_path + UNIT_FOLDER_NAME + unit_file)
+    elif output_format == 'parquet':
+        # The units write new files for their chunk, so the previous rows of the chunk are removed beforehand
+        for name_key, file_names in chunk_file_names.items():
+            remove_parquet_chunk_rows(output_root=output_path + PARQUET_FOLDER_NAME,
+                                      chunk_name=name_key,
+                                      origin_file_names=file_names if incremental else None)
+
+    units = plan_extraction_units(file_chunks_dict=file_chunks_dict,
+                                  max_files_per_unit=max_files_per_unit,
+                                  max_bytes_per_unit=max_bytes_per_unit)
+    if qa_failed_only and units:
+        prefilter = qa_prefilter(file_paths=[file for file_list in file_chunks_dict.values() for file in file_list],
+                                 multi_process=multi_process)
+        for unit in units:
+            unit['qa_prefilter'] = {file: prefilter[file] for file in unit['files'] if file in prefilter}
+    return manifest, chunk_file_names, units
 
 
 def xml_folder_to_pickled_extraction_dicts(input_folder_path: str,
                                            chunk_by: str,
                                            chunksize: int = 1000,
                                            file_chunks_dict: dict = None,
-                                           multi_process: bool = True):
+                                           multi_process: bool = True,
+                                           backend: str = 'bs4',
+                                           qa_category_list=('presence', 'range', 'integrity',
+                                                             'intervariable_comparison', 'temporal'),
+                                           output_subtests: bool = True,
+                                           native_codes: bool = True,
+                                           incremental: bool = False,
+                                           output_format: str = 'pickle',
+                                           max_files_per_unit: int = 250,
+                                           max_bytes_per_unit: int = 64 * 2 ** 20,
+                                           validation_rate: float = 0.0,
+                                           metrics_format: str = None,
+                                           profile: bool = False,
+                                           qa_failed_only: bool = False,
+                                           queue_name: str = None,
+                                           lease_seconds: float = LEASE_SECONDS,
+                                           poll_seconds: float = 5.0):
     """ End-to-end function for the complete extraction process from input folder (with xml's) to output folder with
     dictionaries of extracted values.
 
+    The chunks are split into work units of at most max_files_per_unit files and max_bytes_per_unit bytes, which are
+    handed to the next idle worker (largest first). Each unit flushes its partial result, so the memory of a worker
+    does not grow with the size of a station, and the units of a chunk are merged after all of them are finished.
+
      Params:
         input_folder_path (str) - Path of the folder containing (only) the xml files.
         chunk_by ("chunksize"/"station") - Indicator how to break the data into chunks for processing.
@@ -509,40 +1463,457 @@ def xml_folder_to_pickled_extraction_dicts(input_folder_path: str,
         file_chunks_dict (dict) - Dictionary of which files should be processed together. Is ignored for
                                   chunk_by='chunksize' and if not given will be calculated for chunk_by='station'.
         multi_process (bool) - Indicator if single or all available kernels should be used for processing.
+        backend ("bs4"/"lxml") - Parser used for the extraction (see xml_extraction_complete_compose).
+        qa_category_list (list) - List of all QA categories whose flag values should be extracted
+        output_subtests (boolean) - Indicator if only summary flag (False) or all flag values (True) should be added.
+        native_codes (boolean) - Indicator if natives codes are to be extracted
+        incremental (bool) - Indicator if only files which are new, changed or extracted with other options since the
+                             last run are extracted and merged into their chunks. Also resumes an interrupted run.
+        output_format ("pickle"/"parquet"/"compact"/"flat") - Output format of the extractions (see EXTRACTION_FORMATS)
+        max_files_per_unit (int) - Maximum number of files a worker extracts before flushing its result
+        max_bytes_per_unit (int) - Maximum size of the files a worker extracts before flushing its result
+        validation_rate (float) - Share of the files (0 to 1) which are checked against the summary statistics in
+                                  their header during the extraction (see batch_compare_to_count_values)
+        metrics_format (None/"jsonl"/"prometheus") - Format the stage timers and counters of all workers are saved in
+                                                    (see extraction_metrics), no metrics are collected if None
+        profile (bool) - Indicator if each work unit is profiled with cProfile (saved to "extraction_profiles/")
+        qa_failed_only (bool) - Indicator if only the files needed for training are extracted completely: files with
+                                a failed automatic QA and all versions of corrected observation times. The other files
+                                get a light record with metadata and qa_summary counts (key "qa_prefilter"), which are
+                                decided from the headers before the extraction (see qa_prefilter).
+        queue_name (str) - Name of a cooperative run shared by several hosts which mount the same folders. All hosts
+                           call this function with the same arguments, the first one plans the run and all of them
+                           extract its work units from the queue "extraction_queue/<queue_name>/" (see
+                           xml_queue_extraction). The result is the same as the one of a single host.
+        lease_seconds (float) - Seconds without heartbeat after which a work unit of a dead worker is reclaimed
+                                (only used with queue_name)
+        poll_seconds (float) - Seconds a worker waits for the tasks of other workers (only used with queue_name)
 
     Returns:
         Nothing returned, but creates dictionaries in the data/interim folder (same subsequent structure as input path)
-        with dictionaries with the extracted values split depending on the chunk_by parameter.
+        with dictionaries with the extracted values split depending on the chunk_by parameter. For the output_format
+        "parquet" a dataset partitioned by station and month is created in the subfolder "parquet/" instead. For
+        "compact" the chunk pickles hold compact chunks (see compact_records.read_records_pickle to load them). For
+        "flat" the chunk pickles hold one record per station and observation time with the original values and the
+        values after the latest relevant manual correction (suffix '_post_mc', see version_flattening.flat_record).
+
+    Byproduct:
+        extraction_manifest.json - Size, mtime, hash, chunk and extraction options of every extracted xml which is used
+                                   to detect new and changed files in incremental runs.
+        extraction_schema.json - Schema registry of the keys of compact chunks (only for output_format "compact")
+        extraction_validation.csv - Flag categories of validated files whose counts do not match the summary
+                                    statistics (only if there are any)
+        extraction_metrics.jsonl/.prom - Seconds and calls per stage (read, parse, observations, pickle, merge, ...)
+                                         and counters (files, bytes, observations, anomalies) of the run (only if
+                                         metrics_format)
     """
 
     assert chunk_by in ["chunksize", "station"]
+    assert output_format in EXTRACTION_FORMATS
+    assert metrics_format in (None, 'jsonl', 'prometheus')
+    # All versions of an observation time have to be in the same chunk to be flattened
+    assert output_format != 'flat' or chunk_by == 'station', "The output_format 'flat' requires chunk_by='station'."
+    # New corrections are only matched with their originals if all versions of an observation time share a chunk
+    assert not (qa_failed_only and incremental) or chunk_by == 'station', \
+        "Incremental runs with qa_failed_only require chunk_by='station'."
 
     if chunk_by == "chunksize" and file_chunks_dict:
         print("Argument file_chunks_dict will be ignored for chunk_by='chunksize'")
 
-    folder = os.listdir(input_folder_path)
-    output_path = input_folder_path.replace('raw', 'interim')
+    options = extraction_options(qa_category_list=qa_category_list,
+                                 output_subtests=output_subtests,
+                                 native_codes=native_codes,
+                                 output_format=output_format,
+                                 qa_failed_only=qa_failed_only)
+    output_path = extraction_output_path(input_folder_path)
+    preparation_kwargs = dict(input_folder_path=input_folder_path,
+                              chunk_by=chunk_by,
+                              chunksize=chunksize,
+                              file_chunks_dict=file_chunks_dict,
+                              incremental=incremental,
+                              output_format=output_format,
+                              options=options,
+                              max_files_per_unit=max_files_per_unit,
+                              max_bytes_per_unit=max_bytes_per_unit,
+                              qa_failed_only=qa_failed_only,
+                              multi_process=multi_process)
+    profile_path = output_path + PROFILE_FOLDER_NAME if profile else None
+    extraction_kwargs = dict(output_path=output_path,
+                             run_name=extraction_run_name(),
+                             output_format=output_format,
+                             backend=backend,
+                             qa_category_list=qa_category_list,
+                             output_subtests=output_subtests,
+                             native_codes=native_codes,
+                             validation_rate=validation_rate,
+                             metrics=metrics_format is not None,
+                             profile_path=profile_path)
+    num_workers = multiprocessing.cpu_count() if multi_process else 1
+    if queue_name is not None:
+        xml_queue_extraction(queue_path=queue_folder_path(output_path=output_path, queue_name=queue_name),
+                             plan_run=functools.partial(plan_queue_extraction,
+                                                        preparation_kwargs=preparation_kwargs,
+                                                        extraction_kwargs=extraction_kwargs,
+                                                        metrics_format=metrics_format),
+                             options=options,
+                             num_workers=num_workers,
+                             lease_seconds=lease_seconds,
+                             poll_seconds=poll_seconds)
+        return
+
+    manifest, chunk_file_names, units = prepare_folder_extraction(**preparation_kwargs)
+    if profile:
+        ensure_folder_exists(profile_path)
+    with collect_metrics(enabled=metrics_format is not None) as run_metrics:
+        dispatch_start = time.time()
+        if multi_process:
+            # batch_size=1 dispatches every unit on its own to the next idle worker
+            unit_iterable = Parallel(n_jobs=num_workers, batch_size=1, pre_dispatch='2*n_jobs')(
+                delayed(xml_unit_extraction)(unit, **extraction_kwargs) for unit in units)
+
+        elif not multi_process:
+            unit_iterable = [xml_unit_extraction(unit=unit, **extraction_kwargs) for unit in units]
+        dispatch_seconds = time.time() - dispatch_start
+
+        chunk_units = {}
+        validation_reports = []
+        for unit, manifest_entries, stats, unit_validation_reports in unit_iterable:
+            chunk_units.setdefault(unit['chunk'], []).append((unit, manifest_entries, stats))
+            validation_reports.extend(unit_validation_reports)
+
+        schema_registry = load_schema_registry(folder_path=output_path) if output_format == 'compact' else None
+        unit_stats = []
+        for name_key, chunk_results in chunk_units.items():
+            chunk_results.sort(key=lambda result: result[0]['index'])
+            with stage_timer('merge'):
+                merge_chunk_units(output_path=output_path,
+                                  chunk_name=name_key,
+                                  unit_names=[extraction_unit_name(unit=unit, run_name=extraction_kwargs['run_name'])
+                                              for unit, _, _ in chunk_results],
+                                  output_format=output_format,
+                                  merge_existing=incremental and output_format != 'flat',
+                                  excluded_file_names=chunk_file_names[name_key],
+                                  schema_registry=schema_registry)
+            chunk_entries = {}
+            for _, manifest_entries, stats in chunk_results:
+                chunk_entries.update(manifest_entries)
+                unit_stats.append(stats)
+            # The journal is only written after the chunk is complete
+            write_manifest_journal(output_path=output_path, chunk_name=name_key, entries=chunk_entries)
+            manifest.update(chunk_entries)
+
+    if run_metrics is not None:
+        # Time the workers were not busy with a unit: process start, (de)serialization by joblib and load imbalance
+        busy_seconds = sum(stats['seconds'] for stats in unit_stats)
+        run_metrics['timers']['worker_idle'] = [1, max(dispatch_seconds * num_workers - busy_seconds, 0.0)]
+        run_metrics['counters']['units'] = len(unit_stats)
+        run_metrics['counters']['workers'] = len({stats['worker'] for stats in unit_stats})
+        for stats in unit_stats:
+            merge_metrics(total=run_metrics, metrics=stats.pop('metrics'))
+        metrics_report(metrics=run_metrics)
+        save_metrics(output_path=output_path, metrics=run_metrics, metrics_format=metrics_format,
+                     labels={'run': extraction_kwargs['run_name'], 'backend': backend, 'output_format': output_format})
+    worker_throughput_report(unit_stats=unit_stats)
+    if validation_reports:
+        save_validation_report(output_path=output_path, report=pd.concat(validation_reports))
+    save_extraction_manifest(output_path=output_path, manifest=manifest)
+
+
+# Cooperative Extraction ##############################################################################################
+
+def queue_unit_task(unit: dict, run_name: str):
+    """ Returns the name of the queue task of a work unit. """
+    return 'unit.' + extraction_unit_name(unit=unit, run_name=run_name)
+
+
+def plan_queue_extraction(preparation_kwargs: dict, extraction_kwargs: dict, metrics_format: str = None):
+    """ Plans a cooperative run (see prepare_folder_extraction), which is done by the first host only.
 
-    if folder:
-        ensure_folder_exists(output_path)
-        folder = [input_folder_path + file for file in folder if len(file) > 38]
+    Returns:
+        plan (dict) - Options, extraction arguments and work units of the run, the unit tasks of each chunk in the
+                      order of the units and the manifest of the previous runs without the removed files
+    """
+    manifest, chunk_file_names, units = prepare_folder_extraction(**preparation_kwargs)
+    if extraction_kwargs['profile_path']:
+        ensure_folder_exists(extraction_kwargs['profile_path'])
+    chunk_units = {}
+    for unit in sorted(units, key=lambda unit: unit['index']):
+        chunk_units.setdefault(unit['chunk'], []).append(queue_unit_task(unit, extraction_kwargs['run_name']))
+    return {'options': preparation_kwargs['options'],
+            'incremental': preparation_kwargs['incremental'],
+            'metrics_format': metrics_format,
+            'extraction_kwargs': extraction_kwargs,
+            'units': units,
+            'chunk_units': chunk_units,
+            'chunk_file_names': chunk_file_names,
+            'manifest': manifest}
+
+
+def queue_unit_extraction(unit: dict, extraction_kwargs: dict):
+    """ Extracts a work unit of a cooperative run (see xml_unit_extraction). Each attempt writes files of its own, so
+    a worker which lost its lease (but is still running) never overwrites the files of the worker which reclaimed it.
+
+    Returns:
+        result (dict) - Name of the unit files of the attempt, manifest entries, stats and validation reports
+    """
+    attempt_kwargs = dict(extraction_kwargs, run_name='%s-%s' % (extraction_kwargs['run_name'], attempt_name()))
+    unit, manifest_entries, stats, validation_reports = xml_unit_extraction(unit=unit, **attempt_kwargs)
+    return {'unit_name': extraction_unit_name(unit=unit, run_name=attempt_kwargs['run_name']),
+            'manifest_entries': manifest_entries,
+            'stats': stats,
+            'validation_reports': validation_reports}
+
+
+def queue_chunk_merge(queue_path: str, plan: dict, chunk_name: str, lease_seconds: float, poll_seconds: float):
+    """ Merges the published units of a chunk (see merge_chunk_units) and writes its manifest journal. The units are
+    kept until the run is finished, so the merge of a dead worker can be repeated by another one.
+
+    Returns:
+        chunk_entries (dict) - Manifest entries of the files of the chunk
+    """
+    output_path = plan['extraction_kwargs']['output_path']
+    output_format = plan['extraction_kwargs']['output_format']
+    unit_results = [load_task_result(queue_path, task) for task in plan['chunk_units'][chunk_name]]
+    merge_kwargs = dict(output_path=output_path,
+                        chunk_name=chunk_name,
+                        unit_names=[unit_result['unit_name'] for unit_result in unit_results],
+                        output_format=output_format,
+                        merge_existing=plan['incremental'] and output_format != 'flat',
+                        excluded_file_names=plan['chunk_file_names'][chunk_name],
+                        remove_units=False)
+    if output_format == 'compact':
+        # The schema registry is shared by all chunks, so compact chunks are merged one after the other
+        with task_lease(queue_path, 'schema_registry', lease_seconds=lease_seconds, poll_seconds=poll_seconds):
+            merge_chunk_units(schema_registry=load_schema_registry(folder_path=output_path), **merge_kwargs)
     else:
-        print("Nothing to do. Folder doesn't contain files with length over 38 characters.")
+        merge_chunk_units(**merge_kwargs)
+    chunk_entries = {}
+    for unit_result in unit_results:
+        chunk_entries.update(unit_result['manifest_entries'])
+    write_manifest_journal(output_path=output_path, chunk_name=chunk_name, entries=chunk_entries)
+    return chunk_entries
+
+
+def discard_queue_attempts(plan: dict, unit_names: set):
+    """ Removes the unit files of a finished cooperative run, including the ones of attempts which were abandoned
+    (parquet files of abandoned attempts would otherwise be part of the dataset). """
+    output_path = plan['extraction_kwargs']['output_path']
+    run_marker = '-%s-' % plan['extraction_kwargs']['run_name']
+    if plan['extraction_kwargs']['output_format'] == 'parquet':
+        for file_path in parquet_chunk_files(output_root=output_path + PARQUET_FOLDER_NAME,
+                                             chunk_name='*' + run_marker[:-1]):
+            if os.path.basename(file_path).rpartition('-')[0] not in unit_names:
+                os.remove(file_path)
+        return
+    for file_name in os.listdir(output_path + UNIT_FOLDER_NAME):
+        if run_marker in file_name:
+            os.remove(output_path + UNIT_FOLDER_NAME + file_name)
+
+
+def queue_finish(queue_path: str, plan: dict):
+    """ Finishes a cooperative run once all chunks are merged: removes the unit files and saves the manifest, the
+    validation report and the metrics of all units (like the end of xml_folder_to_pickled_extraction_dicts).
 
-    if chunk_by == 'station' and not file_chunks_dict:
-        file_chunks_dict = get_mapping_station2filename(folder_path=input_folder_path)
-        file_chunks_dict = append_prefix_to_mapping_values(mapping_dict=file_chunks_dict, prefix=input_folder_path)
-    elif chunk_by == "chunksize":
-        file_chunks_dict = list_chunking(input_list=folder, chunksize=chunksize)
+    Returns:
+        summary (dict) - Number of units, files and bytes of the run
+    """
+    output_path = plan['extraction_kwargs']['output_path']
+    unit_results = [load_task_result(queue_path, queue_unit_task(unit, plan['extraction_kwargs']['run_name']))
+                    for unit in plan['units']]
+    discard_queue_attempts(plan=plan, unit_names={unit_result['unit_name'] for unit_result in unit_results})
+
+    manifest = dict(plan['manifest'])
+    for chunk_name in plan['chunk_units']:
+        manifest.update(load_task_result(queue_path, 'merge.' + chunk_name))
+    if plan['metrics_format'] is not None:
+        run_metrics = new_metrics()
+        for unit_result in unit_results:
+            merge_metrics(total=run_metrics, metrics=unit_result['stats']['metrics'])
+        run_metrics['counters']['units'] = len(unit_results)
+        metrics_report(metrics=run_metrics)
+        save_metrics(output_path=output_path, metrics=run_metrics, metrics_format=plan['metrics_format'],
+                     labels={'run': plan['extraction_kwargs']['run_name'],
+                             'backend': plan['extraction_kwargs']['backend'],
+                             'output_format': plan['extraction_kwargs']['output_format']})
+    validation_reports = [report for unit_result in unit_results for report in unit_result['validation_reports']]
+    if validation_reports:
+        save_validation_report(output_path=output_path, report=pd.concat(validation_reports))
+    save_extraction_manifest(output_path=output_path, manifest=manifest)
+    return {'units': len(unit_results),
+            'files': sum(unit_result['stats']['files'] for unit_result in unit_results),
+            'bytes': sum(unit_result['stats']['bytes'] for unit_result in unit_results)}
+
+
+def xml_queue_worker(queue_path: str, lease_seconds: float = LEASE_SECONDS, poll_seconds: float = 5.0):
+    """ Worker of a cooperative run which claims tasks from the queue until the run is finished: the work units
+    (largest first), the merge of each chunk whose units are all published and finally the finish of the run.
 
+    Returns:
+        unit_stats (list) - Stats of the units extracted by this worker (see extraction_unit_stats)
+    """
+    plan = load_task_result(queue_path, 'plan')
+    run_name = plan['extraction_kwargs']['run_name']
+    unit_stats = []
+    while not task_done(queue_path, 'finish'):
+        progress = False
+        for unit in plan['units']:
+            task = queue_unit_task(unit, run_name)
+            if try_task(queue_path, task, lease_seconds=lease_seconds,
+                        run_task=functools.partial(queue_unit_extraction, unit, plan['extraction_kwargs'])):
+                unit_stats.append(load_task_result(queue_path, task)['stats'])
+                progress = True
+        for chunk_name, unit_tasks in plan['chunk_units'].items():
+            if all(task_done(queue_path, task) for task in unit_tasks):
+                progress |= try_task(queue_path, 'merge.' + chunk_name, lease_seconds=lease_seconds,
+                                     run_task=functools.partial(queue_chunk_merge, queue_path, plan, chunk_name,
+                                                                lease_seconds, poll_seconds))
+        if all(task_done(queue_path, 'merge.' + chunk_name) for chunk_name in plan['chunk_units']):
+            wait_for_task(queue_path, 'finish', run_task=functools.partial(queue_finish, queue_path, plan),
+                          lease_seconds=lease_seconds, poll_seconds=poll_seconds)
+        elif not progress:
+            time.sleep(poll_seconds)
+    return unit_stats
+
+
+def xml_queue_extraction(queue_path: str,
+                         plan_run,
+                         options: dict,
+                         num_workers: int = 1,
+                         lease_seconds: float = LEASE_SECONDS,
+                         poll_seconds: float = 5.0):
+    """ Takes part in a cooperative run of several hosts which share a queue folder (see extraction_queue).
+
+    The first host to arrive plans the run, the others wait for its plan. Then num_workers processes of this host
+    claim tasks until the run is finished (see xml_queue_worker). A task is leased to one worker at a time and the
+    lease is kept alive by a heartbeat, so the tasks of a dead worker (or host) are reclaimed after lease_seconds.
+    Unit files are written per attempt and chunks and manifest are only saved atomically from published results,
+    so the output is the same as the one of a single host. A run interrupted on all hosts is resumed by starting it
+    again with the same queue name. The queue folder is kept after the run (hosts which start late find it finished)
+    and can be removed once all hosts are done.
+
+    Params:
+        queue_path (str) - Queue folder of the run (see extraction_queue.queue_folder_path)
+        plan_run (callable) - Function without arguments which returns the plan (see plan_queue_extraction)
+        options (dict) - Extraction options of this host which have to match the ones of the plan
+        num_workers (int) - Number of worker processes of this host
+        lease_seconds (float) - Seconds without heartbeat after which the lease of a worker is reclaimed
+        poll_seconds (float) - Seconds a worker waits before it looks for new tasks again
+    """
+    plan = wait_for_task(queue_path, 'plan', run_task=plan_run, lease_seconds=lease_seconds, poll_seconds=poll_seconds)
+    assert plan['options'] == options, "The queue %s was planned with other extraction options: %s" % (
+        queue_path, plan['options'])
+    worker_kwargs = dict(queue_path=queue_path, lease_seconds=lease_seconds, poll_seconds=poll_seconds)
+    if num_workers > 1:
+        worker_results = Parallel(n_jobs=num_workers, batch_size=1)(
+            delayed(xml_queue_worker)(**worker_kwargs) for _ in range(num_workers))
+    else:
+        worker_results = [xml_queue_worker(**worker_kwargs)]
+    unit_stats = [stats for worker_stats in worker_results for stats in worker_stats]
+    worker_throughput_report(unit_stats=unit_stats)
+    summary = load_task_result(queue_path, 'finish')
+    print("--- Cooperative run finished: %d units with %d files (%d by this host).---" % (
+        summary['units'], summary['files'], sum(stats['files'] for stats in unit_stats)))
+
+
+def xml_payloads_to_extraction(payloads: list,
+                               output_path: str,
+                               chunk_name: str,
+                               output_format: str = 'pickle',
+                               batch_size: int = 500,
+                               backend: str = 'bs4',
+                               qa_category_list=('presence', 'range', 'integrity', 'intervariable_comparison',
+                                                 'temporal'),
+                               output_subtests: bool = True,
+                               native_codes: bool = True):
+    """ Extracts a chunk of payloads read from an export (see payload_export.iter_export_payloads) in memory and saves
+    them like a chunk of xml files. The origin_filename of a payload is its name derived from the source uri.
+
+    Returns:
+        num_payloads (int) - Number of extracted payloads
+    """
+    records = ((extraction_file_id(station_data), station_data)
+               for station_data in (xml_extraction_complete_compose(source_uri_payload_name(data_payload_uri),
+                                                                    qa_category_list=qa_category_list,
+                                                                    output_subtests=output_subtests,
+                                                                    native_codes=native_codes,
+                                                                    backend=backend,
+                                                                    xml_content=xml_content)
+                                    for data_payload_uri, xml_content in payloads))
+    if output_format == 'pickle':
+        save_chunk_pickle(folder_path=output_path, chunk_name=chunk_name, chunk=dict(records))
+    elif output_format == 'parquet':
+        write_parquet_records(records=records,
+                              output_root=output_path + PARQUET_FOLDER_NAME,
+                              chunk_name=chunk_name,
+                              batch_size=batch_size)
+    return len(payloads)
+
+
+def xml_export_to_extraction_dicts(export_path: str,
+                                   output_path: str,
+                                   chunksize: int = 1000,
+                                   multi_process: bool = True,
+                                   backend: str = 'bs4',
+                                   qa_category_list=('presence', 'range', 'integrity', 'intervariable_comparison',
+                                                     'temporal'),
+                                   output_subtests: bool = True,
+                                   native_codes: bool = True,
+                                   output_format: str = 'pickle',
+                                   delimiter: str = ',',
+                                   quotechar: str = '"'):
+    """ End-to-end function for the extraction of a bulk export of the database (one csv/loader file, optionally gzip
+    or zstd compressed, with the columns data_payload_uri and data_payload_content) instead of a folder with one xml
+    file per payload.
+
+    The export is read once sequentially and the payloads are extracted in memory, chunks of chunksize successive
+    payloads are handed to the workers while the export is still read.
+
+    Params:
+        export_path (str) - Path of the export
+        output_path (str) - Folder the chunks are saved to (named '<export name>_<start>_to_<end>')
+        chunksize (int) - Number of payloads per chunk
+        multi_process (bool) - Indicator if single or all available kernels should be used for processing.
+        backend ("bs4"/"lxml") - Parser used for the extraction (see xml_extraction_complete_compose).
+        qa_category_list (list) - List of all QA categories whose flag values should be extracted
+        output_subtests (boolean) - Indicator if only summary flag (False) or all flag values (True) should be added.
+        native_codes (boolean) - Indicator if natives codes are to be extracted
+        output_format ("pickle"/"parquet") - Output format of the extractions (see EXTRACTION_FORMATS)
+        delimiter (str) - Field delimiter of the export
+        quotechar (str) - Character enclosing fields with delimiters or line breaks
+
+    Returns:
+        num_payloads (int) - Number of extracted payloads
+    """
+    # The chunks are saved by the workers, while compact chunks are only encoded by a single process
+    assert output_format in ('pickle', 'parquet'), "Exports can be extracted to pickle or parquet."
+    ensure_folder_exists(output_path)
+
+    name_prefix = export_name(export_path) + '_'
+    chunks = export_payload_chunks(payloads=iter_export_payloads(export_path=export_path,
+                                                                 delimiter=delimiter,
+                                                                 quotechar=quotechar),
+                                   chunksize=chunksize)
+    extraction_kwargs = dict(output_path=output_path,
+                             output_format=output_format,
+                             backend=backend,
+                             qa_category_list=qa_category_list,
+                             output_subtests=output_subtests,
+                             native_codes=native_codes)
     if multi_process:
-        Parallel(n_jobs=multiprocessing.cpu_count())(
-            delayed(xml_list_to_pickled_extraction_dict)(file_list, output_path+name_key)
-            for name_key, file_list in file_chunks_dict.items())
+        # The chunks are read lazily, so only a few chunks per worker are held in memory at once
+        num_payloads_iterable = Parallel(n_jobs=multiprocessing.cpu_count(), pre_dispatch='2*n_jobs')(
+            delayed(xml_payloads_to_extraction)(payloads, chunk_name=name_prefix + name_key, **extraction_kwargs)
+            for name_key, payloads in chunks)
 
     elif not multi_process:
-        for (name_key, file_list) in file_chunks_dict.items():
-            xml_list_to_pickled_extraction_dict(input_files=file_list, output_path=output_path+name_key)
+        num_payloads_iterable = [xml_payloads_to_extraction(payloads=payloads,
+                                                            chunk_name=name_prefix + name_key,
+                                                            **extraction_kwargs)
+                                 for name_key, payloads in chunks]
+
+    num_payloads = sum(num_payloads_iterable)
+    print("--- Extracted %d payloads from export %s.---" % (num_payloads, export_path))
+    return num_payloads
 
 
 if __name__ == "__main__":
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The modules of src/data import each other by their module name (like the notebooks, which run inside src/data)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src', 'data'))
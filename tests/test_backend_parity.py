@@ -0,0 +1,106 @@
+import datetime
+
+import pytest
+
+from synthetic_xml import synthetic_xml
+from xml2dict import EXTRACTION_BACKENDS, compare_extraction_backends, xml_extraction_complete_compose
+
+
+# A payload with the corner cases of the archive which the synthetic payloads don't contain: an observation without
+# categories, an observation with a category but without subtests and no qa_summary group.
+HANDWRITTEN_XML = (
+    '<?xml version="1.0" encoding="UTF-8"?>\n'
+    '<om:ObservationCollection xmlns="http://dms.ec.gc.ca/schema/point-observation/2.1" '
+    'xmlns:om="http://www.opengis.net/om/1.0" xmlns:xlink="http://www.w3.org/1999/xlink"><om:member><om:Observation>'
+    '<om:metadata><set><general><author name="manual" version="1.0"/></general><identification-elements>'
+    '<element name="date_time" value="2019-12-01T06:00:00.000Z"/>'
+    '<element name="tc_identifier" value="ZPK"/>'
+    '<element name="version" value="0"/>'
+    '<element name="correction" value="0"/>'
+    '<element name="source_uri" value="/data/msc/observation/201912010600/2402604/zpk/orig/data_0"/>'
+    '<element name="station_identifier" value="2402604"/>'
+    '</identification-elements></set></om:metadata><om:result><elements>'
+    '<element name="relative_humidity" value="87" group="calculated" std-pkg-id="9.1"/>'
+    '<element name="air_temperature" orig-name="12" element-index="1" value="-3.4" orig-value="-3.4" uom="C" '
+    'group="measured"><qualifier name="sensor_index" value="1" uom="unitless"/><quality-controlled><native>'
+    '<qualifier name="error" group="quality" value="N"/><qualifier name="suspect" group="quality" value="Y"/>'
+    '<qualifier name="suppressed" group="value" value="N"/></native><real-time>'
+    '<element name="overall_qa_summary" group="assessment" value="100"/></real-time></quality-controlled></element>'
+    '<element name="wind_speed" orig-name="24" element-index="2" value="11" orig-value="11" uom="km/h" '
+    'group="measured"><quality-controlled><native><qualifier name="error" group="quality" value="Y"/>'
+    '<qualifier name="suspect" group="quality" value="N"/><qualifier name="suppressed" group="value" value="N"/>'
+    '</native>'
+    '<real-time><element name="overall_qa_summary" group="assessment" value="10">'
+    '<element name="range_summary" group="assessment" value="10"/></element></real-time></quality-controlled>'
+    '</element></elements></om:result></om:Observation></om:member></om:ObservationCollection>')
+
+
+def write_payload(tmp_path, xml: str, file_name: str = 'payload.xml'):
+    file_path = tmp_path / file_name
+    file_path.write_text(xml)
+    return str(file_path)
+
+
+def extract_with_all_backends(xml_path: str, **kwargs):
+    return {backend: xml_extraction_complete_compose(xml_path, backend=backend, **kwargs)
+            for backend in EXTRACTION_BACKENDS}
+
+
+def assert_identical(results: dict):
+    reference_backend, reference = next(iter(results.items()))
+    for backend, station_data in results.items():
+        assert station_data == reference, "%s differs from %s in %s" % (
+            backend, reference_backend,
+            sorted(key for key in set(reference) | set(station_data) if reference.get(key) != station_data.get(key)))
+        assert list(station_data) == list(reference), "%s returns the keys in another order" % backend
+
+
+@pytest.mark.parametrize('version', [0, 1, 2])
+@pytest.mark.parametrize('num_sensors, num_subtests', [(12, 3), (14, 1), (5, 0)])
+@pytest.mark.parametrize('output_subtests, native_codes', [(True, True), (False, True), (True, False)])
+def test_backends_return_identical_dictionaries(tmp_path, version, num_sensors, num_subtests, output_subtests,
+                                                native_codes):
+    xml_path = write_payload(tmp_path, synthetic_xml(version=version, num_sensors=num_sensors,
+                                                     num_subtests=num_subtests, seed=version * 7 + num_sensors))
+    assert_identical(extract_with_all_backends(xml_path, output_subtests=output_subtests, native_codes=native_codes))
+
+
+def test_compared_dictionaries_contain_native_codes_subtests_and_corrections(tmp_path):
+    original = extract_with_all_backends(write_payload(tmp_path, synthetic_xml(version=0), 'v0.xml'))['lxml']
+    corrected = extract_with_all_backends(write_payload(tmp_path, synthetic_xml(version=1, seed=3), 'v1.xml'))['lxml']
+    assert original['air_temperature_12_native-error'] in ('Y', 'N')
+    assert 'air_temperature_12_qa-temporal_102' in original
+    assert corrected['version'] == '1'
+    assert any(key.endswith(('_qa_flag_override', '_value_override')) for key in corrected)
+    assert any(key.endswith('_qc_remark') for key in corrected)
+
+
+def test_backends_agree_on_handwritten_payload(tmp_path):
+    results = extract_with_all_backends(write_payload(tmp_path, HANDWRITTEN_XML))
+    assert_identical(results)
+    assert results['lxml']['wind_speed_24_native-error'] == 'Y'
+
+
+def test_backends_agree_on_in_memory_content(tmp_path):
+    xml = synthetic_xml(version=1, timestamp=datetime.datetime(2019, 12, 1, 6))
+    results = {backend: xml_extraction_complete_compose('export/payload_1', backend=backend,
+                                                        xml_content=xml.encode('utf-8'))
+               for backend in EXTRACTION_BACKENDS}
+    assert_identical(results)
+    assert results['lxml']['origin_filename'] == 'export/payload_1'
+    from_file = xml_extraction_complete_compose(write_payload(tmp_path, xml), backend='lxml')
+    assert dict(from_file, origin_filename='export/payload_1') == results['lxml']
+
+
+def test_compare_extraction_backends_reports_differences(tmp_path, monkeypatch):
+    xml_path = write_payload(tmp_path, synthetic_xml())
+    compare_extraction_backends([xml_path])
+
+    def changed_compose(*args, backend: str = 'bs4', **kwargs):
+        station_data = xml_extraction_complete_compose(*args, backend=backend, **kwargs)
+        if backend == EXTRACTION_BACKENDS[-1]:
+            station_data['air_temperature_12_value'] = None
+        return station_data
+    monkeypatch.setattr('xml2dict.xml_extraction_complete_compose', changed_compose)
+    with pytest.raises(AssertionError, match='air_temperature_12_value'):
+        compare_extraction_backends([xml_path])
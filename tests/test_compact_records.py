@@ -0,0 +1,64 @@
+import numpy as np
+import pytest
+
+from chunk_union import chunk_file_paths
+from compact_records import compact_records, compact_to_records, load_schema_registry, read_records_pickle
+from synthetic_xml import write_synthetic_folder
+from xml2dict import xml_folder_to_pickled_extraction_dicts
+
+# Values which look like numbers but can't be restored from one, next to values which can
+ODD_VALUES = ['-0.0', '007', '1e5', '', '1.50', '-10', None, '12.3', '99999999999999999999']
+
+
+@pytest.fixture(scope='module')
+def chunks(tmp_path_factory):
+    input_path = str(tmp_path_factory.mktemp('compact') / 'raw' / 'deploy') + '/'
+    write_synthetic_folder(input_path, num_stations=2, num_hours=6, num_versions=2, num_sensors=4)
+    xml_folder_to_pickled_extraction_dicts(input_path, chunk_by='station', multi_process=False, backend='lxml')
+    return [read_records_pickle(file_path) for file_path in chunk_file_paths(input_path.replace('raw', 'interim'))]
+
+
+def with_odd_values(records: dict):
+    """ Adds a column per odd value (in every other record, so each column has absent records) and a column mixing
+    all of them. """
+    records = {file_id: dict(station_data) for file_id, station_data in records.items()}
+    for position, station_data in enumerate(records.values()):
+        station_data['mixed_value'] = ODD_VALUES[position % len(ODD_VALUES)]
+        if position % 2:
+            for number, value in enumerate(ODD_VALUES):
+                station_data['odd_%d_value' % number] = value
+    return records
+
+
+def test_compact_chunks_restore_the_records(chunks, tmp_path):
+    registry = load_schema_registry(str(tmp_path) + '/')
+    for records in chunks:
+        records = with_odd_values(records)
+        compact, _ = compact_records(records, registry)
+        assert compact_to_records(compact, registry) == records
+
+
+def test_category_codes_keep_none_and_the_present_bitmap(chunks, tmp_path):
+    registry = load_schema_registry(str(tmp_path) + '/')
+    records = with_odd_values(chunks[0])
+    compact, _ = compact_records(records, registry)
+    columns = dict(zip([registry['columns'][column_id] for column_id in compact['column_ids'].tolist()],
+                       compact['columns']))
+    none_column = columns['odd_%d_value' % ODD_VALUES.index(None)]
+    assert none_column['encoding'] == 'category' and none_column['categories'] == [None]
+    assert columns['mixed_value']['encoding'] == 'category' and None in columns['mixed_value']['categories']
+    present = np.unpackbits(none_column['present'], count=len(records)).astype(bool)
+    assert present.tolist() == [bool(position % 2) for position in range(len(records))]
+
+
+def test_chunks_of_an_older_registry_version_are_restored_after_it_grew(chunks, tmp_path):
+    registry = load_schema_registry(str(tmp_path) + '/')
+    first, changed = compact_records(chunks[0], registry)
+    assert changed and first['schema_version'] == 1
+    second_records = with_odd_values(chunks[1])
+    second, changed = compact_records(second_records, registry)
+    assert changed and second['schema_version'] == 2
+    _, changed = compact_records(chunks[0], registry)
+    assert not changed and registry['version'] == 2
+    assert compact_to_records(first, registry) == chunks[0]
+    assert compact_to_records(second, registry) == second_records
@@ -0,0 +1,56 @@
+import pandas as pd
+import pytest
+
+from chunk_union import combine_chunks
+from dataset_builder import (build_store_target_dataset, build_target_dataset, feature_batch_columns,
+                             iter_target_batches, iter_target_frames, typed_feature_batch)
+from online_scoring import is_station_dummy
+from synthetic_xml import write_synthetic_folder
+from xml2dict import xml_folder_to_pickled_extraction_dicts
+
+TARGET_VAR = 'air_temperature_12'
+
+
+@pytest.fixture(scope='module')
+def output_path(tmp_path_factory):
+    input_path = str(tmp_path_factory.mktemp('dataset') / 'raw' / 'deploy') + '/'
+    write_synthetic_folder(input_path, num_stations=3, num_hours=24, num_versions=2, num_sensors=4)
+    xml_folder_to_pickled_extraction_dicts(input_path, chunk_by='station', multi_process=False, backend='lxml',
+                                           output_format='flat')
+    return input_path.replace('raw', 'interim')
+
+
+def concatenated_dataset(output_path: str, only_qa_failed: bool):
+    """ Builds the dataset by holding all batches in memory, like build_target_dataset did before streaming. """
+    batches = list(iter_target_batches(output_path, TARGET_VAR, only_qa_failed=only_qa_failed))
+    X = pd.concat([X_batch for X_batch, _ in batches])
+    station_columns = [column for column in X.columns if is_station_dummy(column)]
+    X[station_columns] = X[station_columns].fillna(0)
+    return X.dropna(how='all', axis=1), pd.concat([y_batch for _, y_batch in batches])
+
+
+@pytest.mark.parametrize('only_qa_failed', [True, False])
+def test_streamed_dataset_equals_the_concatenated_batches(output_path, only_qa_failed):
+    X, y = build_target_dataset(output_path, TARGET_VAR, only_qa_failed=only_qa_failed,
+                                drop_incomplete_columns=False)
+    expected_X, expected_y = concatenated_dataset(output_path, only_qa_failed)
+    pd.testing.assert_frame_equal(X, expected_X)
+    pd.testing.assert_series_equal(y, expected_y)
+
+
+def test_feature_columns_are_the_columns_of_the_typed_batch(output_path):
+    df = pd.concat(iter_target_frames(output_path, TARGET_VAR, only_qa_failed=False))
+    assert df['tc_identifier'].nunique() == 3
+    X, _ = typed_feature_batch(df, TARGET_VAR)
+    assert feature_batch_columns(df) == list(X.columns)
+
+
+@pytest.mark.parametrize('only_qa_failed', [True, False])
+def test_dataset_of_the_combined_columns_equals_the_dataset_of_the_chunks(output_path, tmp_path, only_qa_failed):
+    store_path = str(tmp_path / 'store') + '/'
+    combine_chunks(output_path, store_path=store_path, partition='records')
+    X, y = build_store_target_dataset(store_path, 'records', TARGET_VAR, only_qa_failed=only_qa_failed)
+    expected_X, expected_y = build_target_dataset(output_path, TARGET_VAR, only_qa_failed=only_qa_failed)
+    assert len(X) > 0
+    pd.testing.assert_frame_equal(X.sort_index(axis=1), expected_X.sort_index(axis=1), check_column_type=False)
+    pd.testing.assert_series_equal(y, expected_y)
@@ -0,0 +1,42 @@
+import datetime
+
+import numpy as np
+
+from chunk_union import write_column_values
+from extraction_metrics import collect_metrics
+from extraction_parquet import records_to_typed_dataframe
+from synthetic_xml import synthetic_source_uri
+
+
+def record(air_temperature: str, overall_qa_summary: str, date_time: str = '2019-01-01T00:00:00.000Z'):
+    timestamp = datetime.datetime(2019, 1, 1)
+    return {'source_uri': synthetic_source_uri('wic', '2402604', timestamp, 0), 'date_time': date_time,
+            'air_temperature_12_value': air_temperature, 'air_temperature_12_overall_qa_summary': overall_qa_summary}
+
+
+def test_typed_dataframe_counts_the_values_which_are_no_numbers():
+    records = {'a': record('1.5', '100'), 'b': record('MSNG', '100'), 'c': record(None, 'x', date_time='later')}
+    with collect_metrics() as metrics:
+        df = records_to_typed_dataframe(records)
+    assert df['air_temperature_12_value'].isna().tolist() == [False, True, True]
+    assert metrics['counters']['coerced_values.float'] == 1
+    assert metrics['counters']['coerced_values.flag'] == 1
+    assert metrics['counters']['coerced_values.datetime'] == 1
+    assert metrics['counters']['anomaly.coerced_value'] == 3
+    assert any("'MSNG'" in sample for sample in metrics['anomalies']['coerced_value'])
+
+
+def test_typed_dataframe_of_clean_records_records_no_coercion():
+    with collect_metrics() as metrics:
+        records_to_typed_dataframe({'a': record('1.5', '100'), 'b': record(None, None)})
+    assert 'coerced_value' not in metrics['anomalies']
+
+
+def test_union_column_values_count_the_values_which_are_no_numbers():
+    array = np.full(4, np.nan)
+    with collect_metrics() as metrics:
+        write_column_values(array, column='air_temperature_12_value', column_type='float', rows=np.arange(1, 4),
+                            values=['2.5', None, 'n/a'])
+    np.testing.assert_array_equal(array, [np.nan, 2.5, np.nan, np.nan])
+    assert metrics['counters']['coerced_values.float'] == 1
+    assert "air_temperature_12_value" in metrics['anomalies']['coerced_value'][0]
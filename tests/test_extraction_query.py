@@ -0,0 +1,54 @@
+import pickle
+
+import pandas as pd
+import pytest
+
+from extraction_query import build_extraction_index, chunk_file_paths, query_extraction
+from synthetic_xml import write_synthetic_folder
+from xml2dict import read_pickle, xml_folder_to_pickled_extraction_dicts
+
+
+@pytest.fixture
+def output_path(tmp_path):
+    input_path = str(tmp_path / 'raw' / 'deploy') + '/'
+    write_synthetic_folder(input_path, num_stations=2, num_hours=12, num_versions=2, num_sensors=4)
+    xml_folder_to_pickled_extraction_dicts(input_path, chunk_by='station', multi_process=False, backend='lxml')
+    return input_path.replace('raw', 'interim')
+
+
+def expected_extractions(output_path: str, station: str, start: str, end: str):
+    df = pd.concat([pd.DataFrame.from_dict(read_pickle(file_path), orient='index')
+                    for file_path in chunk_file_paths(output_path)])
+    times = pd.to_datetime(df['date_time'], utc=True)
+    return df[(df['tc_identifier'] == station) & (times >= pd.Timestamp(start)) & (times <= pd.Timestamp(end))]
+
+
+def rewrite_chunk_without_first_records(file_path: str, num_records: int):
+    """ Writes a chunk again with fewer records, like an incremental extraction of the station does. """
+    chunk = read_pickle(file_path)
+    with open(file_path, 'wb') as handle:
+        pickle.dump({file_id: chunk[file_id] for file_id in list(chunk)[num_records:]}, handle)
+
+
+def test_query_returns_the_extractions_of_the_time_range(output_path):
+    build_extraction_index(output_path)
+    result = query_extraction(output_path, 'waa ', start='2019-01-01T02:00Z', end='2019-01-01T05:00Z')
+    expected = expected_extractions(output_path, 'WAA', '2019-01-01T02:00Z', '2019-01-01T05:00Z')
+    assert sorted(result.index) == sorted(expected.index)
+    assert len(result) == 8
+
+
+def test_query_of_a_rewritten_chunk_updates_the_index(output_path):
+    build_extraction_index(output_path)
+    rewrite_chunk_without_first_records(chunk_file_paths(output_path)[0], num_records=4)
+    result = query_extraction(output_path, 'WAA', start='2019-01-01T00:00Z', end='2019-01-01T05:00Z')
+    expected = expected_extractions(output_path, 'WAA', '2019-01-01T00:00Z', '2019-01-01T05:00Z')
+    assert sorted(result.index) == sorted(expected.index)
+    assert (pd.to_datetime(result['date_time'], utc=True) >= pd.Timestamp('2019-01-01T02:00Z')).all()
+
+
+def test_query_of_a_stale_index_fails_without_rebuild(output_path):
+    build_extraction_index(output_path)
+    rewrite_chunk_without_first_records(chunk_file_paths(output_path)[0], num_records=4)
+    with pytest.raises(AssertionError, match='stale'):
+        query_extraction(output_path, 'WAA', start='2019-01-01T00:00Z', end='2019-01-01T00:30Z', rebuild_stale=False)
@@ -0,0 +1,93 @@
+import glob
+import json
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import time
+
+import pandas as pd
+import pytest
+
+from compact_records import read_records_pickle
+from extraction_parquet import read_parquet_extraction
+from extraction_queue import LEASE_FOLDER_NAME, QUEUE_FOLDER_NAME
+from synthetic_xml import write_synthetic_folder
+from xml2dict import get_mapping_station2filename, xml_folder_to_pickled_extraction_dicts
+
+SOURCE_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src', 'data')
+EXTRACTION_KWARGS = dict(chunk_by='station', multi_process=False, backend='lxml', max_files_per_unit=20)
+# A host of the cooperative run, the short lease lets the others reclaim the tasks of a killed host within the test
+WORKER_SCRIPT = '''
+import sys
+from xml2dict import xml_folder_to_pickled_extraction_dicts
+xml_folder_to_pickled_extraction_dicts(sys.argv[1], output_format=sys.argv[2], queue_name='test', lease_seconds=1.5,
+                                       poll_seconds=0.05, **%r)
+''' % EXTRACTION_KWARGS
+NUM_HOSTS = 3
+
+
+def start_host(input_path: str, output_format: str, **kwargs):
+    return subprocess.Popen([sys.executable, '-c', WORKER_SCRIPT, input_path, output_format],
+                            env=dict(os.environ, PYTHONPATH=SOURCE_PATH), text=True, **kwargs)
+
+
+def output_snapshot(output_path: str, output_format: str):
+    """ Returns the chunks of an output folder and its manifest. """
+    with open(output_path + 'extraction_manifest.json') as manifest_file:
+        manifest = json.load(manifest_file)
+    if output_format == 'parquet':
+        df = read_parquet_extraction(output_path + 'parquet/')
+        return df.sort_values('file_id').reset_index(drop=True).astype(str).sort_index(axis=1), manifest
+    return {os.path.basename(file_path): read_records_pickle(file_path)
+            for file_path in sorted(glob.glob(output_path + '*.pickle'))}, manifest
+
+
+def kill_during_unit_lease(host, lease_path: str, timeout_seconds: float = 60):
+    """ Kills a host as soon as it holds the lease of a work unit.
+
+    Returns:
+        killed_with_lease (bool) - Indicator if the lease of the host was left behind
+    """
+    start_time = time.time()
+    while not glob.glob(lease_path + 'unit.*.lease'):
+        assert host.poll() is None, "The host finished before it leased a work unit."
+        assert time.time() - start_time < timeout_seconds, "The host didn't lease a work unit in time."
+        time.sleep(0.005)
+    host.send_signal(signal.SIGKILL)
+    host.wait()
+    return bool(glob.glob(lease_path + 'unit.*.lease'))
+
+
+@pytest.fixture(scope='module')
+def input_path(tmp_path_factory):
+    input_path = str(tmp_path_factory.mktemp('queue') / 'raw' / 'deploy') + '/'
+    write_synthetic_folder(input_path, num_stations=3, num_hours=40, num_versions=2, num_sensors=6)
+    get_mapping_station2filename(input_path)
+    return input_path
+
+
+@pytest.mark.parametrize('output_format', ['pickle', 'compact', 'flat', 'parquet'])
+def test_hosts_killed_mid_lease_produce_the_single_host_output(input_path, output_format):
+    output_path = input_path.replace('raw', 'interim')
+    xml_folder_to_pickled_extraction_dicts(input_path, output_format=output_format, **EXTRACTION_KWARGS)
+    expected_chunks, expected_manifest = output_snapshot(output_path, output_format)
+    shutil.rmtree(output_path)
+
+    killed_with_lease = kill_during_unit_lease(start_host(input_path, output_format, stdout=subprocess.DEVNULL),
+                                               lease_path=output_path + QUEUE_FOLDER_NAME + 'test/' + LEASE_FOLDER_NAME)
+    hosts = [start_host(input_path, output_format, stdout=subprocess.PIPE) for _ in range(NUM_HOSTS)]
+    outputs = [host.communicate(timeout=300)[0] for host in hosts]
+    assert [host.returncode for host in hosts] == [0] * NUM_HOSTS
+    if killed_with_lease:
+        assert any('Reclaimed lease unit.' in output for output in outputs)
+
+    chunks, manifest = output_snapshot(output_path, output_format)
+    if output_format == 'parquet':
+        pd.testing.assert_frame_equal(chunks, expected_chunks)
+    else:
+        assert list(chunks) == list(expected_chunks)
+        assert all(chunks[chunk_name] == expected_chunks[chunk_name] for chunk_name in expected_chunks)
+    assert manifest == expected_manifest
+    shutil.rmtree(output_path)
@@ -0,0 +1,171 @@
+import datetime
+import glob
+import os
+import shutil
+
+import pytest
+
+import xml2dict
+from compact_records import read_records_pickle
+from extraction_manifest import file_needs_extraction, file_manifest_entry, list_journal_files
+from synthetic_xml import synthetic_file_name, synthetic_xml, write_synthetic_folder
+from xml2dict import get_mapping_filename2station, xml_folder_to_pickled_extraction_dicts
+
+EXTRACTION_KWARGS = dict(chunk_by='station', multi_process=False, backend='lxml', max_files_per_unit=10)
+OPTIONS = {'qa_category_list': ['presence'], 'output_subtests': True, 'native_codes': True,
+           'output_format': 'pickle'}
+
+
+def without_folder(value, input_path: str):
+    """ Strips the input folder from the origin filenames, which differ between the extracted folders. """
+    if isinstance(value, dict):
+        return {key: without_folder(item, input_path) for key, item in value.items()}
+    if isinstance(value, str) and value.startswith(input_path):
+        return value[len(input_path):]
+    return value
+
+
+def chunks(input_path: str):
+    """ Returns the records of every chunk pickle extracted from an input folder by chunk. """
+    return {os.path.basename(file_path): without_folder(read_records_pickle(file_path), input_path)
+            for file_path in sorted(glob.glob(input_path.replace('raw', 'interim') + '*.pickle'))}
+
+
+def fresh_chunks(input_path: str, fresh_path: str, **kwargs):
+    """ Extracts a copy of the payloads of input_path completely and returns its chunks. """
+    os.makedirs(fresh_path)
+    for file_name in os.listdir(input_path):
+        if file_name.endswith('_payload.ldr'):
+            shutil.copy2(input_path + file_name, fresh_path + file_name)
+    xml_folder_to_pickled_extraction_dicts(fresh_path, **dict(EXTRACTION_KWARGS, **kwargs))
+    return chunks(fresh_path)
+
+
+def change_folder(input_path: str):
+    """ Adds the payloads of a new hour and a new station, changes the content of one payload, only touches another
+    one and deletes a third. """
+    timestamp = datetime.datetime(2019, 1, 1, 6)
+    for tc_identifier, station_identifier in (('waa', '1000000'), ('wzz', '1999999')):
+        with open(input_path + synthetic_file_name(tc_identifier, station_identifier, timestamp, 0), 'w') as file:
+            file.write(synthetic_xml(tc_identifier=tc_identifier, station_identifier=station_identifier,
+                                     timestamp=timestamp, num_sensors=4))
+    changed_time = datetime.datetime(2019, 1, 1, 2)
+    with open(input_path + synthetic_file_name('wab', '1001013', changed_time, 1), 'w') as file:
+        file.write(synthetic_xml(tc_identifier='wab', station_identifier='1001013', timestamp=changed_time, version=1,
+                                 num_sensors=4, seed=1))
+    touched_path = input_path + synthetic_file_name('waa', '1000000', datetime.datetime(2019, 1, 1, 3), 0)
+    os.utime(touched_path, ns=(os.stat(touched_path).st_atime_ns, os.stat(touched_path).st_mtime_ns + 10 ** 9))
+    os.remove(input_path + synthetic_file_name('wab', '1001013', datetime.datetime(2019, 1, 1, 4), 0))
+
+
+@pytest.fixture(params=['pickle', 'compact', 'flat'])
+def extracted_folder(request, tmp_path):
+    input_path = str(tmp_path / 'raw' / 'deploy') + '/'
+    write_synthetic_folder(input_path, num_stations=2, num_hours=6, num_versions=2, num_sensors=4)
+    xml_folder_to_pickled_extraction_dicts(input_path, output_format=request.param, **EXTRACTION_KWARGS)
+    return input_path, request.param, str(tmp_path / 'raw' / 'fresh') + '/'
+
+
+def test_incremental_run_equals_a_full_run(extracted_folder):
+    input_path, output_format, fresh_path = extracted_folder
+    change_folder(input_path)
+    xml_folder_to_pickled_extraction_dicts(input_path, output_format=output_format, incremental=True,
+                                           **EXTRACTION_KWARGS)
+    assert chunks(input_path) == fresh_chunks(input_path, fresh_path,
+                                                                        output_format=output_format)
+
+
+def test_removed_files_leave_the_chunks_which_are_not_extracted_again(extracted_folder):
+    input_path, output_format, fresh_path = extracted_folder
+    os.remove(input_path + synthetic_file_name('waa', '1000000', datetime.datetime(2019, 1, 1, 5), 1))
+    for file_path in glob.glob(input_path + 'wab_1001013_*'):
+        os.remove(file_path)
+    xml_folder_to_pickled_extraction_dicts(input_path, output_format=output_format, incremental=True,
+                                           **EXTRACTION_KWARGS)
+    assert list(chunks(input_path)) == ['waa_1000000.pickle']
+    assert chunks(input_path) == fresh_chunks(input_path, fresh_path, output_format=output_format)
+
+
+def test_run_killed_after_its_journals_is_resumed(extracted_folder, monkeypatch):
+    input_path, output_format, fresh_path = extracted_folder
+    output_path = input_path.replace('raw', 'interim')
+    change_folder(input_path)
+    journals = []
+    write_manifest_journal = xml2dict.write_manifest_journal
+
+    def killed_after_first_journal(**kwargs):
+        if journals:
+            raise KeyboardInterrupt
+        write_manifest_journal(**kwargs)
+        journals.append(kwargs['chunk_name'])
+
+    monkeypatch.setattr(xml2dict, 'write_manifest_journal', killed_after_first_journal)
+    with pytest.raises(KeyboardInterrupt):
+        xml_folder_to_pickled_extraction_dicts(input_path, output_format=output_format, incremental=True,
+                                               **EXTRACTION_KWARGS)
+    assert len(list_journal_files(output_path)) == 1
+    monkeypatch.undo()
+
+    xml_folder_to_pickled_extraction_dicts(input_path, output_format=output_format, incremental=True,
+                                           **EXTRACTION_KWARGS)
+    assert not list_journal_files(output_path)
+    assert chunks(input_path) == fresh_chunks(input_path, fresh_path, output_format=output_format)
+
+
+def test_changed_options_extract_every_file_again(extracted_folder, monkeypatch):
+    input_path, output_format, fresh_path = extracted_folder
+    extracted = []
+    extraction_complete_compose = xml2dict.xml_extraction_complete_compose
+
+    def counted_compose(xml_path, **kwargs):
+        extracted.append(xml_path)
+        return extraction_complete_compose(xml_path, **kwargs)
+
+    monkeypatch.setattr(xml2dict, 'xml_extraction_complete_compose', counted_compose)
+    xml_folder_to_pickled_extraction_dicts(input_path, output_format=output_format, incremental=True,
+                                           **EXTRACTION_KWARGS)
+    assert not extracted
+    xml_folder_to_pickled_extraction_dicts(input_path, output_format=output_format, incremental=True,
+                                           output_subtests=False, **EXTRACTION_KWARGS)
+    assert len(extracted) == 24
+    assert chunks(input_path) == fresh_chunks(input_path, fresh_path,
+                                                                        output_format=output_format,
+                                                                        output_subtests=False)
+
+
+def test_rejected_files_are_only_read_once(tmp_path, monkeypatch, capsys):
+    input_path = str(tmp_path / 'raw' / 'deploy') + '/'
+    write_synthetic_folder(input_path, num_stations=1, num_hours=2, num_versions=1, num_sensors=1)
+    with open(input_path + 'notes.txt', 'w') as file:
+        file.write('no payload')
+    scanned = []
+    header_source_uri = xml2dict.xml_header_source_uri
+
+    def counted_source_uri(xml_path, **kwargs):
+        scanned.append(os.path.basename(xml_path))
+        return header_source_uri(xml_path, **kwargs)
+
+    monkeypatch.setattr(xml2dict, 'xml_header_source_uri', counted_source_uri)
+    xml_folder_to_pickled_extraction_dicts(input_path, **EXTRACTION_KWARGS)
+    assert len(scanned) == 3 and 'notes.txt' in scanned
+    assert "notes.txt is no valid xml payload" in capsys.readouterr().out
+    assert get_mapping_filename2station(input_path, multi_process=False)['notes.txt'] is None
+
+    xml_folder_to_pickled_extraction_dicts(input_path, incremental=True, **EXTRACTION_KWARGS)
+    assert len(scanned) == 3
+    assert "no valid xml payload" not in capsys.readouterr().out
+
+
+def test_touched_file_returns_a_refreshed_entry(tmp_path):
+    file_path = str(tmp_path / 'payload.xml')
+    with open(file_path, 'w') as file:
+        file.write(synthetic_xml(num_sensors=1))
+    entry = file_manifest_entry(file_path, chunk_name='chunk', file_id='file', options=OPTIONS)
+    os.utime(file_path, ns=(entry['mtime'], entry['mtime'] + 10 ** 9))
+    previous_entry = dict(entry)
+
+    needs_extraction, refreshed_entry = file_needs_extraction(file_path, entry, OPTIONS)
+    assert not needs_extraction
+    assert entry == previous_entry
+    assert refreshed_entry == dict(entry, mtime=entry['mtime'] + 10 ** 9)
+    assert file_needs_extraction(file_path, refreshed_entry, dict(OPTIONS, native_codes=False)) == (True, None)
@@ -0,0 +1,136 @@
+import asyncio
+import datetime
+import time
+
+import pandas as pd
+import pytest
+
+import notification_feed
+from notification_feed import buffer_to_dataframe, load_fetched_urls, new_observation_buffer, poll_notification_feed
+from synthetic_xml import synthetic_xml
+from xml2dict import extraction_file_id, xml_extraction_complete_compose
+
+web = pytest.importorskip('aiohttp.web')
+test_utils = pytest.importorskip('aiohttp.test_utils')
+
+
+def payload_name(station: str, hour: int):
+    return '%s_%02d' % (station, hour)
+
+
+def feed_title(name: str):
+    return '/20190101T0000/%s/orig/%s' % (name.split('_')[0], name)
+
+
+def payload_xml(name: str):
+    station, hour = name.split('_')
+    return synthetic_xml(tc_identifier=station, station_identifier=str(1000000 + ord(station[-1])),
+                         timestamp=datetime.datetime(2019, 1, 1, int(hour)), num_sensors=4)
+
+
+class FeedStandIn:
+    """ Local stand-in of the DMS: each feed window lists payload names and every request of a payload is counted. The
+    payload 'missing' doesn't exist and 'broken' is no xml. """
+
+    def __init__(self, windows: dict):
+        self.windows = windows
+        self.requests = {}
+
+    def application(self):
+        app = web.Application()
+        app.router.add_get('/notification', self.feed)
+        app.router.add_get('/payload/{name}', self.payload)
+        return app
+
+    async def feed(self, request):
+        names = self.windows[request.query['time']]
+        items = ''.join('<item><title>%s</title><link>%s</link></item>' % (
+            feed_title(name), request.url.with_path('/payload/' + name))
+            for name in names)
+        return web.Response(body='<rss><channel>%s</channel></rss>' % items, content_type='application/rss+xml')
+
+    async def payload(self, request):
+        name = request.match_info['name']
+        self.requests[name] = self.requests.get(name, 0) + 1
+        if name == 'missing':
+            raise web.HTTPNotFound()
+        if name == 'broken':
+            return web.Response(body='<no xml', content_type='application/xml')
+        return web.Response(body=payload_xml(name), content_type='application/xml')
+
+
+def run_polls(stand_in: FeedStandIn, buffer: dict, fetched_urls: set, port: int = None, **kwargs):
+    async def run():
+        server = test_utils.TestServer(stand_in.application(), port=port)
+        await server.start_server()
+        try:
+            feed_urls = [str(server.make_url('/notification?time=%s' % window)) for window in stand_in.windows]
+            return await poll_notification_feed(feed_urls=feed_urls, buffer=buffer, fetched_urls=fetched_urls,
+                                                interval_seconds=0, **kwargs), str(server.make_url('/payload/'))
+        finally:
+            await server.close()
+    return asyncio.run(run())
+
+
+def test_polls_ingest_every_new_payload_once(tmp_path):
+    first_day = [payload_name('waa', hour) for hour in range(4)]
+    windows = {'1d': first_day + ['waa_supp_1440', 'missing'],
+               '2d': first_day + [payload_name('wab', hour) for hour in range(3)] + ['broken']}
+    stand_in = FeedStandIn(windows)
+    state_path = str(tmp_path / 'fetched_urls.txt')
+    buffer = new_observation_buffer(capacity=2)
+
+    stats, payload_url = run_polls(stand_in, buffer, fetched_urls=set(), max_polls=2, state_path=state_path,
+                              parse_workers=1)
+
+    expected_names = sorted(set(windows['1d'] + windows['2d']) - {'waa_supp_1440', 'missing', 'broken'})
+    assert stats[0]['new'] == len(expected_names) and stats[0]['failed'] == 2
+    assert stats[1]['new'] == 0 and stats[1]['known'] == 2 * len(first_day) + 3
+    # Payloads listed in both windows and in both polls are fetched once, failed ones are tried again
+    assert {name: stand_in.requests[name] for name in expected_names} == {name: 1 for name in expected_names}
+    assert stand_in.requests['missing'] == 2 and 'waa_supp_1440' not in stand_in.requests
+
+    # The buffered rows are the extraction dictionaries of the payloads
+    records = [xml_extraction_complete_compose(payload_url + name, backend='lxml',
+                                               xml_content=payload_xml(name).encode('utf-8'))
+               for name in expected_names]
+    expected = pd.DataFrame.from_dict({extraction_file_id(station_data): station_data for station_data in records},
+                                      orient='index')
+    df = buffer_to_dataframe(buffer)
+    assert set(df.columns) == set(expected.columns)
+    pd.testing.assert_frame_equal(df.sort_index().astype(object),
+                                  expected.sort_index()[list(df.columns)].astype(object))
+    with open(state_path) as state_file:
+        assert sorted(line.rsplit('/', 1)[1] for line in state_file.read().split()) == expected_names
+
+
+def test_state_of_previous_runs_is_skipped(tmp_path):
+    stand_in = FeedStandIn({'1d': [payload_name('waa', hour) for hour in range(3)]})
+    state_path = str(tmp_path / 'fetched_urls.txt')
+    port = test_utils.unused_port()
+    buffer = new_observation_buffer()
+    run_polls(stand_in, buffer, fetched_urls=load_fetched_urls(state_path), port=port, max_polls=1,
+              state_path=state_path, parse_workers=0)
+    stand_in.windows['1d'].append(payload_name('waa', 3))
+    stats, _ = run_polls(stand_in, buffer, fetched_urls=load_fetched_urls(state_path), port=port, max_polls=1,
+                         state_path=state_path, parse_workers=0)
+    assert stats[0]['new'] == 1 and stats[0]['known'] == 3
+    assert buffer['size'] == 4 and set(stand_in.requests.values()) == {1}
+
+
+def test_parsing_does_not_block_the_fetches(monkeypatch):
+    stand_in = FeedStandIn({'1d': [payload_name('waa', hour) for hour in range(8)]})
+    parse_seconds = 0.25
+    extract_payload = notification_feed.extract_payload
+
+    def slow_extract_payload(*args, **kwargs):
+        time.sleep(parse_seconds)
+        return extract_payload(*args, **kwargs)
+    monkeypatch.setattr(notification_feed, 'extract_payload', slow_extract_payload)
+
+    buffer = new_observation_buffer()
+    start_time = time.perf_counter()
+    stats, _ = run_polls(stand_in, buffer, fetched_urls=set(), max_polls=1, max_concurrency=8, parse_workers=0)
+    assert stats[0]['new'] == 8
+    # Parsed one after the other in the event loop, the 8 payloads would take 8 * parse_seconds
+    assert time.perf_counter() - start_time < 8 * parse_seconds / 2
@@ -0,0 +1,77 @@
+import datetime
+import threading
+import time
+
+import pytest
+
+from online_scoring import compile_feature_layout, score_stream
+from synthetic_xml import synthetic_source_uri
+
+
+class ThresholdModel:
+    """ Model flagging observations whose air temperature is below zero. """
+
+    def predict(self, matrix):
+        return (matrix[:, 0] < 0).astype(int)
+
+
+SCORING_MODEL = {'model': ThresholdModel(), 'layout': compile_feature_layout(['air_temperature_12_value'])}
+
+
+def observation(hour: int, value: str = '-1.5'):
+    return {'source_uri': synthetic_source_uri('wic', '2402604', datetime.datetime(2019, 1, 1, hour), 0),
+            'air_temperature_12_value': value}
+
+
+def test_single_observation_is_scored_at_its_deadline():
+    next_hour = threading.Event()
+
+    def records():
+        yield observation(0)
+        # The next observation of the station arrives an hour later
+        next_hour.wait(timeout=10)
+        yield observation(1, value='3.0')
+
+    start_time = time.perf_counter()
+    predictions = score_stream(SCORING_MODEL, records(), max_wait_seconds=0.2)
+    first = next(predictions)
+    assert time.perf_counter() - start_time < 1
+    assert first == ('wic_2402604_201901010000_data_0', 1)
+    next_hour.set()
+    assert [prediction for _, prediction in predictions] == [0]
+
+
+def test_full_batches_are_scored_without_waiting():
+    latencies = {}
+    results = list(score_stream(SCORING_MODEL, (observation(hour % 24, str(hour - 50)) for hour in range(100)),
+                                max_batch_size=32, max_wait_seconds=60, latencies=latencies))
+    assert [prediction for _, prediction in results] == [int(hour < 50) for hour in range(100)]
+    assert len(latencies['batch']) == 4 and len(latencies['observation']) == 100
+
+
+def test_error_of_the_stream_is_raised_after_the_scored_records():
+    def records():
+        yield observation(0)
+        raise ValueError('feed closed')
+
+    predictions = score_stream(SCORING_MODEL, records(), max_wait_seconds=60)
+    assert next(predictions)[1] == 1
+    with pytest.raises(ValueError, match='feed closed'):
+        next(predictions)
+
+
+def test_closed_stream_stops_reading_the_records():
+    consumed = []
+
+    def records():
+        for hour in range(10 ** 6):
+            consumed.append(hour)
+            yield observation(hour % 24)
+
+    predictions = score_stream(SCORING_MODEL, records(), max_batch_size=1)
+    assert next(predictions)[1] == 1
+    predictions.close()
+    num_consumed = len(consumed)
+    time.sleep(0.1)
+    assert len(consumed) == num_consumed < 10 ** 6
+    assert not any(thread.name == 'score_stream_reader' for thread in threading.enumerate())
@@ -0,0 +1,102 @@
+import datetime
+import re
+
+import pytest
+
+import xml2dict
+from chunk_union import chunk_file_paths
+from synthetic_xml import synthetic_file_name, synthetic_xml
+from xml2dict import (QA_PREFILTER_KEY, qa_summary_comparision_value, read_pickle,
+                      xml_folder_to_pickled_extraction_dicts, xml_header_values)
+
+QA_SUMMARY_ELEMENT = re.compile(r'<element name="\w+" group="qa_summary" value="\d+"/>')
+
+
+def write_payload(folder_path: str, hour: int, version: int = 0, passed: bool = True, counts: bool = True):
+    """ Writes a payload whose automatic QA passed completely (no subtests, all flags 100) or not, optionally without
+    the qa_summary counts in its header. """
+    timestamp = datetime.datetime(2019, 1, 1, hour)
+    xml = synthetic_xml(timestamp=timestamp, version=version, num_sensors=4, num_subtests=0 if passed else 3,
+                        status_indicators=False)
+    if not counts:
+        xml = QA_SUMMARY_ELEMENT.sub('', xml)
+    file_path = folder_path + synthetic_file_name('wic', '2402604', timestamp, version)
+    with open(file_path, 'w') as file:
+        file.write(xml)
+    if counts:
+        check_stat = qa_summary_comparision_value(qa_summary=xml_header_values(file_path)[1])
+        assert (check_stat['accepted_count'] == check_stat['total_qa_count']) == passed
+    return file_path
+
+
+@pytest.fixture
+def input_path(tmp_path):
+    input_path = str(tmp_path / 'raw' / 'deploy') + '/'
+    (tmp_path / 'raw' / 'deploy').mkdir(parents=True)
+    return input_path
+
+
+def extract_qa_failed_only(input_path: str, monkeypatch):
+    """ Extracts the folder with qa_failed_only and returns the records by file id and the scanned files. """
+    scanned = []
+
+    def spy_observations_passed(xml_path):
+        scanned.append(xml_path)
+        return observations_passed(xml_path)
+
+    observations_passed = xml2dict.xml_observations_passed
+    monkeypatch.setattr(xml2dict, 'xml_observations_passed', spy_observations_passed)
+    xml_folder_to_pickled_extraction_dicts(input_path, chunk_by='station', multi_process=False, backend='lxml',
+                                           qa_failed_only=True)
+    records = {}
+    for file_path in chunk_file_paths(input_path.replace('raw', 'interim')):
+        records.update(read_pickle(file_path))
+    return records, scanned
+
+
+def is_light(station_data: dict):
+    return station_data.get(QA_PREFILTER_KEY) == 'passed'
+
+
+def test_passed_original_gets_a_light_record_with_the_header_counts(input_path, monkeypatch):
+    file_path = write_payload(input_path, hour=0)
+    records, scanned = extract_qa_failed_only(input_path, monkeypatch)
+    station_data = records['wic_2402604_201901010000_data_0']
+    assert is_light(station_data) and not scanned
+    assert station_data['accepted_count'] == station_data['elements_quality_assessed_count'] == '4'
+    assert station_data['source_uri'] == xml_header_values(file_path)[0]['source_uri']
+    assert not any(key.endswith('_overall_qa_summary') for key in station_data)
+
+
+def test_failed_counts_are_extracted_fully(input_path, monkeypatch):
+    write_payload(input_path, hour=1, passed=False)
+    records, scanned = extract_qa_failed_only(input_path, monkeypatch)
+    station_data = records['wic_2402604_201901010100_data_0']
+    assert not is_light(station_data) and not scanned
+    assert any(value not in (None, '100') for key, value in station_data.items() if key.endswith('_overall_qa_summary'))
+
+
+def test_original_with_a_later_version_is_extracted_fully(input_path, monkeypatch):
+    write_payload(input_path, hour=2)
+    write_payload(input_path, hour=2, version=1)
+    records, scanned = extract_qa_failed_only(input_path, monkeypatch)
+    assert not is_light(records['wic_2402604_201901010200_data_0'])
+    assert not is_light(records['wic_2402604_201901010200_data_1'])
+    assert 'air_temperature_12_overall_qa_summary' in records['wic_2402604_201901010200_data_0']
+    assert not scanned
+
+
+def test_files_without_counts_are_scanned(input_path, monkeypatch):
+    passed_path = write_payload(input_path, hour=3, counts=False)
+    failed_path = write_payload(input_path, hour=4, passed=False, counts=False)
+    records, scanned = extract_qa_failed_only(input_path, monkeypatch)
+    assert sorted(scanned) == sorted([passed_path, failed_path])
+    assert is_light(records['wic_2402604_201901010300_data_0'])
+    assert not is_light(records['wic_2402604_201901010400_data_0'])
+
+
+def test_incremental_runs_by_chunksize_are_rejected(input_path):
+    write_payload(input_path, hour=0)
+    with pytest.raises(AssertionError, match="chunk_by='station'"):
+        xml_folder_to_pickled_extraction_dicts(input_path, chunk_by='chunksize', multi_process=False,
+                                               qa_failed_only=True, incremental=True)
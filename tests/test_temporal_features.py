@@ -0,0 +1,38 @@
+import numpy as np
+import pandas as pd
+
+from temporal_features import hour_intervals, new_temporal_state, temporal_features, update_temporal_features
+
+HOURS_PER_YEAR = 8760
+
+
+def observations(times, values, station: str = 'WAA'):
+    return pd.DataFrame({'tc_identifier': station,
+                         'date_time': [time.strftime('%Y-%m-%dT%H:%M:%S.000Z') for time in times],
+                         'air_temperature_12_value': [str(value) for value in values]},
+                        index=['%s_%d' % (station, number) for number in range(len(values))])
+
+
+def test_intervals_leave_out_the_gap_before_a_late_observation():
+    latest_hour = 500000
+    starts, ends = hour_intervals(hours=np.array([latest_hour, latest_hour - HOURS_PER_YEAR]), ring_size=24,
+                                  end_hour=latest_hour)
+    np.testing.assert_array_equal(starts, [latest_hour - HOURS_PER_YEAR - 24, latest_hour - 24])
+    np.testing.assert_array_equal(ends, [latest_hour - HOURS_PER_YEAR, latest_hour])
+
+
+def test_late_observation_gets_the_features_of_a_single_batch():
+    times = pd.date_range('2020-01-01', periods=48, freq='h', tz='UTC')
+    history = observations(times, np.arange(48.0))
+    late = observations([times[-1] + pd.Timedelta(hours=1), times[0] - pd.Timedelta(days=365),
+                         times[0] - pd.Timedelta(days=365) + pd.Timedelta(hours=2)], [48.0, -1.0, -2.0])
+    late.index = ['late_%d' % number for number in range(len(late))]
+
+    state = new_temporal_state(sensor_prefixes=['air_temperature_12'])
+    update_temporal_features(state, history)
+    features = update_temporal_features(state, late)
+    expected, _ = temporal_features(pd.concat([history, late]), sensor_prefixes=['air_temperature_12'])
+    pd.testing.assert_frame_equal(features, expected.loc[late.index])
+    assert features.loc['late_0', 'air_temperature_12_value_lag_1'] == 47.0
+    assert features.loc['late_2', 'air_temperature_12_value_lag_2'] == -1.0
+    assert state['stations']['WAA']['latest_hour'] == times[-1].value // 3600 // 10 ** 9 + 1
@@ -0,0 +1,56 @@
+import json
+
+import numpy as np
+import pytest
+from sklearn.utils import check_array
+
+from synthetic_xml import write_synthetic_folder
+from training_runner import SUMMARY_FILE_NAME, TEST_PARTITION, TRAIN_PARTITION, load_target_features, train_targets
+from xml2dict import xml_folder_to_pickled_extraction_dicts
+
+TARGET_VAR = 'air_temperature_12'
+
+
+@pytest.fixture(scope='module')
+def model_path(tmp_path_factory):
+    tmp_path = tmp_path_factory.mktemp('training')
+    input_path = str(tmp_path / 'raw' / 'deploy') + '/'
+    write_synthetic_folder(input_path, num_stations=3, num_hours=24, num_versions=2, num_sensors=4)
+    xml_folder_to_pickled_extraction_dicts(input_path, chunk_by='station', multi_process=False, backend='lxml',
+                                           output_format='flat')
+    model_path = str(tmp_path / 'models') + '/'
+    train_targets(output_path=input_path.replace('raw', 'interim'), model_path=model_path, target_vars=[TARGET_VAR],
+                  num_cores=2, resampler=None, model_params={'n_estimators': 5},
+                  dataset_kwargs={'only_qa_failed': False}, permutation_repeats=0, num_partial_dependence=1)
+    return model_path
+
+
+def test_training_rows_are_passed_to_the_estimator_without_copy(model_path):
+    X_train, y_train, columns = load_target_features(model_path + 'training_features/', TARGET_VAR, TRAIN_PARTITION)
+    X_test, y_test, _ = load_target_features(model_path + 'training_features/', TARGET_VAR, TEST_PARTITION)
+    assert isinstance(X_train, np.memmap) and not X_train.flags.writeable
+    assert X_train.shape == (len(y_train), len(columns)) and X_test.shape == (len(y_test), len(columns))
+    assert len(y_train) + len(y_test) == 72
+    assert np.shares_memory(check_array(X_train, dtype=np.float32), X_train)
+
+
+def test_nested_stages_are_reported_within_their_parent(model_path):
+    with open(model_path + SUMMARY_FILE_NAME) as summary_file:
+        stage_seconds = json.load(summary_file)['stage_seconds']
+    assert {'build_datasets', 'train_models', 'train_models/fit', 'build_datasets/save_features'} <= set(
+        stage_seconds)
+    assert 'fit' not in stage_seconds
+
+
+def test_targets_without_rows_are_listed_in_the_summary(tmp_path):
+    input_path = str(tmp_path / 'raw' / 'deploy') + '/'
+    write_synthetic_folder(input_path, num_stations=1, num_hours=2, num_versions=1, num_sensors=2)
+    xml_folder_to_pickled_extraction_dicts(input_path, chunk_by='station', multi_process=False, backend='lxml',
+                                           output_format='flat')
+    model_path = str(tmp_path / 'models') + '/'
+    results = train_targets(output_path=input_path.replace('raw', 'interim'), model_path=model_path,
+                            target_vars=['snow_depth_99'], num_cores=1, resampler=None)
+    with open(model_path + SUMMARY_FILE_NAME) as summary_file:
+        summary = json.load(summary_file)
+    assert not results and not summary['datasets']
+    assert summary['skipped_targets'] == ['snow_depth_99']
@@ -0,0 +1,57 @@
+import datetime
+
+from synthetic_xml import synthetic_source_uri
+from version_flattening import (POST_MC_SUFFIX, flatten_version_state, merge_version_states, station_time_identifier,
+                                update_version_state)
+
+TIMESTAMP = datetime.datetime(2019, 1, 1, 6)
+
+
+def extraction(version: int, air_temperature: str, timestamp: datetime.datetime = TIMESTAMP, **keys):
+    return dict({'source_uri': synthetic_source_uri('wic', '2402604', timestamp, version),
+                 'version': str(version),
+                 'air_temperature_12_value': air_temperature}, **keys)
+
+
+def flat_records(*extractions):
+    state = {}
+    for station_data in extractions:
+        update_version_state(state=state, station_data=station_data)
+    return flatten_version_state(state)
+
+
+def test_latest_of_two_corrections_is_flattened_in_any_order():
+    original = extraction(0, '1.0', **{'air_temperature_12_overall_qa_summary': '0'})
+    first = extraction(1, '1.5', **{'air_temperature_12_qa_flag_override': '100'})
+    second = extraction(2, '2.0')
+    for order in ((original, first, second), (second, original, first), (first, second, original)):
+        record, = flat_records(*order).values()
+        assert record['_merge'] == 'both'
+        assert record['air_temperature_12_value'] == '1.0'
+        assert record['air_temperature_12_value' + POST_MC_SUFFIX] == '2.0'
+        assert record['version' + POST_MC_SUFFIX] == '2'
+        assert record['source_uri' + POST_MC_SUFFIX] == second['source_uri']
+        # Keys of an older correction which are missing in the latest one are not taken over
+        assert 'air_temperature_12_qa_flag_override' + POST_MC_SUFFIX not in record
+
+
+def test_versions_are_compared_as_numbers():
+    record, = flat_records(extraction(0, '1.0'), extraction(10, '3.0'), extraction(9, '2.0')).values()
+    assert record['version' + POST_MC_SUFFIX] == '10'
+    assert record['air_temperature_12_value' + POST_MC_SUFFIX] == '3.0'
+
+
+def test_correction_without_original_has_no_record():
+    later = datetime.datetime(2019, 1, 1, 7)
+    records = flat_records(extraction(0, '1.0'), extraction(1, '2.0', timestamp=later))
+    assert list(records) == [station_time_identifier(extraction(0, '1.0'))]
+    assert records[station_time_identifier(extraction(0, '1.0'))]['_merge'] == 'left_only'
+
+
+def test_states_of_work_units_are_merged_like_one_state():
+    extractions = [extraction(0, '1.0'), extraction(10, '3.0'), extraction(9, '2.0')]
+    state = update_version_state(state={}, station_data=extractions[2])
+    other_state = {}
+    for station_data in extractions[:2]:
+        update_version_state(state=other_state, station_data=station_data)
+    assert flatten_version_state(merge_version_states(state, other_state)) == flat_records(*extractions)